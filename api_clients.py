@@ -0,0 +1,202 @@
+import os
+import math
+import time
+import random
+import asyncio
+import threading
+import contextlib
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+from elevenlabs.client import ElevenLabs
+from rich import print
+
+# Limits for each service we talk to.
+# max_concurrent: how many requests can be in flight at once (across every agent and room). Extra requests wait for a free slot.
+# timeout: seconds to wait for the server to send something (for a streamed response, this is per chunk). connect_timeout: seconds to open the connection.
+# max_retries: how many times to retry after a 429 (rate limited), a 5xx or a dropped connection, with exponential backoff inbetween
+# deadline: a request (including its retries, and reading the whole of a streamed response) gives up after this many seconds, so one bad response can't stall a turn forever
+# timeout_argument: how the client takes a per-request timeout. Each attempt's timeout is cut down to what's left of the deadline.
+PROVIDER_SETTINGS = {
+    "openai": {"max_concurrent": 8, "timeout": 30, "connect_timeout": 5, "max_retries": 3, "deadline": 90, "timeout_argument": "timeout"},
+    "elevenlabs": {"max_concurrent": 4, "timeout": 30, "connect_timeout": 5, "max_retries": 3, "deadline": 90, "timeout_argument": "request_options"},
+}
+
+class APIClients():
+
+    # The OpenAi and ElevenLabs clients that every agent and room shares.
+    # Each service gets one client with a pool of keep-alive connections, so the TLS handshake is only paid once instead of once per agent.
+    # Requests should go through call() / open_stream() (or their async versions), which add the concurrency limit, retries and deadline.
+
+    def __init__(self, provider_settings=PROVIDER_SETTINGS):
+        self.provider_settings = provider_settings
+        self.creation_lock = threading.Lock()
+        self._openai = None
+        self._elevenlabs = None
+        self.slots = {provider: threading.BoundedSemaphore(settings["max_concurrent"]) for provider, settings in provider_settings.items()}
+        # Async clients and semaphores belong to the event loop that created them, so there's one per loop
+        self.async_openai_clients = {}
+        self.async_slots = {}
+
+    def get_http_client_settings(self, provider):
+        settings = self.provider_settings[provider]
+        return {
+            "timeout": httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+            "limits": httpx.Limits(max_connections=settings["max_concurrent"] * 2, max_keepalive_connections=settings["max_concurrent"]),
+        }
+
+    @property
+    def openai(self):
+        with self.creation_lock:
+            if self._openai is None:
+                # Retries are done by call(), so the client doesn't retry on its own as well
+                self._openai = OpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0, http_client=httpx.Client(**self.get_http_client_settings("openai")))
+            return self._openai
+
+    # The async client for the event loop that's currently running
+    def get_async_openai(self):
+        loop = asyncio.get_running_loop()
+        with self.creation_lock:
+            if loop not in self.async_openai_clients:
+                self.async_openai_clients[loop] = AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0, http_client=httpx.AsyncClient(**self.get_http_client_settings("openai")))
+            return self.async_openai_clients[loop]
+
+    @property
+    def elevenlabs(self):
+        with self.creation_lock:
+            if self._elevenlabs is None:
+                settings = self.provider_settings["elevenlabs"]
+                self._elevenlabs = ElevenLabs(api_key=os.getenv('ELEVENLABS_API_KEY'), timeout=settings["timeout"], httpx_client=httpx.Client(**self.get_http_client_settings("elevenlabs")))
+            return self._elevenlabs
+
+    def get_async_slot(self, provider):
+        loop = asyncio.get_running_loop()
+        with self.creation_lock:
+            if (loop, provider) not in self.async_slots:
+                self.async_slots[(loop, provider)] = asyncio.Semaphore(self.provider_settings[provider]["max_concurrent"])
+            return self.async_slots[(loop, provider)]
+
+    # Calls function(*args, **kwargs) once a slot is free for this provider, retrying if it fails with an error that's worth retrying.
+    # function gets the time that's left of the deadline as its timeout (see timeout_argument), so it has to take that argument.
+    def call(self, provider, function, *args, **kwargs):
+        with self.slots[provider]:
+            return self.call_with_retries(provider, self.get_deadline(provider), function, *args, **kwargs)
+
+    # For streamed responses: keeps the slot until you're done reading the stream. Use it like:
+    # with api_clients.open_stream("openai", client.chat.completions.create, model=..., stream=True) as stream:
+    #     for chunk in stream:
+    # Only opening the stream is retried, since by the time chunks are coming in we've already used some of them.
+    # The stream is closed if it's still going at the deadline, so a server that trickles chunks in can't hold us up forever.
+    @contextlib.contextmanager
+    def open_stream(self, provider, function, *args, **kwargs):
+        with self.slots[provider]:
+            deadline = self.get_deadline(provider)
+            stream = self.call_with_retries(provider, deadline, function, *args, **kwargs)
+            timer = threading.Timer(max(0, deadline - time.time()), self.close_late_stream, (provider, stream))
+            timer.daemon = True
+            timer.start()
+            try:
+                yield stream
+            finally:
+                timer.cancel()
+
+    def get_deadline(self, provider):
+        return time.time() + self.provider_settings[provider]["deadline"]
+
+    # Adds the timeout for one attempt to the request's arguments: the usual timeout, or whatever is left of the deadline if that's less
+    def add_timeout(self, provider, kwargs, time_left):
+        settings = self.provider_settings[provider]
+        timeout_argument = settings.get("timeout_argument")
+        if timeout_argument == "timeout":
+            return dict(kwargs, timeout=httpx.Timeout(min(settings["timeout"], time_left), connect=min(settings["connect_timeout"], time_left)))
+        if timeout_argument == "request_options":
+            # ElevenLabs only takes whole seconds
+            request_options = dict(kwargs.get("request_options") or {}, timeout_in_seconds=max(1, math.ceil(min(settings["timeout"], time_left))))
+            return dict(kwargs, request_options=request_options)
+        return kwargs
+
+    def close_late_stream(self, provider, stream):
+        print(f"[red]{provider} stream is still going after its {self.provider_settings[provider]['deadline']}s deadline, closing it")
+        try:
+            result = stream.close()
+            # Async streams close with a coroutine, which has to run on their event loop
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        except Exception as e:
+            print(f"[red]Couldn't close the {provider} stream: {e}")
+
+    # Runs function until it works, it fails with an error that isn't worth retrying, or there's no time left before the deadline for another attempt
+    def call_with_retries(self, provider, deadline, function, *args, **kwargs):
+        settings = self.provider_settings[provider]
+        for attempt in range(settings["max_retries"] + 1):
+            try:
+                return function(*args, **self.add_timeout(provider, kwargs, deadline - time.time()))
+            except Exception as e:
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None or attempt == settings["max_retries"] or time.time() + delay >= deadline:
+                    raise
+                print(f"[yellow]{provider} request failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    # Async version of call(). function must be an async function.
+    async def call_async(self, provider, function, *args, **kwargs):
+        async with self.get_async_slot(provider):
+            return await self.call_with_retries_async(provider, self.get_deadline(provider), function, *args, **kwargs)
+
+    # Async version of open_stream()
+    @contextlib.asynccontextmanager
+    async def open_stream_async(self, provider, function, *args, **kwargs):
+        async with self.get_async_slot(provider):
+            deadline = self.get_deadline(provider)
+            stream = await self.call_with_retries_async(provider, deadline, function, *args, **kwargs)
+            timer = asyncio.get_running_loop().call_later(max(0, deadline - time.time()), self.close_late_stream, provider, stream)
+            try:
+                yield stream
+            finally:
+                timer.cancel()
+
+    async def call_with_retries_async(self, provider, deadline, function, *args, **kwargs):
+        settings = self.provider_settings[provider]
+        for attempt in range(settings["max_retries"] + 1):
+            try:
+                return await function(*args, **self.add_timeout(provider, kwargs, deadline - time.time()))
+            except Exception as e:
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None or attempt == settings["max_retries"] or time.time() + delay >= deadline:
+                    raise
+                print(f"[yellow]{provider} request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    # Returns how long to wait before retrying after this error, or None if it isn't worth retrying (e.g. a bad request or a wrong API key)
+    def get_retry_delay(self, error, attempt):
+        status_code = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        if status_code is None and response is not None:
+            status_code = getattr(response, "status_code", None)
+        if status_code is not None:
+            if status_code != 429 and status_code < 500:
+                return None
+        elif not isinstance(error, (httpx.TransportError, openai.APIConnectionError)):
+            return None
+
+        # If the server told us how long to wait, do that
+        headers = getattr(response, "headers", None) or {}
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), 30)
+            except ValueError:
+                pass
+        # Otherwise exponential backoff (0.5s, 1s, 2s, ...) with some randomness, so the agents don't all retry at the same moment
+        return 0.5 * (2 ** attempt) * random.uniform(0.75, 1.25)
+
+api_clients = None
+api_clients_lock = threading.Lock()
+
+# Everyone shares the same APIClients, which is created the first time it's needed
+def get_api_clients():
+    global api_clients
+    with api_clients_lock:
+        if api_clients is None:
+            api_clients = APIClients()
+        return api_clients
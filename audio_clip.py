@@ -0,0 +1,59 @@
+import io
+import soundfile as sf
+from mutagen.mp3 import MP3
+from rich import print
+
+class AudioClip():
+
+    # A piece of audio that is kept in memory, so it can go from TTS to subtitles to playback without being saved and read back from disk.
+    # data is the encoded audio (the bytes of an mp3 or wav file), audio_format is "mp3", "wav", "ogg" or "flac".
+    # file_path is where the same audio is saved on disk, if anywhere (e.g. in the TTS cache).
+
+    def __init__(self, data, audio_format="mp3", file_path=None):
+        self.data = data
+        self.audio_format = audio_format
+        self.file_path = file_path
+        self._duration = None
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path, "rb") as f:
+            data = f.read()
+        return cls(data, detect_audio_format(data), file_path)
+
+    # Length of the clip in seconds. Only reads the headers, and is only worked out once.
+    @property
+    def duration(self):
+        if self._duration is None:
+            if self.audio_format in ("wav", "ogg", "flac"):
+                with sf.SoundFile(self.get_file_object()) as sound_file:
+                    self._duration = sound_file.frames / sound_file.samplerate
+            elif self.audio_format == "mp3":
+                self._duration = MP3(self.get_file_object()).info.length
+            else:
+                print("Unknown audio format. Returning 0 as clip length")
+                self._duration = 0
+        return self._duration
+
+    # A new file-like object for the audio, for libraries that want to read a file (pygame, mutagen, soundfile).
+    # Every reader gets its own, so they don't move each other's read position.
+    def get_file_object(self):
+        return io.BytesIO(self.data)
+
+    def save(self, file_path):
+        with open(file_path, "wb") as f:
+            f.write(self.data)
+        self.file_path = file_path
+        return file_path
+
+# Works out the real format from the first few bytes, since the file extension can't be trusted
+# (ElevenLabs returns mp3 audio even when we save it as a .wav, which is why pygame used to choke on those files)
+def detect_audio_format(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:4] == b"OggS":
+        return "ogg"
+    if data[:4] == b"fLaC":
+        return "flac"
+    # Otherwise it's an mp3, which starts with an ID3 tag or straight away with an mp3 frame
+    return "mp3"
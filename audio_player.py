@@ -2,15 +2,259 @@ import pygame
 import time
 import os
 import asyncio
-import subprocess
+import queue
 import threading
 import keyboard
 import wave
 import pyaudio
+import numpy as np
 import soundfile as sf
 from mutagen.mp3 import MP3
 from pydub import AudioSegment
 from rich import print
+from audio_clip import AudioClip
+
+# One clip in a PlaybackQueue. started and finished are set the moment Pygame actually starts and stops playing it.
+class PlaybackItem():
+
+    def __init__(self, audio_clip):
+        self.audio_clip = audio_clip
+        self.sound = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        # time.time() of when the clip started and stopped playing
+        self.started_at = None
+        self.finished_at = None
+        self.started_callbacks = []
+        self.finished_callbacks = []
+        self.callbacks_lock = threading.Lock()
+
+    def mark_started(self):
+        self.started_at = time.time()
+        with self.callbacks_lock:
+            self.started.set()
+            callbacks = self.started_callbacks
+            self.started_callbacks = []
+        for callback in callbacks:
+            self.run_callback(callback)
+
+    # Calls callback() the moment the clip starts playing (or straight away if it already has).
+    # It runs on the playback thread, so it should be quick, e.g. sending a message to the front-end.
+    def on_started(self, callback):
+        with self.callbacks_lock:
+            if not self.started.is_set():
+                self.started_callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+    # Same as on_started, but for when the clip stops playing
+    def on_finished(self, callback):
+        with self.callbacks_lock:
+            if not self.finished.is_set():
+                self.finished_callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+    def run_callback(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            print(f"[red]Error in a playback callback: {e}")
+
+    def mark_finished(self):
+        self.finished_at = time.time()
+        with self.callbacks_lock:
+            self.finished.set()
+            callbacks = self.finished_callbacks
+            self.finished_callbacks = []
+        for callback in callbacks:
+            self.run_callback(callback)
+
+    # Returns False if the clip still hadn't finished after timeout seconds
+    def wait_until_finished(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    # The playback thread wakes up the event loop when the clip finishes, so there's no polling
+    async def wait_until_finished_async(self, timeout=None):
+        if self.finished.is_set():
+            return True
+        event_loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+        self.on_finished(lambda: event_loop.call_soon_threadsafe(finished.set))
+        try:
+            await asyncio.wait_for(finished.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class PlaybackQueue():
+
+    # Plays AudioClips one after another with no gap inbetween, on its own reserved Pygame channel.
+    # Pygame Music can only hold one track, so instead every clip is decoded into a Pygame Sound as soon as it's queued,
+    # and handed to the channel's own queue while the previous clip is still playing. Pygame then starts it the moment the previous one ends.
+    # Each queued clip gets a PlaybackItem, whose started/finished events are what the conversation waits on (instead of sleeping for the clip's length).
+    # The playback thread only wakes up when a clip is queued, when the current clip is due to end, or when the queue is stopped.
+    # While nothing is playing it just sits on the queue, so an idle room costs no CPU.
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.channel = pygame.mixer.Channel(channel_id)
+        self.items = queue.Queue() # None in here is just a wake-up call for the playback thread
+        self.current_item = None # The clip that's playing
+        self.next_item = None # The clip that's waiting in the channel's queue
+        self.stopped = False
+        self.closed = False
+        # Set by stop() and close(), for when the playback thread is waiting for the current clip to end
+        self.wake_up = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Adds a clip to the end of the queue, and returns its PlaybackItem
+    def add_clip(self, audio_clip):
+        item = PlaybackItem(audio_clip)
+        self.items.put(item)
+        return item
+
+    # Stops the current clip and throws away the rest of the queue
+    def stop(self):
+        self.stopped = True
+        self.items.put(None)
+        self.wake_up.set()
+
+    # Stops everything and ends the playback thread, after which the channel can be given to another queue
+    def close(self):
+        self.closed = True
+        self.stop()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    # Seconds until Pygame should be done with the current clip.
+    # Never 0, so if Pygame is a little late we check again shortly instead of spinning.
+    def get_time_left(self):
+        time_left = self.current_item.started_at + self.current_item.sound.get_length() - time.time()
+        return max(time_left, 0.01)
+
+    def run(self):
+        while not self.closed:
+            item = None
+            if self.current_item is None:
+                # Nothing is playing, so wait as long as it takes for a clip
+                item = self.items.get()
+            elif self.next_item is None:
+                # Take the next clip as soon as it's queued, so it's decoded and handed to Pygame before the current one ends
+                try:
+                    item = self.items.get(timeout=self.get_time_left())
+                except queue.Empty:
+                    pass
+            else:
+                # Both of the channel's slots are taken, so there's nothing to do until the current clip ends
+                self.wake_up.wait(self.get_time_left())
+                self.wake_up.clear()
+
+            if self.stopped:
+                self.stopped = False
+                self.channel.stop()
+                if item is not None:
+                    item.mark_started()
+                    item.mark_finished()
+                self.clear()
+                continue
+
+            if item is not None:
+                try:
+                    self.start_item(item)
+                except Exception as e:
+                    # A clip that can't be decoded (or played) is skipped, and the queue carries on with the next one
+                    print(f"[red]Couldn't play a clip, skipping it: {e}")
+                    item.mark_started()
+                    item.mark_finished()
+
+            if self.current_item is None:
+                continue
+            # Pygame moves the queued sound into the channel the moment the current one ends
+            if self.next_item is not None and self.channel.get_queue() is None:
+                self.current_item.mark_finished()
+                self.current_item = self.next_item
+                self.next_item = None
+                self.current_item.mark_started()
+            elif self.next_item is None and not self.channel.get_busy():
+                self.current_item.mark_finished()
+                self.current_item = None
+
+        # Closed, so nothing else is going to play the clips that are left
+        self.channel.stop()
+        self.clear()
+
+    # Starts the clip straight away if nothing is playing, otherwise hands it to the channel's queue
+    def start_item(self, item):
+        # Decoding happens here, while the previous clip is still playing
+        item.sound = pygame.mixer.Sound(file=item.audio_clip.get_file_object())
+        if self.current_item is None:
+            self.channel.play(item.sound)
+            self.current_item = item
+            item.mark_started()
+        else:
+            self.channel.queue(item.sound)
+            self.next_item = item
+
+    # Marks every clip as finished, so nobody is left waiting on them
+    def clear(self):
+        for item in (self.current_item, self.next_item):
+            if item is not None:
+                item.mark_started()
+                item.mark_finished()
+        self.current_item = None
+        self.next_item = None
+        while True:
+            try:
+                item = self.items.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item.mark_started()
+                item.mark_finished()
+
+class AudioRingBuffer():
+
+    # A fixed amount of mono audio samples, stored in one numpy array that gets written to in a circle.
+    # Used while streaming the mic, so memory use stays the same no matter how long someone talks.
+
+    def __init__(self, max_samples):
+        self.buffer = np.zeros(max_samples, dtype=np.float32)
+        self.start = 0 # Index of the oldest sample
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    # Adds samples to the end. If the buffer is full, the oldest samples are overwritten.
+    def write(self, samples):
+        max_samples = len(self.buffer)
+        if len(samples) >= max_samples:
+            samples = samples[-max_samples:]
+        dropped = max(0, self.length + len(samples) - max_samples)
+        if dropped:
+            print(f"[red]Mic buffer is full, dropped {dropped} samples")
+            self.start = (self.start + dropped) % max_samples
+            self.length -= dropped
+        end = (self.start + self.length) % max_samples
+        first_part = min(len(samples), max_samples - end)
+        self.buffer[end:end+first_part] = samples[:first_part]
+        self.buffer[:len(samples)-first_part] = samples[first_part:]
+        self.length += len(samples)
+
+    # Returns the oldest count samples, without removing them
+    def peek(self, count):
+        count = min(count, self.length)
+        indexes = (self.start + np.arange(count)) % len(self.buffer)
+        return self.buffer[indexes]
+
+    # Returns the oldest count samples and removes them from the buffer
+    def read(self, count):
+        samples = self.peek(count)
+        self.start = (self.start + len(samples)) % len(self.buffer)
+        self.length -= len(samples)
+        return samples
 
 class AudioManager:
 
@@ -26,6 +270,38 @@ class AudioManager:
         # Use higher frequency to prevent audio glitching noises
         # Use higher buffer because why not (default is 512)
         pygame.mixer.init(frequency=48000, buffer=1024) 
+        # Name -> PlaybackQueue. Each queue (e.g. one per conversation room) gets its own reserved channel, so they don't cut each other off.
+        self.playback_queues = {}
+        self.playback_queues_lock = threading.Lock()
+
+    # Returns the PlaybackQueue with this name, creating it the first time
+    def get_playback_queue(self, name="main"):
+        with self.playback_queues_lock:
+            if name not in self.playback_queues:
+                if not pygame.mixer.get_init(): # Reinitialize mixer if needed
+                    pygame.mixer.init(frequency=48000, buffer=1024) 
+                # Reuse the lowest channel that a removed queue has given back
+                used_channel_ids = {playback_queue.channel_id for playback_queue in self.playback_queues.values()}
+                channel_id = 0
+                while channel_id in used_channel_ids:
+                    channel_id += 1
+                # Reserved channels are never picked by Sound.play(), so play_audio can't steal them
+                if pygame.mixer.get_num_channels() < channel_id + 8:
+                    pygame.mixer.set_num_channels(channel_id + 8)
+                pygame.mixer.set_reserved(max(used_channel_ids | {channel_id}) + 1)
+                self.playback_queues[name] = PlaybackQueue(channel_id)
+            return self.playback_queues[name]
+
+    # Stops a PlaybackQueue and ends its thread (e.g. when its room is destroyed). Its channel is reused by the next queue.
+    def remove_playback_queue(self, name):
+        with self.playback_queues_lock:
+            playback_queue = self.playback_queues.pop(name, None)
+        if playback_queue is not None:
+            playback_queue.close()
+
+    # Adds a clip to the end of a PlaybackQueue, and returns its PlaybackItem
+    def queue_clip(self, audio_clip, queue_name="main"):
+        return self.get_playback_queue(queue_name).add_clip(audio_clip)
 
     def play_audio(self, file_path, sleep_during_playback=True, delete_file=False, play_using_music=True):
         """
@@ -37,21 +313,12 @@ class AudioManager:
         """
         if not pygame.mixer.get_init(): # Reinitialize mixer if needed
             pygame.mixer.init(frequency=48000, buffer=1024) 
+        audio_clip = None
         if play_using_music:
             # Pygame Music can only play one file at a time
-            try:
-                pygame.mixer.music.load(file_path)
-                pygame.mixer.music.play()
-                converted = False
-            except:
-                # Wav files from Elevenlabs don't work with Pygame's Music for some fucking reason (works fine with Sound)
-                # If there's an error here that's likely why, so convert it to a format that Pygame can handle
-                # You can't convert the file in place so just convert it into a temp file that you delete later
-                converted_wav = "temp_convert.wav"
-                subprocess.run(["ffmpeg", "-y", "-i", file_path, "-ar", "48000", "-ac", "2", "-c:a", "pcm_s16le", converted_wav])
-                converted = True
-                pygame.mixer.music.load(converted_wav)
-                pygame.mixer.music.play()
+            # The file is read into memory and handed to Pygame from there, see play_clip
+            audio_clip = AudioClip.from_file(file_path)
+            self.play_clip(audio_clip)
         else:
             # Pygame Sound lets you play multiple sounds simultaneously
             pygame_sound = pygame.mixer.Sound(file_path) 
@@ -59,7 +326,7 @@ class AudioManager:
 
         if sleep_during_playback:
             # Sleep until file is done playing
-            file_length = self.get_audio_length(file_path)
+            file_length = audio_clip.duration if audio_clip else self.get_audio_length(file_path)
             time.sleep(file_length)
             # Delete the file
             if delete_file:
@@ -69,11 +336,18 @@ class AudioManager:
                 pygame.mixer.quit()
                 try:  
                     os.remove(file_path)
-                    if converted:
-                        os.remove(converted_wav) # Remove the converted wav if it was created
                 except PermissionError:
                     print(f"Couldn't remove {file_path} because it is being used by another process.")
 
+    # Plays an in-memory AudioClip with Pygame Music, without waiting for it to finish
+    def play_clip(self, audio_clip):
+        if not pygame.mixer.get_init(): # Reinitialize mixer if needed
+            pygame.mixer.init(frequency=48000, buffer=1024) 
+        # Wav files from Elevenlabs used to break Pygame's Music, because they're actually mp3s with the wrong extension, so we had to convert them with ffmpeg.
+        # Loading from memory with the real format as a hint avoids that (and the temp file).
+        pygame.mixer.music.load(audio_clip.get_file_object(), audio_clip.audio_format)
+        pygame.mixer.music.play()
+
     async def play_audio_async(self, file_path):
         """
         Parameters:
@@ -134,33 +408,7 @@ class AudioManager:
         # For some reason this doesn't work on the Broadcast GoXLR Mix, the other 3 GoXLR audio inputs all work fine.
         # Both Azure Speech-to-Text AND this script have issues listening to Broadcast Stream Mix, so just ignore it.
         audio = pyaudio.PyAudio()
-        
-        if audio_device is None:
-            # If no audio_device is provided, use the default mic
-            audio_stream = audio.open(format=self.audio_format, channels=self.channels, rate=self.rate, input=True, frames_per_buffer=self.chunk)
-        else:
-            # If an audio device was provided, find its index
-            device_index = None
-            for i in range(audio.get_device_count()):
-                dev_info = audio.get_device_info_by_index(i)
-                # print(dev_info['name'])
-                if audio_device in dev_info['name']:
-                    device_index = i
-                    # Some audio devices only support specific sample rates, so make sure to find a sample rate that's compatible with the device
-                    # This was necessary on certain GoXLR input but only sometimes. But this fixes the issues so w/e.
-                    supported_rates = [96000, 48000, 44100, 32000, 22050, 16000, 11025, 8000]
-                    for rate in supported_rates:
-                        try:
-                            if audio.is_format_supported(rate, input_device=device_index, input_channels=self.channels, input_format=self.audio_format):
-                                self.rate = rate
-                                break
-                        except ValueError:
-                            continue
-            if device_index is None:
-                raise ValueError(f"Device '{audio_device}' not found")
-            if self.rate is None:
-                raise ValueError(f"No supported sample rate found for device '{audio_device}'")
-            audio_stream = audio.open(format=self.audio_format, channels=self.channels, rate=self.rate, input=True, input_device_index=device_index, frames_per_buffer=self.chunk)
+        audio_stream = self.open_mic_stream(audio, audio_device)
                     
         # Start recording an a second thread
         self.is_recording = True
@@ -189,4 +437,73 @@ class AudioManager:
         audio.terminate()
 
         return filename
-        
+
+    # Same as record_audio, but instead of saving everything to a wav file at the end, this hands the audio over in windows while the person is still talking.
+    # This is a generator that yields (samples, sample_rate) every window_seconds, and once more with whatever is left when the end key is pressed.
+    # samples is a mono float32 numpy array (between -1 and 1) at self.rate, which still has to be resampled to 16kHz for Whisper (see whisper_openai.py).
+    # Only the current window is kept in memory, in a ring buffer, so a long rant doesn't pile up in RAM.
+    def stream_mic_audio(self, end_recording_key='=', audio_device=None, window_seconds=10):
+        audio = pyaudio.PyAudio()
+        audio_stream = self.open_mic_stream(audio, audio_device)
+        window_samples = int(window_seconds * self.rate)
+        # The extra second is the part of the window we search for a quiet spot to cut at, plus room for one more chunk
+        ring_buffer = AudioRingBuffer(window_samples + self.rate + self.chunk)
+        try:
+            # Reading a chunk takes about 20ms, so we check the key much more often than record_audio does
+            while not keyboard.is_pressed(end_recording_key):
+                data = audio_stream.read(self.chunk, exception_on_overflow=False)
+                ring_buffer.write(self.pcm_to_mono_float(data))
+                if len(ring_buffer) >= window_samples + self.rate:
+                    yield ring_buffer.read(self.find_quiet_cut(ring_buffer.peek(window_samples + self.rate), window_samples)), self.rate
+            if len(ring_buffer) > 0:
+                yield ring_buffer.read(len(ring_buffer)), self.rate
+        finally:
+            audio_stream.stop_stream()
+            audio_stream.close()
+            audio.terminate()
+
+    # Converts interleaved 16-bit PCM from the mic into mono float32 samples
+    def pcm_to_mono_float(self, data):
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+        return samples.reshape(-1, self.channels).mean(axis=1)
+
+    # Returns where to end a window, so we don't cut a word in half:
+    # the quietest 20ms after the first min_samples samples (or the end of the window if that's the quietest)
+    def find_quiet_cut(self, samples, min_samples):
+        frame_length = max(1, int(self.rate * 0.02))
+        search_area = samples[min_samples:]
+        frame_count = len(search_area) // frame_length
+        if frame_count == 0:
+            return len(samples)
+        frames = search_area[:frame_count * frame_length].reshape(frame_count, frame_length)
+        frame_energy = (frames ** 2).mean(axis=1)
+        return min_samples + int(np.argmin(frame_energy)) * frame_length
+
+    # Opens an input stream on the mic (or on the given audio device)
+    def open_mic_stream(self, audio, audio_device=None):
+        if audio_device is None:
+            # If no audio_device is provided, use the default mic
+            return audio.open(format=self.audio_format, channels=self.channels, rate=self.rate, input=True, frames_per_buffer=self.chunk)
+
+        # If an audio device was provided, find its index
+        device_index = None
+        for i in range(audio.get_device_count()):
+            dev_info = audio.get_device_info_by_index(i)
+            # print(dev_info['name'])
+            if audio_device in dev_info['name']:
+                device_index = i
+                # Some audio devices only support specific sample rates, so make sure to find a sample rate that's compatible with the device
+                # This was necessary on certain GoXLR input but only sometimes. But this fixes the issues so w/e.
+                supported_rates = [96000, 48000, 44100, 32000, 22050, 16000, 11025, 8000]
+                for rate in supported_rates:
+                    try:
+                        if audio.is_format_supported(rate, input_device=device_index, input_channels=self.channels, input_format=self.audio_format):
+                            self.rate = rate
+                            break
+                    except ValueError:
+                        continue
+        if device_index is None:
+            raise ValueError(f"Device '{audio_device}' not found")
+        if self.rate is None:
+            raise ValueError(f"No supported sample rate found for device '{audio_device}'")
+        return audio.open(format=self.audio_format, channels=self.channels, rate=self.rate, input=True, input_device_index=device_index, frames_per_buffer=self.chunk)
@@ -0,0 +1,424 @@
+# Offline benchmark for the conversation loop.
+# Runs the real ConversationRoom / Agent / PreparedTurn / Human code and the real managers, with stand-ins only for what's outside this PC:
+# the OpenAi and ElevenLabs clients are faked (underneath APIClients, the TTS cache and the voice cache), OBS is a fake websocket server
+# (see fake_obs_server.py) that the real OBSWebsocketsManager connects to, the audio plays through SDL's silent "dummy" driver, and the mic and Whisper are scripted.
+# Each fake waits for a random amount of time (a log-normal distribution with the median and p95 you give it) to act like the real service.
+#
+# Example: python benchmark.py --turns 40 --interject-every 8 --llm-first-sentence 0.6:1.8 --tts 0.5:1.5
+#
+# At the end it prints turns per minute, the dead air between speakers, how long turns waited on the locks,
+# how much memory grew over the run, and the p50/p95 of every stage from latency_trace.py.
+# Everything is written into a temporary folder, so your real chat history and TTS cache aren't touched.
+# Note that tiktoken needs its encoding files, so run the real app once (online) before using this on an offline machine.
+
+import os
+import sys
+import json
+import math
+import time
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from rich import print
+
+# Play the audio through SDL's silent driver, so the real playback queue runs without anything coming out of your speakers
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import api_clients
+import latency_trace
+from elevenlabs import VoiceSettings
+from api_clients import APIClients
+from latency_trace import LatencyTracer, print_summary
+from obs_websockets import OBSWebsocketsManager
+from fake_obs_server import FakeOBSServer
+import multi_agent_gpt
+from multi_agent_gpt import SharedResources, ConversationRoom, Human, DEFAULT_AGENTS
+
+# Median and p95 of each fake service's latency, in seconds
+DEFAULT_LATENCIES = {
+    "llm_first_sentence": (0.6, 1.5), # From sending the request to the first full sentence
+    "llm_next_sentence": (0.3, 0.8), # Each sentence after that
+    "tts": (0.5, 1.2), # One TTS request
+    "obs": (0.01, 0.05), # One OBS websocket request
+    "asr": (0.3, 1.0), # Whisper finishing the transcript after the human stops talking
+}
+
+FAKE_SENTENCES = [
+    "I once raced a goose in Mario Kart and the goose won.",
+    "That is the most unhinged thing anyone has said all day!",
+    "Honestly, the blue shell is a metaphor for capitalism.",
+    "Wait, are we still talking about video games?",
+    "My controller is held together entirely with tape and spite.",
+    "Nobody respects the rainbow road like I do.",
+    "I would trade my whole family for one more mushroom.",
+    "Excuse me, that was clearly a legal shortcut.",
+    "Let's be real, Luigi has been carrying this franchise.",
+    "I'm going to pretend I didn't hear that.",
+]
+
+# Random wait times that look like real network latency: usually close to the median, with a long tail up to the p95 and beyond
+class LatencyDistribution():
+
+    def __init__(self, median, p95):
+        self.median = median
+        self.sigma = math.log(p95 / median) / 1.645 if p95 > median > 0 else 0
+
+    def sample(self):
+        if self.median <= 0:
+            return 0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    def wait(self):
+        time.sleep(self.sample())
+
+    async def wait_async(self):
+        await asyncio.sleep(self.sample())
+
+# Stand-in for the OpenAI client. Only chat.completions.create() is used by OpenAiManager.
+# It also acts out OpenAi's prompt caching, so the benchmark shows how much of each prompt would have been cached.
+class FakeOpenAI():
+
+    def __init__(self, latencies, sentences_per_answer=3):
+        self.latencies = latencies
+        self.sentences_per_answer = sentences_per_answer
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        # Every prompt prefix (a whole number of messages) we've seen, shared by the sync and async clients
+        self.seen_prefixes = set()
+        self.seen_prefixes_lock = threading.Lock()
+
+    def make_answer(self):
+        return random.sample(FAKE_SENTENCES, self.sentences_per_answer)
+
+    # Like OpenAi: the longest start of the prompt that was sent before is cached, if it's at least 1024 tokens, in steps of 128 tokens.
+    # Tokens are estimated as 4 characters each.
+    def get_usage(self, messages):
+        prompt_tokens = 0
+        cached_tokens = 0
+        prefix = ""
+        with self.seen_prefixes_lock:
+            for message in messages:
+                prefix += json.dumps(message, sort_keys=True)
+                prompt_tokens = len(prefix) // 4
+                if prefix in self.seen_prefixes:
+                    cached_tokens = prompt_tokens
+                self.seen_prefixes.add(prefix)
+        cached_tokens = cached_tokens // 128 * 128 if cached_tokens >= 1024 else 0
+        return SimpleNamespace(prompt_tokens=prompt_tokens, prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+
+    def create(self, model=None, messages=None, stream=False, stream_options=None, timeout=None):
+        sentences = self.make_answer()
+        usage = self.get_usage(messages or [])
+        if stream:
+            return self.stream(sentences, usage)
+        self.latencies["llm_first_sentence"].wait()
+        for _ in sentences[1:]:
+            self.latencies["llm_next_sentence"].wait()
+        return make_completion(" ".join(sentences), usage)
+
+    def stream(self, sentences, usage):
+        for i, sentence in enumerate(sentences):
+            self.latencies["llm_first_sentence" if i == 0 else "llm_next_sentence"].wait()
+            # Send each sentence word by word, like OpenAi does
+            for word in (sentence + " ").split(" "):
+                yield make_chunk(word + " ")
+        yield make_usage_chunk(usage)
+
+# Async version of FakeOpenAI, for the asyncio engine
+class FakeAsyncOpenAI(FakeOpenAI):
+
+    async def create(self, model=None, messages=None, stream=False, stream_options=None, timeout=None):
+        sentences = self.make_answer()
+        usage = self.get_usage(messages or [])
+        if stream:
+            return self.stream_async(sentences, usage)
+        await self.latencies["llm_first_sentence"].wait_async()
+        for _ in sentences[1:]:
+            await self.latencies["llm_next_sentence"].wait_async()
+        return make_completion(" ".join(sentences), usage)
+
+    async def stream_async(self, sentences, usage):
+        for i, sentence in enumerate(sentences):
+            await self.latencies["llm_first_sentence" if i == 0 else "llm_next_sentence"].wait_async()
+            for word in (sentence + " ").split(" "):
+                yield make_chunk(word + " ")
+        yield make_usage_chunk(usage)
+
+def make_completion(text, usage=None):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+def make_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+def make_usage_chunk(usage):
+    return SimpleNamespace(choices=[], usage=usage)
+
+# Silent mp3 audio: MPEG-1 Layer III frames (128kbps, 44.1kHz, mono) with nothing in them. Each frame is 1152 samples long.
+SILENT_MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0xC4]) + bytes(413)
+
+def make_silent_mp3(duration):
+    return SILENT_MP3_FRAME * max(1, round(duration * 44100 / 1152))
+
+# Stand-in for the ElevenLabs client, used underneath the real ElevenLabsManager, so its voice cache and TTS cache are part of the benchmark.
+# TTS returns silent mp3 audio that's as long as the text would take to say, divided by playback_speed.
+class FakeElevenLabs():
+
+    def __init__(self, latencies, playback_speed=1, words_per_second=2.5):
+        self.latencies = latencies
+        self.playback_speed = playback_speed
+        self.words_per_second = words_per_second
+        self.voices = SimpleNamespace(get_all=self.get_all_voices, get_settings=self.get_voice_settings)
+        self.text_to_speech = SimpleNamespace(convert_with_timestamps=self.convert_with_timestamps)
+
+    def get_all_voices(self, request_options=None):
+        self.latencies["tts"].wait()
+        return SimpleNamespace(voices=[SimpleNamespace(name=agent["voice"], voice_id=f"voice-{i}") for i, agent in enumerate(DEFAULT_AGENTS)])
+
+    def get_voice_settings(self, voice_id, request_options=None):
+        self.latencies["tts"].wait()
+        return VoiceSettings(stability=0.5, similarity_boost=0.75)
+
+    def get_duration(self, text):
+        return max(0.2, len(text.split()) / self.words_per_second) / self.playback_speed
+
+    def generate(self, text=None, voice=None, model=None, request_options=None):
+        self.latencies["tts"].wait()
+        return make_silent_mp3(self.get_duration(text))
+
+    # Every character gets the same amount of time in the alignment
+    def convert_with_timestamps(self, voice_id, text=None, model_id=None, voice_settings=None, request_options=None):
+        self.latencies["tts"].wait()
+        duration = self.get_duration(text)
+        character_length = duration / max(1, len(text))
+        alignment = {
+            "characters": list(text),
+            "character_start_times_seconds": [i * character_length for i in range(len(text))],
+            "character_end_times_seconds": [(i + 1) * character_length for i in range(len(text))],
+        }
+        return {"audio_base64": base64.b64encode(make_silent_mp3(duration)).decode("ascii"), "alignment": alignment}
+
+# APIClients that hands out the fake OpenAi and ElevenLabs clients instead of real ones. The concurrency limits, retries and deadlines are the real ones.
+class FakeAPIClients(APIClients):
+
+    def __init__(self, latencies, playback_speed=1):
+        super().__init__()
+        self.fake_openai = FakeOpenAI(latencies)
+        self.fake_async_openai = FakeAsyncOpenAI(latencies)
+        self.fake_elevenlabs = FakeElevenLabs(latencies, playback_speed)
+
+    @property
+    def openai(self):
+        return self.fake_openai
+
+    def get_async_openai(self):
+        return self.fake_async_openai
+
+    @property
+    def elevenlabs(self):
+        return self.fake_elevenlabs
+
+# Stand-in for Whisper, only used if the subtitles have nothing better to go on
+class FakeWhisperManager():
+
+    def __init__(self, latencies):
+        self.latencies = latencies
+
+    def audio_to_text(self, audio_file, timestamps=None):
+        self.latencies["asr"].wait()
+        return [] if timestamps else ""
+
+# The human, but instead of the keyboard and mic it interjects every few agent turns with a scripted line.
+# It still goes through the real Human.run() loop: pause the agents, share the line, activate a random agent.
+class ScriptedHuman(Human):
+
+    def __init__(self, room, name, latencies, interject_every, speaking_seconds, count_agent_turns):
+        super().__init__(room, name)
+        self.latencies = latencies
+        self.interject_every = interject_every
+        self.speaking_seconds = speaking_seconds
+        self.count_agent_turns = count_agent_turns
+        self.next_interjection = interject_every
+        self.interjections = 0
+
+    def get_pressed_key(self):
+        if self.interject_every and self.count_agent_turns() >= self.next_interjection:
+            self.next_interjection += self.interject_every
+            return 'num 7'
+        return None
+
+    def record_and_transcribe(self):
+        tracer = latency_trace.get_latency_tracer()
+        trace = {"trace_id": tracer.new_trace_id(self.name), "room": self.room.name}
+        with tracer.span("human_recording", **trace):
+            time.sleep(self.speaking_seconds)
+        with tracer.span("asr", **trace):
+            self.latencies["asr"].wait()
+        self.interjections += 1
+        return f"Okay everyone, new topic number {self.interjections}: who would win in a fight, a goose or Luigi?"
+
+def parse_latency(value):
+    median, p95 = value.split(":")
+    return float(median), float(p95)
+
+def format_megabytes(size_bytes):
+    return f"{size_bytes / (1024 * 1024):.2f} MB"
+
+# Waits (up to timeout seconds) for every other task on the running event loop to finish
+async def wait_for_leftover_tasks(timeout=30):
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+# obs_restart_every: close the fake OBS after every this many agent lines (0 = never), and open it again obs_outage_seconds later
+def run_benchmark(turns=20, engine_mode="threading", latencies=None, interject_every=0, human_speaking_seconds=2, playback_speed=1, streaming=True, timeout=None, obs_restart_every=0, obs_outage_seconds=1):
+    latency_settings = dict(DEFAULT_LATENCIES)
+    latency_settings.update(latencies or {})
+    latencies = {name: LatencyDistribution(*values) for name, values in latency_settings.items()}
+
+    # Keep every file the room writes (conversation log, trace, TTS cache, voice cache) out of the real project folder
+    working_directory = tempfile.mkdtemp(prefix="agent_benchmark_")
+    original_directory = os.getcwd()
+    os.chdir(working_directory)
+    try:
+        # Swap the shared OpenAi / ElevenLabs clients and the latency tracer for ours
+        api_clients.api_clients = FakeAPIClients(latencies, playback_speed)
+        tracer = LatencyTracer(os.path.join(working_directory, "latency_trace.jsonl"))
+        latency_trace.latency_tracer = tracer
+        multi_agent_gpt.STREAMING_RESPONSES = streaming
+
+        # The ElevenLabs and audio managers are the real ones (created when the room first needs them). OBS is the real manager, talking to a fake OBS.
+        obs_server = FakeOBSServer(response_delay=latencies["obs"].sample)
+        obs_server.start()
+        resources = SharedResources()
+        resources._obswebsockets_manager = OBSWebsocketsManager(host=obs_server.host, port=obs_server.port, password="", min_reconnect_delay=0.1, max_reconnect_delay=2)
+        resources._obswebsockets_manager.wait_until_connected(5)
+        resources._whisper_manager = FakeWhisperManager(latencies)
+        obs_restart_timer = None
+        next_obs_restart = obs_restart_every
+
+        room = ConversationRoom("benchmark", resources, DEFAULT_AGENTS, None, engine_mode)
+        agent_names = {agent.name for agent in room.agents}
+        def count_agent_turns():
+            return sum(1 for entry in room.conversation_log.get_entries() if entry['speaker'] in agent_names)
+        room.human = ScriptedHuman(room, "DOUGDOUG", latencies, interject_every, human_speaking_seconds, count_agent_turns)
+
+        tracemalloc.start()
+        memory_samples = [(0, tracemalloc.get_traced_memory()[0])]
+        start = time.perf_counter()
+        if engine_mode == "asyncio":
+            event_loop = asyncio.new_event_loop()
+            event_loop_thread = threading.Thread(target=event_loop.run_forever, daemon=True)
+            event_loop_thread.start()
+            room.async_future = asyncio.run_coroutine_threadsafe(room.run_async(), event_loop)
+            # The agents' activation events only exist once run_async() has started
+            while room.agents[0].event_loop is None:
+                time.sleep(0.01)
+        else:
+            room.start()
+        room.agents[0].activate()
+
+        print(f"[green]Running {turns} turns with the {engine_mode} engine in {working_directory}")
+        completed_turns = 0
+        while completed_turns < turns:
+            time.sleep(0.05)
+            new_completed_turns = count_agent_turns()
+            if new_completed_turns != completed_turns:
+                completed_turns = new_completed_turns
+                memory_samples.append((completed_turns, tracemalloc.get_traced_memory()[0]))
+            if obs_restart_every and completed_turns >= next_obs_restart and obs_restart_timer is None:
+                next_obs_restart += obs_restart_every
+                print("[yellow]Closing the fake OBS")
+                obs_server.stop()
+                obs_restart_timer = threading.Timer(obs_outage_seconds, obs_server.start)
+                obs_restart_timer.start()
+            if obs_restart_timer is not None and not obs_restart_timer.is_alive():
+                obs_restart_timer = None
+            if timeout and time.perf_counter() - start > timeout:
+                print(f"[red]Timed out after {completed_turns} turns")
+                break
+        elapsed = time.perf_counter() - start
+        room.stop()
+        # Wait for everyone to stop, so nothing gets written to the conversation log after we've left the temporary folder
+        room.wait_until_stopped()
+        if engine_mode == "asyncio":
+            # Cancelled lines that were prepared ahead of time can still be waiting on their TTS, let them finish before the loop goes away
+            asyncio.run_coroutine_threadsafe(wait_for_leftover_tasks(), event_loop).result()
+            event_loop.call_soon_threadsafe(event_loop.stop)
+            event_loop_thread.join(timeout=30)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if obs_restart_timer is not None:
+            obs_restart_timer.cancel()
+            obs_restart_timer.join()
+        obs_health = resources.obswebsockets_manager.get_health()
+        resources.obswebsockets_manager.disconnect()
+        obs_server.stop()
+
+        report = {
+            "turns": completed_turns,
+            "elapsed_seconds": round(elapsed, 1),
+            "turns_per_minute": round(completed_turns / elapsed * 60, 2) if elapsed else 0,
+            "interjections": room.human.interjections,
+            "memory_start": memory_samples[0][1],
+            "memory_end": memory_samples[-1][1],
+            "memory_peak": peak_memory,
+            "memory_samples": memory_samples,
+            "prompt_tokens": sum(agent.openai_manager.total_prompt_tokens for agent in room.agents),
+            "cached_tokens": sum(agent.openai_manager.total_cached_tokens for agent in room.agents),
+            "obs_requests": len(obs_server.received_requests),
+            # A batch is one round-trip, however many requests are in it
+            "obs_round_trips": len(obs_server.received_requests) - sum(obs_server.batch_sizes) + len(obs_server.batch_sizes),
+            "obs_connections": obs_server.connections,
+            "obs_dropped_requests": obs_health["dropped_requests"],
+            "tts_cache": resources.elevenlabs_manager.tts_cache.get_stats(),
+            "stages": tracer.get_summary(),
+        }
+        return report
+    finally:
+        os.chdir(original_directory)
+
+def print_report(report):
+    stages = report["stages"]
+    print("\n[bold]Benchmark results")
+    print(f"Turns: {report['turns']} in {report['elapsed_seconds']}s ({report['turns_per_minute']} turns per minute), {report['interjections']} human interjections")
+    for name, label in [("dead_air", "Dead air between speakers"), ("wait_speaking_lock", "Waiting on speaking_lock"), ("wait_conversation_lock", "Waiting on conversation_lock")]:
+        if name in stages:
+            print(f"{label}: p50 {stages[name]['p50_ms']} ms, p95 {stages[name]['p95_ms']} ms, max {stages[name]['max_ms']} ms")
+    if report["prompt_tokens"]:
+        print(f"Prompt cache: {report['cached_tokens']}/{report['prompt_tokens']} prompt tokens cached ({report['cached_tokens'] / report['prompt_tokens']:.0%})")
+    tts_cache = report["tts_cache"]
+    print(f"TTS cache: {tts_cache['hits']} hits, {tts_cache['misses']} misses, {tts_cache['evictions']} evictions, {tts_cache['files']} files")
+    print(f"OBS: {report['obs_requests']} requests in {report['obs_round_trips']} round-trips, reconnected {report['obs_connections'] - 1} times, {report['obs_dropped_requests']} requests dropped while disconnected")
+    # Memory that Python allocated since the benchmark started, at the start, halfway through and at the end.
+    # If it keeps going up between the halfway point and the end, something is holding on to every turn.
+    samples = report["memory_samples"]
+    middle_turn, middle_memory = samples[len(samples) // 2]
+    growth = report["memory_end"] - report["memory_start"]
+    turns = max(1, report["turns"])
+    print(f"Memory: {format_megabytes(report['memory_start'])} -> {format_megabytes(middle_memory)} after {middle_turn} turns -> {format_megabytes(report['memory_end'])} (peak {format_megabytes(report['memory_peak'])}), {growth / turns / 1024:.1f} KB per turn")
+    print("\n[bold]All stages")
+    print_summary(stages)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the agents against fake OpenAi, ElevenLabs and OBS servers, silent speakers and a scripted mic, and reports how fast the conversation flows.")
+    parser.add_argument("--turns", type=int, default=20, help="number of agent lines to run")
+    parser.add_argument("--engine", choices=["threading", "asyncio"], default="threading")
+    parser.add_argument("--no-streaming", action="store_true", help="wait for each full answer instead of streaming it sentence by sentence")
+    parser.add_argument("--interject-every", type=int, default=0, help="the human talks after every this many agent lines (0 = never)")
+    parser.add_argument("--human-speaking-seconds", type=float, default=2, help="how long each human interjection takes to say")
+    parser.add_argument("--playback-speed", type=float, default=1, help="make the fake TTS audio this many times shorter, to run more turns quicker")
+    parser.add_argument("--obs-restart-every", type=int, default=0, help="close the fake OBS for a second after every this many agent lines (0 = never)")
+    parser.add_argument("--timeout", type=float, default=None, help="give up after this many seconds")
+    for name, (median, p95) in DEFAULT_LATENCIES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=parse_latency, default=None, metavar="MEDIAN:P95", help=f"latency in seconds (default {median}:{p95})")
+    args = parser.parse_args()
+
+    latencies = {name: getattr(args, name) for name in DEFAULT_LATENCIES if getattr(args, name) is not None}
+    report = run_benchmark(args.turns, args.engine, latencies, args.interject_every, args.human_speaking_seconds, args.playback_speed, not args.no_streaming, args.timeout, args.obs_restart_every)
+    print_report(report)
+    # The agent threads are daemons, so this ends them
+    sys.exit(0)
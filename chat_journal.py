@@ -0,0 +1,138 @@
+import os
+import json
+import queue
+import atexit
+import threading
+from rich import print
+
+# Background thread that does the actual disk writes for every ChatJournal, so nobody has to wait on the disk while holding the conversation lock
+class JournalWriter():
+
+    def __init__(self):
+        self.write_queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            write_function, args = self.write_queue.get()
+            try:
+                write_function(*args)
+            except Exception as e:
+                print(f"[red]ERROR: Couldn't write chat history to disk: {e}")
+            self.write_queue.task_done()
+
+    def submit(self, write_function, *args):
+        self.write_queue.put((write_function, args))
+
+    # Blocks until everything that has been submitted so far is on disk
+    def flush(self):
+        self.write_queue.join()
+
+journal_writer = None
+journal_writer_lock = threading.Lock()
+
+# All journals share a single writer thread, which is created the first time it's needed
+def get_journal_writer():
+    global journal_writer
+    with journal_writer_lock:
+        if journal_writer is None:
+            journal_writer = JournalWriter()
+            atexit.register(journal_writer.flush) # Make sure nothing is lost when the program exits
+        return journal_writer
+
+class ChatJournal():
+
+    # Saves a chat history by appending one line per change, instead of rewriting the whole history every time a message is added.
+    # The backup file holds the full chat history, and is only rewritten when the journal is compacted:
+    #   {"generation": 3, "messages": [...]}   (older backups are just the JSON list of messages, which still loads as generation 0)
+    # The journal file sits next to it ("backup_history_X.txt.journal") and holds one JSON record per line:
+    #   {"op": "append", "message": {...}, "generation": 3}   a message was added to the end of the history
+    #   {"op": "pop", "index": 1, "generation": 3}            a message was removed from the history
+    # To restore, load the backup file and then replay the journal on top of it.
+    # Every compaction starts a new generation. The journal is only deleted after the new backup file is in place, so if we crash inbetween,
+    # the old journal is still there, but its records are from an older generation than the backup, so they're skipped instead of being added twice.
+
+    def __init__(self, backup_file, compact_every=500):
+        self.backup_file = backup_file
+        self.journal_file = f"{backup_file}.journal"
+        # After this many journal records, rewrite the backup file and empty the journal
+        self.compact_every = compact_every
+        self.records_since_compaction = 0
+        self.generation = 0 # The generation of the latest backup file, which the new records are written on top of
+        self.writer = get_journal_writer()
+
+    # Returns the saved chat history, or None if nothing has been saved yet
+    def load(self):
+        chat_history = None
+        if os.path.exists(self.backup_file):
+            with open(self.backup_file, 'r') as file:
+                backup = json.load(file)
+            if isinstance(backup, dict):
+                chat_history = backup["messages"]
+                self.generation = backup.get("generation", 0)
+            else:
+                chat_history = backup
+        snapshot_generation = self.generation
+        if os.path.exists(self.journal_file):
+            if chat_history is None:
+                chat_history = []
+            with open(self.journal_file, 'r') as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line can be cut off if the program was killed mid-write, so just skip it
+                        print(f"[red]Skipping a broken line in {self.journal_file}")
+                        continue
+                    record_generation = record.get("generation", 0)
+                    if record_generation < snapshot_generation:
+                        # Already part of the backup file, we crashed before this journal could be deleted
+                        continue
+                    self.generation = max(self.generation, record_generation)
+                    if record["op"] == "append":
+                        chat_history.append(record["message"])
+                    elif record["op"] == "pop":
+                        chat_history.pop(record["index"])
+                    self.records_since_compaction += 1
+        return chat_history
+
+    def record_append(self, message, chat_history):
+        self.add_record({"op": "append", "message": message}, chat_history)
+
+    def record_pop(self, index, chat_history):
+        self.add_record({"op": "pop", "index": index}, chat_history)
+
+    def add_record(self, record, chat_history):
+        record["generation"] = self.generation
+        self.records_since_compaction += 1
+        if self.records_since_compaction >= self.compact_every:
+            self.compact(chat_history)
+        else:
+            self.writer.submit(self.write_record, record)
+
+    # Rewrite the backup file with the full chat history and start a fresh journal.
+    # We only copy the list here, the slow JSON encoding happens on the writer thread.
+    def compact(self, chat_history):
+        self.records_since_compaction = 0
+        self.generation += 1
+        self.writer.submit(self.write_snapshot, list(chat_history), self.generation)
+
+    def write_record(self, record):
+        with open(self.journal_file, 'a') as file:
+            file.write(json.dumps(record) + "\n")
+
+    def write_snapshot(self, chat_history, generation):
+        # Write to a temp file first, so a crash mid-write can never leave us with half a backup file
+        temp_file = f"{self.backup_file}.tmp"
+        with open(temp_file, 'w') as file:
+            json.dump({"generation": generation, "messages": chat_history}, file)
+        os.replace(temp_file, self.backup_file)
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    # Blocks until every change so far has been written to disk
+    def flush(self):
+        self.writer.flush()
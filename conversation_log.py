@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import threading
+import tiktoken
+from rich import print
+from chat_journal import ChatJournal
+
+# Matches the "[NAME] " that starts every message from another speaker
+SPEAKER_PREFIX_REGEX = re.compile(r'^\[(.+?)\] ')
+
+class ConversationLog():
+
+    # A single, append-only record of everything that has been said in a conversation, shared by every agent.
+    # Each agent's OpenAiManager builds its own view of this log: its own system prompt, its own lines as "assistant" messages, and everyone else's lines as "user" messages.
+    # This way every line is stored once and counted with tiktoken once, instead of being copied into every agent's chat history.
+    #
+    # On disk, the log uses the same format as the old chat history backups: a JSON list of messages, journaled with ChatJournal.
+    # Every line is saved the way a listener sees it: {"role": "user", "content": "[VICTORIA] I love Mario Kart"}
+    #
+    # Lines that every agent's view has already trimmed out of its chat history are dropped from the log too (and from the backup file at the next compaction),
+    # so a long stream doesn't keep the whole conversation in memory and on disk. Indexes into the log (len(), get_entries(), add_message()) keep counting from the
+    # first line ever added, so they don't shift when old lines are dropped.
+    #
+    # Each entry in self.entries looks like:
+    # {'speaker': 'VICTORIA', 'text': 'I love Mario Kart', 'message': {...}, 'speaker_tokens': 12, 'listener_tokens': 17}
+    # speaker_tokens is the token length of the line as the speaker's own "assistant" message, listener_tokens is the length of 'message'
+
+    def __init__(self, backup_file=None, legacy_backups=None, model='gpt-4o'):
+        """
+        backup_file: the txt file the log is saved to
+        legacy_backups: optional list of (agent_name, backup_file) from before the log existed.
+            If backup_file doesn't exist yet, we rebuild the conversation from the first of these that does.
+        """
+        self.entries = []
+        self.messages = [] # The messages in their on-disk format, used when the journal compacts
+        self.first_index = 0 # The index of entries[0], i.e. how many lines have been dropped from the start of the log
+        self.views = [] # The OpenAiManagers that read from this log, see add_view()
+        self.lock = threading.Lock()
+        self.model = model
+        self.tiktoken_encoder = None
+        self.journal = ChatJournal(backup_file) if backup_file else None
+
+        saved_messages = self.journal.load() if self.journal else None
+        if saved_messages is not None:
+            for message in saved_messages:
+                self.add_saved_message(message)
+        elif legacy_backups:
+            self.load_legacy_backups(legacy_backups)
+
+    def count_tokens(self, text):
+        if self.tiktoken_encoder is None:
+            self.tiktoken_encoder = tiktoken.encoding_for_model(self.model)
+        return len(self.tiktoken_encoder.encode(text))
+
+    # Adds a new line to the conversation, and returns its index in the log
+    def add_message(self, speaker, text):
+        entry = self.create_entry(speaker, text)
+        with self.lock:
+            self.entries.append(entry)
+            self.messages.append(entry['message'])
+            if self.journal:
+                self.journal.record_append(entry['message'], self.messages)
+            self.drop_unused_entries()
+            return self.first_index + len(self.entries) - 1
+
+    # Returns every entry from start_index onwards (that hasn't been dropped)
+    def get_entries(self, start_index=0):
+        with self.lock:
+            return self.entries[max(0, start_index - self.first_index):]
+
+    # The number of lines ever added, including the ones that have been dropped
+    def __len__(self):
+        with self.lock:
+            return self.first_index + len(self.entries)
+
+    # Registers something that reads from this log. It needs a get_conversation_log_start() that returns the index of the oldest line it still uses.
+    # Once there are views, lines that none of them use anymore are dropped.
+    def add_view(self, view):
+        with self.lock:
+            self.views.append(view)
+
+    # Forgets the lines that every view has trimmed, and rewrites the backup file without them.
+    # Views trim their history in big blocks, so this only happens once every few dozen turns.
+    def drop_unused_entries(self):
+        if not self.views:
+            return
+        oldest_used_index = min(view.get_conversation_log_start() for view in self.views)
+        drop_count = min(oldest_used_index - self.first_index, len(self.entries))
+        if drop_count <= 0:
+            return
+        del self.entries[:drop_count]
+        del self.messages[:drop_count]
+        self.first_index += drop_count
+        if self.journal:
+            self.journal.compact(self.messages)
+
+    # Blocks until every line so far has been written to disk
+    def flush(self):
+        if self.journal:
+            self.journal.flush()
+
+    def create_entry(self, speaker, text):
+        message = {"role": "user", "content": f"[{speaker}] {text}"}
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n, which is 4 tokens plus the role and content
+        return {
+            'speaker': speaker,
+            'text': text,
+            'message': message,
+            'speaker_tokens': 4 + self.count_tokens("assistant") + self.count_tokens(text),
+            'listener_tokens': 4 + self.count_tokens("user") + self.count_tokens(message['content']),
+        }
+
+    # Adds a message that was loaded from the backup file (so it's already saved)
+    def add_saved_message(self, message):
+        content = message.get('content')
+        if not isinstance(content, str):
+            return
+        match = SPEAKER_PREFIX_REGEX.match(content)
+        if match is None:
+            return
+        entry = self.create_entry(match.group(1), content[match.end():])
+        self.entries.append(entry)
+        self.messages.append(entry['message'])
+
+    # Rebuilds the conversation from one of the old per-agent backup files.
+    # Every agent's backup had the whole conversation in it: their own lines as "assistant" messages and everyone else's as "[NAME] ..." user messages.
+    # The system prompt and the "what is your response?" prompts aren't part of the conversation, so they're skipped.
+    def load_legacy_backups(self, legacy_backups):
+        for agent_name, legacy_file in legacy_backups:
+            if not os.path.exists(legacy_file):
+                continue
+            legacy_journal = ChatJournal(legacy_file)
+            legacy_history = legacy_journal.load() or []
+            for message in legacy_history:
+                content = message.get('content')
+                if message.get('role') == 'assistant' and isinstance(content, str):
+                    entry = self.create_entry(agent_name, content)
+                    self.entries.append(entry)
+                    self.messages.append(entry['message'])
+                elif message.get('role') == 'user':
+                    self.add_saved_message(message)
+            print(f"[green]Restored {len(self.entries)} messages from the old backup file {legacy_file}")
+            if self.journal:
+                self.journal.compact(self.messages)
+            return
@@ -1,34 +1,210 @@
-from elevenlabs.client import ElevenLabs
 from elevenlabs import play, stream, save, Voice, VoiceSettings
 import time
 import os
+import json
+import base64
+import threading
+from rich import print
+from tts_cache import TTSCache
+from audio_clip import AudioClip
+from api_clients import get_api_clients
 
 class ElevenLabsManager:
 
-    def __init__(self):
-        self.client = ElevenLabs(api_key=os.getenv('ELEVENLABS_API_KEY')) # Defaults to ELEVEN_API_KEY)
-        self.voices = self.client.voices.get_all().voices
-        # Create a map of Names->IDs, so that we can easily grab a voice's ID later on 
+    def __init__(self, use_tts_cache=True, voice_cache_file="voice_cache.json", voice_cache_max_age=24 * 60 * 60):
+        """
+        voice_cache_file: json file that the voice name->ID map and each voice's settings are saved to, so startup doesn't have to wait on ElevenLabs.
+            Set to None to always fetch them from ElevenLabs.
+        voice_cache_max_age: once the voice list is this many seconds old it's refreshed from ElevenLabs (in the background, we keep using the saved ones meanwhile).
+            This is checked every time a voice is looked up, so a long stream picks up changes too.
+        Nothing is fetched from ElevenLabs while creating this, so it never holds anyone up. Without saved voices, the list is fetched the first time a voice is needed.
+        """
+        # The pooled ElevenLabs client (see api_clients.py). Every request goes through self.api_clients.call() for the concurrency limit and retries.
+        self.api_clients = get_api_clients()
+        self.client = self.api_clients.elevenlabs
+        # Map of Names->IDs, so that we can easily grab a voice's ID later on 
         self.voice_to_id = {}
-        for voice in self.voices:
-           self.voice_to_id[voice.name] = voice.voice_id
         self.voice_to_settings = {}
+        self.voice_cache_file = voice_cache_file
+        self.voice_cache_max_age = voice_cache_max_age
+        self.voice_cache_lock = threading.Lock()
+        # Held while fetching the voice list, so several threads that need it at once only fetch it once
+        self.fetch_voices_lock = threading.Lock()
+        # Held while a background refresh is running, so there's only ever one
+        self.refresh_lock = threading.Lock()
+        self.voices_fetched_at = None # When voice_to_id was last fetched from ElevenLabs
+        self.refresh_attempted_at = 0
+        self.load_voice_cache()
 
-    # Convert text to speech, then save it to file. Returns the file path.
+        # Every line we generate is saved in the tts_cache folder, so saying the same line again with the same voice doesn't call ElevenLabs again
+        self.tts_cache = TTSCache() if use_tts_cache else None
+
+    def get_voice_settings(self, voice):
+        # Currently seems to be a problem with the API where it uses default voice settings, rather than pulling the proper settings from the website
+        # Workaround is to get the voice settings for each voice the first time it's used, then pass those settings in manually
+        # These are saved in the voice cache, and preload_voices() can fetch them at startup so the first line of each character doesn't wait for them
+        if self.voices_fetched_at is not None and time.time() - self.voices_fetched_at > self.voice_cache_max_age:
+            self.refresh_voices_in_background()
+        if voice not in self.voice_to_settings:
+            with self.fetch_voices_lock:
+                if voice not in self.voice_to_id:
+                    # Either nothing was saved yet, or the voice was added after the voice list was saved
+                    self.fetch_voices()
+            self.voice_to_settings[voice] = self.fetch_voice_settings(voice)
+            self.save_voice_cache()
+        return self.voice_to_settings[voice]
+
+    # Makes sure the settings for these voices are ready before anyone speaks. Runs in the background, so it doesn't slow down startup.
+    def preload_voices(self, voices):
+        missing_voices = [voice for voice in voices if voice not in self.voice_to_settings]
+        if not missing_voices:
+            return
+        def preload():
+            for voice in missing_voices:
+                try:
+                    self.get_voice_settings(voice)
+                except Exception as e:
+                    print(f"[red]Couldn't load the settings for voice {voice}: {e}")
+        threading.Thread(target=preload, daemon=True).start()
+
+    # Gets the full voice list from ElevenLabs
+    def fetch_voices(self):
+        voices = self.api_clients.call("elevenlabs", self.client.voices.get_all).voices
+        self.voice_to_id = {voice.name: voice.voice_id for voice in voices}
+        self.voices_fetched_at = time.time()
+
+    def fetch_voice_settings(self, voice):
+        return self.api_clients.call("elevenlabs", self.client.voices.get_settings, self.voice_to_id[voice])
+
+    # Gets the voice list and the settings of every voice we've used again, without making anyone wait on it.
+    # If it fails, we try again at most once a minute, instead of on every lookup.
+    def refresh_voices_in_background(self):
+        if time.time() - self.refresh_attempted_at < 60 or not self.refresh_lock.acquire(blocking=False):
+            return
+        self.refresh_attempted_at = time.time()
+        def refresh():
+            try:
+                with self.fetch_voices_lock:
+                    self.fetch_voices()
+                for voice in list(self.voice_to_settings):
+                    if voice in self.voice_to_id:
+                        self.voice_to_settings[voice] = self.fetch_voice_settings(voice)
+                self.save_voice_cache()
+                print("[green]Refreshed the saved ElevenLabs voices")
+            except Exception as e:
+                print(f"[red]Couldn't refresh the ElevenLabs voices, using the saved ones: {e}")
+            finally:
+                self.refresh_lock.release()
+        threading.Thread(target=refresh, daemon=True).start()
+
+    # Loads the saved voices. Returns when they were saved, or None if there's nothing (usable) saved.
+    # They're refreshed from ElevenLabs the first time they're used, if they're older than voice_cache_max_age.
+    def load_voice_cache(self):
+        if not self.voice_cache_file or not os.path.exists(self.voice_cache_file):
+            return None
+        try:
+            with open(self.voice_cache_file, "r") as f:
+                voice_cache = json.load(f)
+            self.voice_to_id = voice_cache["voice_to_id"]
+            self.voice_to_settings = {voice: VoiceSettings(**settings) for voice, settings in voice_cache["voice_settings"].items()}
+            self.voices_fetched_at = voice_cache["saved_at"]
+            return self.voices_fetched_at
+        except Exception as e:
+            print(f"[red]Couldn't load the saved voices from {self.voice_cache_file}, getting them from ElevenLabs instead: {e}")
+            self.voice_to_id = {}
+            self.voice_to_settings = {}
+            return None
+
+    def save_voice_cache(self):
+        if not self.voice_cache_file:
+            return
+        with self.voice_cache_lock:
+            voice_cache = {
+                "saved_at": self.voices_fetched_at,
+                "voice_to_id": dict(self.voice_to_id),
+                "voice_settings": {voice: settings.model_dump() if hasattr(settings, "model_dump") else settings.dict() for voice, settings in list(self.voice_to_settings.items())},
+            }
+            # Write to a temp file first, so a crash mid-write can never leave us with half a cache file
+            temp_file = f"{self.voice_cache_file}.tmp"
+            with open(temp_file, "w") as f:
+                json.dump(voice_cache, f)
+            os.replace(temp_file, self.voice_cache_file)
+
+    # Convert text to speech, and return it as an in-memory AudioClip (nothing is written to disk, apart from the TTS cache).
     # Current model options (that I would use) are eleven_monolingual_v1 or eleven_turbo_v2
     # eleven_turbo_v2 takes about 60% of the time that eleven_monolingual_v1 takes
     # However eleven_monolingual_v1 seems to produce more variety and emphasis, whereas turbo feels more monotone. Turbo still sounds good, just a little less interesting
+    # Note that ElevenLabs always sends mp3 audio, so the clip is an mp3. file_extension only changes the file name in the cache.
+    def text_to_audio_clip(self, input_text, voice="Doug VO Only", model_id="eleven_monolingual_v1", file_extension=".mp3"):
+        voice_settings = self.get_voice_settings(voice)
+        if self.tts_cache:
+            cache_key = self.tts_cache.make_key("audio", input_text, self.voice_to_id[voice], voice_settings, model_id, file_extension)
+            cached_file = self.tts_cache.get(cache_key, file_extension)
+            if cached_file:
+                try:
+                    return AudioClip.from_file(cached_file)
+                except OSError as e:
+                    # It was deleted right after we looked it up
+                    print(f"[red]Couldn't read cached TTS audio, generating it again: {e}")
+        audio_bytes = self.api_clients.call("elevenlabs", self.generate_audio_bytes, input_text, voice, voice_settings, model_id)
+        audio_clip = AudioClip(audio_bytes, "mp3")
+        if self.tts_cache:
+            audio_clip.file_path = self.tts_cache.add_bytes(cache_key, file_extension, audio_bytes)
+        return audio_clip
+
+    # generate() streams the audio back, so read all of it here. That way a dropped connection mid-download is retried as well.
+    # request_options holds the timeout from api_clients.call()
+    def generate_audio_bytes(self, input_text, voice, voice_settings, model_id, request_options=None):
+        audio_saved = self.client.generate(text=input_text, voice=Voice(voice_id=self.voice_to_id[voice], settings=voice_settings), model=model_id, request_options=request_options)
+        return audio_saved if isinstance(audio_saved, bytes) else b"".join(audio_saved)
+
+    # Same as text_to_audio_clip, but also returns the character timestamps from ElevenLabs, so we can make subtitles without running Whisper.
+    # Returns (audio_clip, alignment), where alignment looks like:
+    # {'characters': ['H', 'i', '.'], 'character_start_times_seconds': [0.0, 0.1, 0.2], 'character_end_times_seconds': [0.1, 0.2, 0.3]}
+    # If the timestamps request fails, this falls back to text_to_audio_clip and returns None as the alignment.
+    def text_to_audio_clip_with_timestamps(self, input_text, voice="Doug VO Only", model_id="eleven_monolingual_v1"):
+        voice_settings = self.get_voice_settings(voice)
+        if self.tts_cache:
+            # The alignment is cached in a json file next to the mp3. We need both, otherwise it's a miss.
+            cache_key = self.tts_cache.make_key("timestamps", input_text, self.voice_to_id[voice], voice_settings, model_id, ".mp3")
+            cached_files = self.tts_cache.get_all(cache_key, [".mp3", ".json"])
+            if cached_files:
+                cached_file, cached_alignment = cached_files
+                try:
+                    with open(cached_alignment, "r") as f:
+                        return AudioClip.from_file(cached_file), json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"[red]Couldn't read cached TTS timestamps, generating them again: {e}")
+        try:
+            response = self.api_clients.call("elevenlabs", self.client.text_to_speech.convert_with_timestamps, voice_id=self.voice_to_id[voice], text=input_text, model_id=model_id, voice_settings=voice_settings)
+            audio_bytes = base64.b64decode(response["audio_base64"])
+            alignment = response.get("alignment")
+        except Exception as e:
+            print(f"[red]Couldn't get TTS with timestamps, falling back to regular TTS: {e}")
+            return self.text_to_audio_clip(input_text, voice, model_id), None
+        audio_clip = AudioClip(audio_bytes, "mp3")
+        if self.tts_cache:
+            audio_clip.file_path = self.tts_cache.add_bytes(cache_key, ".mp3", audio_bytes)
+            if alignment:
+                self.tts_cache.add_bytes(cache_key, ".json", json.dumps(alignment).encode("utf-8"))
+        return audio_clip, alignment
+
+    # The functions below are the older file-based versions of the ones above. They return file paths instead of AudioClips.
+    # The file is always a new copy in the subdirectory, never the TTS cache's own file, so the caller can delete it and the cache can't evict it from under them.
+
+    # Convert text to speech, then save it to file. Returns the file path.
     def text_to_audio(self, input_text, voice="Doug VO Only", save_as_wave=True, subdirectory="", model_id="eleven_monolingual_v1"):
-        # Currently seems to be a problem with the API where it uses default voice settings, rather than pulling the proper settings from the website
-        # Workaround is to get the voice settings for each voice the first time it's used, then pass those settings in manually
-        if voice not in self.voice_to_settings:
-            self.voice_to_settings[voice] = self.client.voices.get_settings(self.voice_to_id[voice])
-        voice_settings = self.voice_to_settings[voice]
-        audio_saved = self.client.generate(text=input_text, voice=Voice(voice_id=self.voice_to_id[voice], settings=voice_settings), model=model_id,)
-        if save_as_wave:
-            file_name = f"___Msg{str(hash(input_text))}{time.time()}_{model_id}.wav"
-        else:
-            file_name = f"___Msg{str(hash(input_text))}{time.time()}_{model_id}.mp3"
-        tts_file = os.path.join(os.path.abspath(os.curdir), subdirectory, file_name)
-        save(audio_saved,tts_file)
-        return tts_file
\ No newline at end of file
+        extension = ".wav" if save_as_wave else ".mp3"
+        audio_clip = self.text_to_audio_clip(input_text, voice, model_id, extension)
+        return self.save_audio_clip(audio_clip, input_text, subdirectory, model_id, extension)
+
+    # Same as text_to_audio, but also returns the character timestamps. Returns (file_path, alignment).
+    # The timestamps endpoint returns mp3 audio, so the file is always saved as an mp3.
+    def text_to_audio_with_timestamps(self, input_text, voice="Doug VO Only", subdirectory="", model_id="eleven_monolingual_v1"):
+        audio_clip, alignment = self.text_to_audio_clip_with_timestamps(input_text, voice, model_id)
+        return self.save_audio_clip(audio_clip, input_text, subdirectory, model_id, ".mp3"), alignment
+
+    # Saves the clip into the working directory (or the subdirectory of it)
+    def save_audio_clip(self, audio_clip, input_text, subdirectory, model_id, extension):
+        file_name = f"___Msg{str(hash(input_text))}{time.time()}_{model_id}{extension}"
+        return audio_clip.save(os.path.join(os.path.abspath(os.curdir), subdirectory, file_name))
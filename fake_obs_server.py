@@ -0,0 +1,127 @@
+import json
+import time
+import socket
+import asyncio
+import threading
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+class FakeOBSServer():
+
+    # A tiny stand-in for OBS's websocket server (obs-websocket 5.x), so obs_websockets.py can be tested (and benchmarked) without OBS running.
+    # Every request succeeds. Scene item IDs are made up (but stay the same for the same source), and text sources remember the text they were given.
+    # It runs its own event loop on a background thread. Call stop() and start() again to make it look like OBS was closed and reopened mid-show.
+    # Authentication isn't supported, so any password works.
+
+    def __init__(self, host="127.0.0.1", port=None, response_delay=0):
+        """
+        port: None picks a free one, which stays the same when the server is restarted
+        response_delay: seconds to wait before answering each request (or batch), to act like a busy OBS. Can also be a function that returns the delay.
+        """
+        self.host = host
+        self.port = port or get_free_port(host)
+        self.response_delay = response_delay
+        # The requestType of every request OBS would have run, in the order it got them. Requests in a RequestBatch are listed one by one.
+        self.received_requests = []
+        self.batch_sizes = []
+        self.connections = 0
+        self.scene_item_ids = {}
+        self.input_settings = {}
+        self.websockets = set() # The connections that are open right now
+        self.lock = threading.Lock()
+        self.event_loop = None
+        self.thread = None
+        self.stop_future = None
+
+    # Starts listening, and returns once connections are accepted
+    def start(self):
+        started = threading.Event()
+        self.event_loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.event_loop.run_until_complete, args=(self.serve(started),), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    # Closes every connection and stops listening, like OBS shutting down
+    def stop(self):
+        if self.thread is None:
+            return
+        self.event_loop.call_soon_threadsafe(self.stop_future.set_result, None)
+        self.thread.join()
+        self.event_loop.close()
+        self.thread = None
+
+    # Blocks until at least count requests have come in. Returns False if that didn't happen within timeout seconds.
+    def wait_for_requests(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.received_requests) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    # Sends an event (op 5) to everyone that's connected, like OBS does when something changes, e.g. send_event("SceneNameChanged", {"oldSceneName": "A", "sceneName": "B"})
+    def send_event(self, event_type, event_data=None):
+        message = json.dumps({"op": 5, "d": {"eventType": event_type, "eventIntent": 1, "eventData": event_data or {}}})
+        async def broadcast():
+            for websocket in list(self.websockets):
+                await websocket.send(message)
+        asyncio.run_coroutine_threadsafe(broadcast(), self.event_loop).result()
+
+    async def serve(self, started):
+        self.stop_future = self.event_loop.create_future()
+        async with serve(self.handle_connection, self.host, self.port):
+            started.set()
+            await self.stop_future
+
+    async def handle_connection(self, websocket):
+        with self.lock:
+            self.connections += 1
+        try:
+            # Hello -> Identify -> Identified, without authentication
+            await websocket.send(json.dumps({"op": 0, "d": {"obsWebSocketVersion": "5.0.0", "rpcVersion": 1}}))
+            await websocket.recv()
+            await websocket.send(json.dumps({"op": 2, "d": {"negotiatedRpcVersion": 1}}))
+            self.websockets.add(websocket)
+            async for message in websocket:
+                message = json.loads(message)
+                data = message.get("d", {})
+                if message.get("op") == 6: # Request
+                    await self.wait_response_delay()
+                    result = self.run_request(data["requestType"], data.get("requestData") or {})
+                    await websocket.send(json.dumps({"op": 7, "d": dict(result, requestId=data["requestId"])}))
+                elif message.get("op") == 8: # RequestBatch
+                    await self.wait_response_delay()
+                    with self.lock:
+                        self.batch_sizes.append(len(data["requests"]))
+                    results = [self.run_request(request["requestType"], request.get("requestData") or {}) for request in data["requests"]]
+                    await websocket.send(json.dumps({"op": 9, "d": {"requestId": data["requestId"], "results": results}}))
+        except ConnectionClosed:
+            pass
+        finally:
+            self.websockets.discard(websocket)
+
+    async def wait_response_delay(self):
+        delay = self.response_delay() if callable(self.response_delay) else self.response_delay
+        if delay:
+            await asyncio.sleep(delay)
+
+    # Returns the answer to one request, as it appears in a RequestResponse (or in a RequestBatchResponse's results)
+    def run_request(self, request_type, request_data):
+        response_data = {}
+        with self.lock:
+            self.received_requests.append(request_type)
+            if request_type == "GetSceneItemId":
+                key = (request_data.get("sceneName"), request_data.get("sourceName"))
+                response_data = {"sceneItemId": self.scene_item_ids.setdefault(key, len(self.scene_item_ids) + 1)}
+            elif request_type == "SetInputSettings":
+                self.input_settings.setdefault(request_data.get("inputName"), {}).update(request_data.get("inputSettings", {}))
+            elif request_type == "GetInputSettings":
+                response_data = {"inputSettings": dict(self.input_settings.get(request_data.get("inputName"), {}))}
+        return {"requestType": request_type, "requestStatus": {"result": True, "code": 100}, "responseData": response_data}
+
+# Returns a port that nothing is listening on right now
+def get_free_port(host="127.0.0.1"):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import contextlib
+from collections import deque
+from rich import print
+from chat_journal import get_journal_writer
+
+class LatencyTracer():
+
+    # Times each stage of a turn (OpenAi, TTS, Whisper, OBS, playback, and waiting on locks), so we can see where the dead air comes from.
+    # Every span is appended to a JSON lines file, one span per line:
+    #   {"trace_id": "VICTORIA-12", "name": "llm_first_sentence", "start": 1718035200.52, "duration_ms": 812.4, "room": "main"}
+    # All spans from one turn share a trace_id. get_summary() gives the p50/p95 of every stage, from the most recent spans in memory.
+    # The file is written on the same background thread as the chat journals, so tracing never waits on the disk.
+    # Once the file gets to max_file_bytes it's renamed to "latency_trace.jsonl.1" (replacing the last one) and a new file is started,
+    # so a stream that runs for days only ever keeps the last two files' worth of spans on disk.
+
+    def __init__(self, output_file="latency_trace.jsonl", enabled=True, max_recent_spans=10000, max_file_bytes=20_000_000):
+        self.output_file = output_file
+        self.enabled = enabled
+        self.max_file_bytes = max_file_bytes
+        # Size of the output file, only used on the writer thread. Checked on disk the first time we write.
+        self.file_bytes = None
+        self.recent_spans = deque(maxlen=max_recent_spans)
+        self.spans_lock = threading.Lock()
+        self.trace_counter = itertools.count(1)
+        self.writer = get_journal_writer() if output_file else None
+
+    # Returns a new id to group the spans of one turn together
+    def new_trace_id(self, prefix="turn"):
+        return f"{prefix}-{next(self.trace_counter)}"
+
+    # Times everything inside the with block
+    @contextlib.contextmanager
+    def span(self, name, trace_id=None, **attributes):
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start_time, (time.perf_counter() - start) * 1000, trace_id, **attributes)
+
+    # Times how long it takes to get the lock (as "wait_<name>"), then holds the lock for the rest of the with block
+    @contextlib.contextmanager
+    def lock(self, lock, name, trace_id=None, **attributes):
+        start_time = time.time()
+        start = time.perf_counter()
+        with lock:
+            self.record(f"wait_{name}", start_time, (time.perf_counter() - start) * 1000, trace_id, **attributes)
+            yield
+
+    # Async version of lock(), for asyncio.Lock
+    @contextlib.asynccontextmanager
+    async def lock_async(self, lock, name, trace_id=None, **attributes):
+        start_time = time.time()
+        start = time.perf_counter()
+        async with lock:
+            self.record(f"wait_{name}", start_time, (time.perf_counter() - start) * 1000, trace_id, **attributes)
+            yield
+
+    # Passes through everything from a generator, and records how long it took to get the first item (e.g. OpenAi's first sentence).
+    # Returns whatever the generator returns, so it works with "yield from".
+    def time_first_item(self, generator, name, trace_id=None, **attributes):
+        start_time = time.time()
+        start = time.perf_counter()
+        first_item = True
+        iterator = iter(generator)
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration as stop:
+                return stop.value
+            if first_item:
+                self.record(name, start_time, (time.perf_counter() - start) * 1000, trace_id, **attributes)
+                first_item = False
+            yield item
+
+    # Records a span that was timed some other way (e.g. from one thread starting something to another thread seeing it finish)
+    def record(self, name, start_time, duration_ms, trace_id=None, **attributes):
+        if not self.enabled:
+            return
+        span = {"trace_id": trace_id, "name": name, "start": round(start_time, 3), "duration_ms": round(duration_ms, 1)}
+        span.update(attributes)
+        with self.spans_lock:
+            self.recent_spans.append(span)
+        if self.writer:
+            self.writer.submit(self.write_span, span)
+
+    def write_span(self, span):
+        if self.file_bytes is None:
+            self.file_bytes = os.path.getsize(self.output_file) if os.path.exists(self.output_file) else 0
+        if self.max_file_bytes and self.file_bytes >= self.max_file_bytes:
+            # Reset first, so if someone deleted the file we just start a new one instead of failing on every span
+            self.file_bytes = 0
+            if os.path.exists(self.output_file):
+                os.replace(self.output_file, get_rotated_file(self.output_file))
+        line = json.dumps(span) + "\n"
+        with open(self.output_file, 'a') as file:
+            file.write(line)
+        self.file_bytes += len(line.encode("utf-8"))
+
+    # Returns {stage name: {"count": 40, "p50_ms": 812.4, "p95_ms": 1460.2, "max_ms": 2011.0}} for the most recent spans
+    def get_summary(self):
+        with self.spans_lock:
+            spans = list(self.recent_spans)
+        return summarize_spans(spans)
+
+    def print_summary(self):
+        print_summary(self.get_summary())
+
+# Works out the percentiles of every stage in a list of spans
+def summarize_spans(spans):
+    durations = {}
+    for span in spans:
+        durations.setdefault(span["name"], []).append(span["duration_ms"])
+    summary = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "p50_ms": round(get_percentile(values, 50), 1),
+            "p95_ms": round(get_percentile(values, 95), 1),
+            "max_ms": round(values[-1], 1),
+        }
+    return summary
+
+# Percentile of an already sorted list, interpolating between the two closest values
+def get_percentile(sorted_values, percentile):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    position = (len(sorted_values) - 1) * percentile / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+# Where the older spans go once the trace file is full
+def get_rotated_file(output_file):
+    return f"{output_file}.1"
+
+def print_summary(summary):
+    print(f"[bold]{'stage':<28}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+    for name, stats in summary.items():
+        print(f"{name:<28}{stats['count']:>8}{stats['p50_ms']:>12}{stats['p95_ms']:>12}{stats['max_ms']:>12}")
+
+latency_tracer = None
+latency_tracer_lock = threading.Lock()
+
+# Everyone records into the same tracer, which is created the first time it's needed
+def get_latency_tracer():
+    global latency_tracer
+    with latency_tracer_lock:
+        if latency_tracer is None:
+            latency_tracer = LatencyTracer()
+        return latency_tracer
+
+# Summarize a trace file (plus its rotated older file, if there is one) from the command line: python latency_trace.py latency_trace.jsonl
+if __name__ == '__main__':
+    trace_file = sys.argv[1] if len(sys.argv) > 1 else "latency_trace.jsonl"
+    spans = []
+    for file_name in (get_rotated_file(trace_file), trace_file):
+        if not os.path.exists(file_name):
+            continue
+        with open(file_name, 'r') as file:
+            for line in file:
+                if line.strip():
+                    spans.append(json.loads(line))
+    print_summary(summarize_spans(spans))
@@ -1,5 +1,7 @@
 # This code runs a thread that manages the frontend code, a thread that listens for keyboard presses from the human, and then threads for the 3 agents
 # Once running, the human can activate a single agent and then let the agents continue an ongoing conversation.
+# Each set of agents lives in a ConversationRoom, which owns its own locks and pause state, so one process can run many shows at once.
+# The main room is created at startup and controlled with the keyboard. More rooms can be created with POST /rooms/<name> and removed with DELETE /rooms/<name>.
 # Each thread has the following core logic:
 
 # Main Thread
@@ -8,17 +10,20 @@
 # Agent X
     # Waits to be activated
     # Once it is activated (by Doug or by another agent):
-        # Acquire conversation lock
-            # Get response from OpenAI
-            # Add this new response to all other agents' chat histories
-        # Creates TTS with ElevenLabs
+        # Use the line it prepared ahead of time (see "Preparing a line" below), or start preparing one now
         # Acquire speaking lock (so only 1 speaks at a time)
-            # Pick another thread randomly, activate them
-                # Because this happens within the speaking lock, we are guaranteed that the other agents are inactive when this called.
-                # But, we start this now so that the next speaker can have their answer and audio ready to go the instant this agent is done talking.
+            # If someone else added to the conversation since the line was prepared, throw it away and prepare a new one
+            # Add this line to the shared conversation log
+                # As soon as it's added, pick another agent randomly and have them start preparing their line,
+                # so that the next speaker has their answer and audio ready to go the instant this agent is done talking.
             # Update client and OBS to display stuff
-            # Play the TTS audio
-            # Release speaking lock (Other threads can now talk)
+            # Queue the TTS clips in the room's playback queue (they play back-to-back with no gap) and wait for the last one to finish
+            # Release speaking lock, then activate the agent that was picked to talk next
+
+# Preparing a line (runs in the background)
+    # Acquire conversation lock just long enough to take a snapshot of the conversation
+    # Get response from OpenAI (streamed sentence by sentence)
+    # Creates TTS with ElevenLabs for each sentence
     
 # Human Input Thread
     # Listens for keypresses:
@@ -26,14 +31,11 @@
     # If F7 is pressed:
         # Toggles "pause" flag - stops other agents from activating additional agents
 
-        # Record mic audio (until you press F8)
+        # Record mic audio (until you press F8), and transcribe it with Whisper a window at a time while you're still talking (without holding any lock)
 
-        # Get convo lock (but not speaking lock)
-            # In theory, wait until everyone is done speaking, and because the agents are "paused" then no new ones will add to the convo
-            # But to be safe, grab the convo lock to ensure that all agents HAVE to wait until my response is added into the convo history
-        
-        # Transcribe mic audio into text with Whisper
-        # Add Doug's response into all agents' chat history
+        # Get convo lock (but not speaking lock), just long enough to add Doug's response into the shared conversation log
+            # Agents only hold the convo lock for quick snapshots and commits, never across an OpenAi call, so this doesn't have to wait on them
+            # Any agent line that was prepared before Doug's response is thrown away and regenerated
         
         # Release the convo lock
         # (then optionally press a key to trigger a specific bot)
@@ -54,19 +56,26 @@
         # Activates Agent 3
 
 from flask import Flask, render_template, session, request
+import flask_socketio
 from flask_socketio import SocketIO, emit
 import threading
+import asyncio
+import concurrent.futures
+import queue
 import time
 import keyboard
 import random
 import logging
 from rich import print
 
-from audio_player import AudioManager
+from audio_player import AudioManager, PlaybackItem
 from eleven_labs import ElevenLabsManager
 from openai_chat import OpenAiManager
-from whisper_openai import WhisperManager
+from whisper_openai import WhisperManager, IncrementalTranscriber
 from obs_websockets import OBSWebsocketsManager
+from subtitle_alignment import SubtitleAligner
+from conversation_log import ConversationLog
+from latency_trace import get_latency_tracer
 from ai_prompts import *
 
 socketio = SocketIO
@@ -78,28 +87,566 @@ log.setLevel(logging.ERROR)
 
 @app.route("/")
 def home():
-    return render_template('index.html')
+    return render_template('index.html', room_name=DEFAULT_ROOM_NAME)
+
+# Each room has its own page, e.g. 127.0.0.1:5151/room/my_show
+@app.route("/room/<room_name>")
+def room_page(room_name):
+    return render_template('index.html', room_name=room_name)
+
+# Create a new room at runtime with the default cast: POST 127.0.0.1:5151/rooms/my_show
+@app.route("/rooms/<room_name>", methods=["POST"])
+def create_room(room_name):
+    if room_manager.create_room(room_name, DEFAULT_AGENTS) is None:
+        return {"error": f"Room {room_name} already exists"}, 409
+    return {"room": room_name}, 201
+
+# Stop and remove a room at runtime: DELETE 127.0.0.1:5151/rooms/my_show
+@app.route("/rooms/<room_name>", methods=["DELETE"])
+def destroy_room(room_name):
+    if not room_manager.destroy_room(room_name):
+        return {"error": f"Room {room_name} doesn't exist"}, 404
+    return {"room": room_name}, 200
+
+# p50/p95 of every stage of a turn, from the most recent turns: GET 127.0.0.1:5151/latency
+# The full trace is in latency_trace.jsonl, run "python latency_trace.py" to summarize it
+@app.route("/latency")
+def latency_summary():
+    return get_latency_tracer().get_summary()
+
+# Whether we're connected to OBS, and how many OBS requests are waiting for it to come back: GET 127.0.0.1:5151/obs
+@app.route("/obs")
+def obs_health():
+    return shared_resources.obswebsockets_manager.get_health()
+
+# How often a line could be replayed from the TTS cache instead of calling ElevenLabs: GET 127.0.0.1:5151/tts_cache
+@app.route("/tts_cache")
+def tts_cache_stats():
+    tts_cache = shared_resources.elevenlabs_manager.tts_cache
+    return tts_cache.get_stats() if tts_cache else {}
 
 @socketio.event
 def connect():
     print("[green]The server connected to client!")
 
-obswebsockets_manager = OBSWebsocketsManager()
-whisper_manager = WhisperManager()
-elevenlabs_manager = ElevenLabsManager()
-audio_manager = AudioManager()
+# The browser sends this when it loads, so it only gets the messages for its own room
+@socketio.event
+def join_room(data):
+    room_name = data.get('room', DEFAULT_ROOM_NAME)
+    flask_socketio.join_room(room_name)
+    print(f"[green]Client joined room {room_name}")
+
+# The expensive things that every room shares: the Whisper model, the OpenAi/ElevenLabs/OBS clients, the voice map and the speakers.
+# Each manager is only created the first time a room actually needs it.
+class SharedResources():
+
+    def __init__(self, asr_settings=None):
+        # Passed to WhisperManager, see ASR_SETTINGS
+        self.asr_settings = asr_settings or {}
+        self.creation_lock = threading.Lock()
+        self._obswebsockets_manager = None
+        self._whisper_manager = None
+        self._elevenlabs_manager = None
+        self._audio_manager = None
+        self._subtitle_aligner = None
+
+    @property
+    def obswebsockets_manager(self):
+        with self.creation_lock:
+            if self._obswebsockets_manager is None:
+                # This returns straight away, and keeps (re)connecting to OBS in the background
+                self._obswebsockets_manager = OBSWebsocketsManager()
+            return self._obswebsockets_manager
+
+    @property
+    def whisper_manager(self):
+        with self.creation_lock:
+            if self._whisper_manager is None:
+                asr_settings = dict(self.asr_settings)
+                # "backend" can be swapped for any class with an audio_to_text(audio_file, timestamps=None) function
+                asr_backend = asr_settings.pop("backend", WhisperManager)
+                self._whisper_manager = asr_backend(**asr_settings)
+            return self._whisper_manager
+
+    @property
+    def elevenlabs_manager(self):
+        with self.creation_lock:
+            if self._elevenlabs_manager is None:
+                # This only reads the saved voices from disk, so nobody else waits long on creation_lock. The voice list is fetched from ElevenLabs when it's first needed.
+                self._elevenlabs_manager = ElevenLabsManager()
+            return self._elevenlabs_manager
+
+    @property
+    def audio_manager(self):
+        with self.creation_lock:
+            if self._audio_manager is None:
+                self._audio_manager = AudioManager()
+            return self._audio_manager
+
+    @property
+    def subtitle_aligner(self):
+        audio_manager = self.audio_manager
+        with self.creation_lock:
+            if self._subtitle_aligner is None:
+                # Whisper is only used if we can't get the timing any other way, so we hand it over lazily
+                self._subtitle_aligner = SubtitleAligner(audio_manager, LazyWhisper(self))
+            return self._subtitle_aligner
+
+# Stand-in for the WhisperManager that only loads the model if someone actually calls it
+class LazyWhisper():
+
+    def __init__(self, resources):
+        self.resources = resources
+
+    def audio_to_text(self, audio_file, timestamps=None):
+        return self.resources.whisper_manager.audio_to_text(audio_file, timestamps)
+
+    def submit(self, audio_file, timestamps=None):
+        return self.resources.whisper_manager.submit(audio_file, timestamps)
+
+# A single show: a cast of agents (plus optionally the human on the keyboard), with its own locks, pause state and Socket.IO room.
+# Many rooms can run in the same process, and they all share the same SharedResources.
+class ConversationRoom():
+
+    def __init__(self, room_name, resources, agent_configs, human_name=None, engine_mode="threading"):
+        self.name = room_name
+        self.resources = resources
+        self.engine_mode = engine_mode
+        self.stopped = False
+        # Makes sure nothing is added to the playback queue after stop() has removed it
+        self.playback_lock = threading.Lock()
+
+        self.speaking_lock = threading.Lock()
+        self.conversation_lock = threading.Lock()
+        # The asyncio engine's version of speaking_lock. It's created in run_async(), on the event loop that uses it.
+        self.async_speaking_lock = None
+        # When True, agents finish their current line but don't activate anyone else
+        self.agents_paused = False
+        # When the last agent's audio finished playing, used to measure the dead air between speakers (see latency_trace.py)
+        self.last_speaker_finished_at = None
+
+        # Everything that's said in this room goes into one shared log, and each agent's chat history is a view of it.
+        # If the room doesn't have a log file yet, we rebuild it from the old per-agent backup files.
+        legacy_backups = [(config["name"], self.get_backup_file_name(config["name"])) for config in agent_configs]
+        self.conversation_log = ConversationLog(self.get_log_file_name(), legacy_backups)
+
+        # agent_configs is a list of dictionaries, see DEFAULT_AGENTS
+        self.agents = []
+        for agent_id, config in enumerate(agent_configs, start=1):
+            self.agents.append(Agent(self, config["name"], agent_id, config["filter_name"], config["system_prompt"], config["voice"]))
+
+        # Only one room should listen to the keyboard, so the human is optional
+        self.human = Human(self, human_name) if human_name else None
+
+        self.threads = []
+        self.async_future = None
+
+    # The txt file the room's shared conversation log is saved to
+    def get_log_file_name(self):
+        if self.name == DEFAULT_ROOM_NAME:
+            return "backup_history.txt"
+        return f"backup_history_{self.name}.txt"
+
+    # The per-agent backup files from before the shared log existed. The default room uses the original names, so old conversations still load.
+    def get_backup_file_name(self, agent_name):
+        if self.name == DEFAULT_ROOM_NAME:
+            return f"backup_history_{agent_name}.txt"
+        return f"backup_history_{self.name}_{agent_name}.txt"
+
+    # Sends a message to the browsers that joined this room
+    def emit(self, event, data):
+        socketio.emit(event, data, to=self.name)
+
+    # Adds a clip to this room's playback queue, and returns its PlaybackItem. Clips play back-to-back in the order they're queued.
+    # Once the room has stopped the clip is skipped (it comes back already finished), so a stopped room never gets a new playback queue.
+    def queue_clip(self, audio_clip):
+        with self.playback_lock:
+            if self.stopped:
+                item = PlaybackItem(audio_clip)
+                item.mark_started()
+                item.mark_finished()
+                return item
+            return self.resources.audio_manager.queue_clip(audio_clip, self.name)
+
+    # Gets every agent's voice settings from ElevenLabs in the background, so the first line of each character doesn't have to wait for them
+    # Creating the ElevenLabsManager doesn't talk to ElevenLabs, and preload_voices() runs on its own thread, so this returns straight away.
+    def preload_voices(self):
+        self.resources.elevenlabs_manager.preload_voices([agent.voice for agent in self.agents])
+
+    # Starts the agents (and the human) on their own threads
+    def start(self):
+        bots = self.agents + ([self.human] if self.human else [])
+        self.threads = [threading.Thread(target=start_bot, args=(bot,), name=bot.name, daemon=True) for bot in bots]
+        for thread in self.threads:
+            thread.start()
+
+    # Runs the agents (and the human) on the current event loop, instead of one thread each
+    # Both engines share conversation_lock and PreparedTurn. Here everything that takes conversation_lock runs on the event loop and never awaits while holding it,
+    # so the lock is never contended and taking it can't block the loop.
+    async def run_async(self):
+        self.async_speaking_lock = asyncio.Lock()
+        # Point every agent's activate() at this event loop
+        for agent in self.agents:
+            agent.event_loop = asyncio.get_running_loop()
+            agent.async_activated = asyncio.Event()
+        bots = self.agents + ([self.human] if self.human else [])
+        await asyncio.gather(*[bot.run_async() for bot in bots])
+
+    # Throw away every line the agents were preparing ahead of time
+    def cancel_prepared_turns(self):
+        for agent in self.agents:
+            agent.cancel_prepared_turn()
 
-speaking_lock = threading.Lock()
-conversation_lock = threading.Lock()
+    # Stops the room. The audio is cut off, the room's playback queue and its channel are handed back, then every thread exits.
+    # Call wait_until_stopped() afterwards to make sure they're all gone.
+    def stop(self):
+        with self.playback_lock:
+            self.stopped = True
+        self.agents_paused = True
+        self.resources.audio_manager.remove_playback_queue(self.name)
+        self.cancel_prepared_turns()
+        # Wake up the idle agents so they notice the room has stopped
+        for agent in self.agents:
+            agent.activate()
 
-agents_paused = False
+    # Waits (up to timeout seconds in total) for the agents and the human to exit after stop(), then writes out whatever is left of the conversation log.
+    # In asyncio mode, anything still running after the timeout is cancelled.
+    def wait_until_stopped(self, timeout=30):
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                print(f"[red]{thread.name} in room {self.name} is still running after {timeout} seconds, leaving it behind")
+        if self.async_future is not None:
+            try:
+                self.async_future.result(max(0, deadline - time.time()))
+            except concurrent.futures.TimeoutError:
+                print(f"[red]Room {self.name} is still running after {timeout} seconds, cancelling it")
+                self.async_future.cancel()
+            except Exception as e:
+                print(f"[red]Room {self.name} stopped with an error: {e}")
+        self.conversation_log.flush()
+
+# Creates and destroys rooms at runtime.
+# In "asyncio" mode every room runs on a single shared event loop, instead of one thread per agent.
+class RoomManager():
+
+    def __init__(self, resources, engine_mode="threading"):
+        self.resources = resources
+        self.engine_mode = engine_mode
+        self.rooms = {}
+        # Names of the rooms that are being created or destroyed right now. Nobody else can use these names until that's done.
+        self.reserved_names = set()
+        self.rooms_lock = threading.Lock()
+        self.event_loop = None
+        self.event_loop_thread = None
+
+    def get_room(self, room_name):
+        with self.rooms_lock:
+            return self.rooms.get(room_name)
+
+    # Returns None if there's already a room with this name
+    def create_room(self, room_name, agent_configs, human_name=None):
+        # Take the name first, so two requests for the same room can't both open its log files
+        with self.rooms_lock:
+            if room_name in self.rooms or room_name in self.reserved_names:
+                return None
+            self.reserved_names.add(room_name)
+        try:
+            room = ConversationRoom(room_name, self.resources, agent_configs, human_name, self.engine_mode)
+            with self.rooms_lock:
+                self.rooms[room_name] = room
+        finally:
+            with self.rooms_lock:
+                self.reserved_names.discard(room_name)
+        room.preload_voices()
+        if self.engine_mode == "asyncio":
+            room.async_future = asyncio.run_coroutine_threadsafe(room.run_async(), self.get_event_loop())
+        else:
+            room.start()
+        print(f"[green]Created room {room_name}")
+        return room
+
+    # Stops the room and waits for it to finish before the name can be used again. Returns False if there was no room with this name.
+    def destroy_room(self, room_name):
+        with self.rooms_lock:
+            room = self.rooms.pop(room_name, None)
+            if room is None:
+                return False
+            # Keep the name taken until the room has stopped, so a new room with the same name can't write to the same log files meanwhile
+            self.reserved_names.add(room_name)
+        try:
+            room.stop()
+            room.wait_until_stopped()
+        finally:
+            with self.rooms_lock:
+                self.reserved_names.discard(room_name)
+        print(f"[red]Destroyed room {room_name}")
+        return True
+
+    # The event loop shared by every room in "asyncio" mode, running on its own thread
+    def get_event_loop(self):
+        with self.rooms_lock:
+            if self.event_loop is None:
+                self.event_loop = asyncio.new_event_loop()
+                self.event_loop_thread = threading.Thread(target=self.event_loop.run_forever, daemon=True)
+                self.event_loop_thread.start()
+            return self.event_loop
+
+# "threading" runs every agent (and the human) on its own thread.
+# "asyncio" runs all of them on a single event loop instead, see ConversationRoom.run_async()
+ENGINE_MODE = "threading"
+
+# The room that is shown at 127.0.0.1:5151 and controlled with the keyboard
+DEFAULT_ROOM_NAME = "main"
+
+# The cast of agents that every new room starts with
+DEFAULT_AGENTS = [
+    {"name": "OSWALD", "filter_name": "Audio Move - Wario Pepper", "system_prompt": VIDEOGAME_AGENT_1, "voice": "Dougsworth"},
+    {"name": "TONY KING OF NEW YORK", "filter_name": "Audio Move - Waluigi Pepper", "system_prompt": VIDEOGAME_AGENT_2, "voice": "Tony Emperor of New York"},
+    {"name": "VICTORIA", "filter_name": "Audio Move - Gamer Pepper", "system_prompt": VIDEOGAME_AGENT_3, "voice": "Victoria"},
+]
+
+# Which speech-to-text model to use. The model is only loaded the first time the human talks (or a subtitle needs Whisper as a fallback).
+# On a PC without an Nvidia GPU, use "base" or "tiny": the model then runs on the CPU with int8 weights, which is fast enough to use live.
+ASR_SETTINGS = {"backend": WhisperManager, "model_size": "large", "device": None, "quantize_on_cpu": True}
+
+shared_resources = SharedResources(ASR_SETTINGS)
+room_manager = RoomManager(shared_resources, ENGINE_MODE)
+
+# If True, agents stream their answer from OpenAi and start speaking as soon as the first sentence has audio,
+# instead of waiting for the full answer, the full TTS file and the subtitles.
+STREAMING_RESPONSES = True
+
+# If True, the human's mic audio is transcribed in chunks while they're still talking, so the transcript is ready almost as soon as they stop.
+# If False, the whole recording is saved to a wav file and transcribed afterwards.
+STREAMING_MIC = True
+
+# How many seconds longer than its audio an agent waits for their line to finish playing before moving on,
+# so a clip that never finishes can't hold the speaking lock (and stall the whole room) forever
+PLAYBACK_TIMEOUT_MARGIN = 10
+
+AGENT_PROMPT = "Okay what is your response? Try to be as chaotic and bizarre and adult-humor oriented as possible. Again, 3 sentences maximum."
+
+# Length of a clip in seconds, or 0 if its headers can't be read (playback will skip a clip like that anyway)
+def get_clip_duration(audio_clip):
+    try:
+        return audio_clip.duration
+    except Exception:
+        return 0
+
+# Runs a generator on a background thread and returns a new generator that yields its items.
+# This lets each stage of a generator pipeline (LLM -> TTS -> playback) work ahead of the next stage.
+# Any exception raised by the original generator is re-raised in the consumer.
+def background_generator(generator, max_items=0):
+    item_queue = queue.Queue(max_items)
+    finished = object()
+
+    def produce():
+        try:
+            for item in generator:
+                item_queue.put(item)
+        except Exception as e:
+            item_queue.put(e)
+        item_queue.put(finished)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = item_queue.get()
+        if item is finished:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# The next line for one agent, generated ahead of time (speculatively) while someone else is still talking.
+# The answer is only added to the conversation once its audio exists and the agent actually starts saying it.
+# If someone else added a line to the conversation in the meantime (e.g. the human interjected), it's thrown away and generated again.
+class PreparedTurn():
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.room = agent.room
+        # Each clip is (text, audio_clip, subtitles) and they're played in order. None means there are no more clips.
+        # With the asyncio engine the clips are made on the agent's event loop, so they go into an asyncio.Queue instead.
+        self.event_loop = agent.event_loop
+        self.clips = asyncio.Queue() if self.event_loop is not None else queue.Queue()
+        # How much of the conversation log this answer was based on. Set once snapshot_taken is set.
+        self.log_position = None
+        self.snapshot_taken = threading.Event()
+        self.cancelled = False
+        # The full answer, once OpenAi has finished writing it
+        self.openai_answer = None
+        # The answer is committed to the conversation once it's finished AND the agent has started saying it.
+        # Both of these are only changed while holding the room's conversation_lock.
+        self.speaking = False
+        self.committed = False
+        # Every stage of this turn is timed under one trace id (see latency_trace.py)
+        self.tracer = get_latency_tracer()
+        self.trace_id = self.tracer.new_trace_id(agent.name)
+        if self.event_loop is not None:
+            asyncio.run_coroutine_threadsafe(self.generate_async(), self.event_loop)
+        else:
+            threading.Thread(target=self.generate, daemon=True).start()
+
+    # Generates the answer, then the TTS audio and subtitles, and puts them into self.clips
+    def generate(self):
+        openai_manager = self.agent.openai_manager
+        resources = self.room.resources
+        tracer = self.tracer
+        trace = {"trace_id": self.trace_id, "room": self.room.name}
+        try:
+            # Take a snapshot of the conversation under the lock, then talk to OpenAi without holding it
+            with tracer.lock(self.room.conversation_lock, "conversation_lock", **trace):
+                messages = openai_manager.prepare_chat_history(AGENT_PROMPT)
+                self.log_position = openai_manager.conversation_log_position
+            self.snapshot_taken.set()
+
+            if STREAMING_RESPONSES:
+                # LLM sentences -> TTS clips, each stage running ahead of the next one
+                def generate_sentences():
+                    with tracer.span("llm", **trace):
+                        openai_answer = yield from tracer.time_first_item(openai_manager.stream_completion(messages), "llm_first_sentence", **trace)
+                    self.finish_answer(openai_answer)
+                sentence_stream = (sentence.replace("*", "") for sentence in background_generator(generate_sentences()))
+                for sentence in sentence_stream:
+                    if not sentence.strip():
+                        continue
+                    with tracer.span("tts", characters=len(sentence), **trace):
+                        audio_clip = resources.elevenlabs_manager.text_to_audio_clip(sentence, self.agent.voice)
+                    if self.cancelled:
+                        break
+                    # We already know each sentence's text, so the subtitle is just the sentence for the length of its clip
+                    subtitles = [{'text': sentence, 'start_time': 0, 'end_time': audio_clip.duration}]
+                    self.clips.put((sentence, audio_clip, subtitles))
+            else:
+                with tracer.span("llm", **trace):
+                    openai_answer = openai_manager.get_completion(messages)
+                self.finish_answer(openai_answer)
+                spoken_answer = openai_answer.replace("*", "")
+                print(f'[magenta]Got the following response:\n{spoken_answer}')
+                if not self.cancelled:
+                    # Create audio response, along with the timestamp of every character
+                    with tracer.span("tts", characters=len(spoken_answer), **trace):
+                        audio_clip, alignment = resources.elevenlabs_manager.text_to_audio_clip_with_timestamps(spoken_answer, self.agent.voice)
+                    # Get the subtitles from the text we already have, instead of transcribing our own audio with Whisper
+                    with tracer.span("subtitles", **trace):
+                        subtitles = resources.subtitle_aligner.get_subtitles(spoken_answer, audio_clip.file_path, alignment, audio_clip.duration)
+                    self.clips.put((spoken_answer, audio_clip, subtitles))
+        except Exception as e:
+            print(f"[magenta] Whoopsie! There was a problem while generating {self.agent.name}'s response: {e}")
+        self.snapshot_taken.set()
+        self.clips.put(None)
+
+    # Same as generate, but for the asyncio engine: OpenAi uses its async client, and ElevenLabs (which only has a blocking client) runs on the default thread pool
+    async def generate_async(self):
+        openai_manager = self.agent.openai_manager
+        resources = self.room.resources
+        tracer = self.tracer
+        trace = {"trace_id": self.trace_id, "room": self.room.name}
+        try:
+            # Everything in the room runs on this event loop, so nobody waits on this lock (see ConversationRoom.run_async)
+            with tracer.lock(self.room.conversation_lock, "conversation_lock", **trace):
+                messages = openai_manager.prepare_chat_history(AGENT_PROMPT)
+                self.log_position = openai_manager.conversation_log_position
+            self.snapshot_taken.set()
+
+            if STREAMING_RESPONSES:
+                def text_to_audio_clip(sentence):
+                    with tracer.span("tts", characters=len(sentence), **trace):
+                        return resources.elevenlabs_manager.text_to_audio_clip(sentence, self.agent.voice)
+
+                # Each sentence's TTS starts as soon as OpenAi finishes writing it, and the clips are handed over in order
+                tts_tasks = asyncio.Queue()
+                async def queue_clips():
+                    while True:
+                        tts_task = await tts_tasks.get()
+                        if tts_task is None:
+                            return
+                        sentence, audio_clip = await tts_task
+                        if self.cancelled:
+                            continue
+                        subtitles = [{'text': sentence, 'start_time': 0, 'end_time': audio_clip.duration}]
+                        await self.clips.put((sentence, audio_clip, subtitles))
+                clips_task = asyncio.ensure_future(queue_clips())
+
+                async def sentence_to_audio_clip(sentence):
+                    return sentence, await asyncio.to_thread(text_to_audio_clip, sentence)
+
+                answer_sentences = []
+                llm_start_time = time.time()
+                llm_start = time.perf_counter()
+                try:
+                    async for sentence in openai_manager.stream_completion_async(messages):
+                        if not answer_sentences:
+                            tracer.record("llm_first_sentence", llm_start_time, (time.perf_counter() - llm_start) * 1000, **trace)
+                        answer_sentences.append(sentence)
+                        sentence = sentence.replace("*", "")
+                        if sentence.strip() and not self.cancelled:
+                            await tts_tasks.put(asyncio.ensure_future(sentence_to_audio_clip(sentence)))
+                    tracer.record("llm", llm_start_time, (time.perf_counter() - llm_start) * 1000, **trace)
+                    self.finish_answer(" ".join(answer_sentences))
+                finally:
+                    await tts_tasks.put(None)
+                    await clips_task
+            else:
+                with tracer.span("llm", **trace):
+                    openai_answer = await openai_manager.get_completion_async(messages)
+                self.finish_answer(openai_answer)
+                spoken_answer = openai_answer.replace("*", "")
+                print(f'[magenta]Got the following response:\n{spoken_answer}')
+                if not self.cancelled:
+                    with tracer.span("tts", characters=len(spoken_answer), **trace):
+                        audio_clip, alignment = await asyncio.to_thread(resources.elevenlabs_manager.text_to_audio_clip_with_timestamps, spoken_answer, self.agent.voice)
+                    with tracer.span("subtitles", **trace):
+                        subtitles = await asyncio.to_thread(resources.subtitle_aligner.get_subtitles, spoken_answer, audio_clip.file_path, alignment, audio_clip.duration)
+                    await self.clips.put((spoken_answer, audio_clip, subtitles))
+        except Exception as e:
+            print(f"[magenta] Whoopsie! There was a problem while generating {self.agent.name}'s response: {e}")
+        self.snapshot_taken.set()
+        await self.clips.put(None)
+
+    def finish_answer(self, openai_answer):
+        with self.tracer.lock(self.room.conversation_lock, "conversation_lock", trace_id=self.trace_id, room=self.room.name):
+            self.openai_answer = openai_answer
+            committed = self.commit()
+        if committed:
+            self.agent.schedule_next_speaker()
+
+    # Called once the agent has the first audio of this line and is about to say it.
+    # The check and the commit happen in one go under the conversation lock, so nobody can add a line inbetween.
+    # Returns False if the conversation has changed since we generated it (unless ignore_changes), in which case it should be thrown away.
+    def start_speaking(self, ignore_changes=False):
+        self.snapshot_taken.wait()
+        with self.tracer.lock(self.room.conversation_lock, "conversation_lock", trace_id=self.trace_id, room=self.room.name):
+            if not ignore_changes and (self.log_position is None or len(self.room.conversation_log) != self.log_position):
+                return False
+            self.speaking = True
+            committed = self.commit()
+        if committed:
+            self.agent.schedule_next_speaker()
+        return True
+
+    # Adds the answer to the conversation, if it's finished AND the agent has started saying it. Must be called while holding the conversation lock.
+    # Returns True if it was added just now, in which case the agent picks (and starts preparing) the next speaker.
+    def commit(self):
+        if self.committed or self.cancelled or not self.speaking or self.openai_answer is None:
+            return False
+        self.committed = True
+        self.agent.openai_manager.record_answer(self.openai_answer)
+        return True
+
+    def cancel(self):
+        self.cancelled = True
 
 # Class that represents a single ChatGPT Agent and its information
 class Agent():
     
-    def __init__(self, agent_name, agent_id, filter_name, all_agents, system_prompt, elevenlabs_voice):
-        # Flag of whether this agent should begin speaking
-        self.activated = False 
+    def __init__(self, room, agent_name, agent_id, filter_name, system_prompt, elevenlabs_voice):
+        # The ConversationRoom this agent belongs to. It holds the other agents, the locks, and the shared managers.
+        self.room = room
+        # Set when this agent should begin speaking. The agent's thread sleeps on this event, so it uses no CPU while idle and wakes up the instant it's activated.
+        self.activated = threading.Event()
         # Used to identify each agent in the conversation history
         self.name = agent_name 
         # an int used to ID this agent to the frontend code
@@ -107,198 +654,396 @@ class Agent():
         # the name of the OBS filter to activate when this agent is speaking
         # You don't need to use OBS filters as part of this code, it's optional for adding extra visual flair
         self.filter_name = filter_name 
-        # A list of the other agents, so that you can pick one to randomly "activate" when you finish talking
-        self.all_agents = all_agents
         # The name of the Elevenlabs voice that you want this agent to speak with
         self.voice = elevenlabs_voice
-        # The name of the txt backup file where this agent's conversation history will be stored
-        backup_file_name = f"backup_history_{agent_name}.txt"
-        # Initialize the OpenAi manager with a system prompt and a file that you would like to save your conversation too
-        # If the backup file isn't empty, then it will restore that backed up conversation for this agent
-        self.openai_manager = OpenAiManager(system_prompt, backup_file_name) 
+        # Initialize the OpenAi manager with a system prompt and the room's shared conversation log
+        # This agent's chat history is its own view of the log: its lines are "assistant" messages and everyone else's are "user" messages
+        self.openai_manager = OpenAiManager(system_prompt, conversation_log=room.conversation_log, speaker_name=agent_name)
         # Optional - tells the OpenAi manager not to print as much
         self.openai_manager.logging = False
+        # Only used by the asyncio engine: the event loop this agent runs on, and its activation event
+        self.event_loop = None
+        self.async_activated = None
+        # Our next line, if it's being generated ahead of time (see PreparedTurn)
+        self.prepared_turn = None
+        self.prepared_turn_lock = threading.Lock()
+        # The agent we picked to talk after us, and who is already preparing their line
+        self.next_speaker = None
 
     def run(self):
         while True:
             # Wait until we've been activated
-            if not self.activated:
-                time.sleep(0.1)
-                continue
-                
-            self.activated = False
+            self.activated.wait()
+            self.activated.clear()
+            if self.room.stopped:
+                return
             print(f"[italic purple] {self.name} has STARTED speaking.")
-            
-            # This lock isn't necessary in theory, but for safety we will require this lock whenever updating any agent's convo history
-            with conversation_lock:
-                # Generate a response to the conversation
-                openai_answer = self.openai_manager.chat_with_history("Okay what is your response? Try to be as chaotic and bizarre and adult-humor oriented as possible. Again, 3 sentences maximum.")
-                openai_answer = openai_answer.replace("*", "")
-                print(f'[magenta]Got the following response:\n{openai_answer}')
-
-                # Add your new response into everyone else's chat history, then have them save their chat history
-                # This agent's responses are marked as "assistant" role to itself, so everyone elses messages are "user" role.
-                for agent in self.all_agents:
-                    if agent is not self:
-                        agent.openai_manager.chat_history.append({"role": "user", "content": f"[{self.name}] {openai_answer}"})
-                        agent.openai_manager.save_chat_to_backup()
-
-            # Create audio response
-            tts_file = elevenlabs_manager.text_to_audio(openai_answer, self.voice, False)
-
-            # Process the audio to get subtitles
-            audio_and_timestamps = whisper_manager.audio_to_text(tts_file, "sentence")
-
-            # Wait here until the current speaker is finished
-            with speaking_lock:
-
-                # If we're "paused", then simply finish speaking without activating another agent
-                # Otherwise, pick another agent randomly, then activate it
-                if not agents_paused:
-                    other_agents = [agent for agent in self.all_agents if agent is not self]
-                    random_agent = random.choice(other_agents)
-                    random_agent.activated = True
-
-                # Activate move filter on the image
-                obswebsockets_manager.set_filter_visibility("Line In", self.filter_name, True)
-            
-                # Play the TTS audio (without pausing)
-                audio_manager.play_audio(tts_file, False, False, True)
 
-                # While the audio is playing, display each sentence on the front-end
-                # Each dictionary will look like: {'text': 'here is my speech', 'start_time': 11.58, 'end_time': 14.74}
-                socketio.emit('start_agent', {'agent_id': self.agent_id})
-                try:
-                    for i in range(len(audio_and_timestamps)):
-                        current_sentence = audio_and_timestamps[i]
-                        duration = current_sentence['end_time'] - current_sentence['start_time']
-                        socketio.emit('agent_message', {'agent_id': self.agent_id, 'text': f"{current_sentence['text']}"})
-                        time.sleep(duration)
-                        # If this is not the final sentence, sleep for the gap of time inbetween this sentence and the next one starting
-                        if i < (len(audio_and_timestamps) - 1):
-                            time_between_sentences = audio_and_timestamps[i+1]['start_time'] - current_sentence['end_time']
-                            time.sleep(time_between_sentences)
-                except Exception:
-                    print(f"[magenta] Whoopsie! There was a problem and I don't know why. This was the current_sentence it broke on: {current_sentence}")
-                socketio.emit('clear_agent', {'agent_id': self.agent_id})
-            
-                time.sleep(1) # Wait one second before the next person talks, otherwise their audio gets cut off
-
-                # Turn off the filter in OBS
-                obswebsockets_manager.set_filter_visibility("Line In", self.filter_name, False)
+            self.run_turn()
 
             print(f"[italic purple] {self.name} has FINISHED speaking.")        
 
+    # Tell this agent to start speaking. Safe to call from any thread.
+    def activate(self):
+        if self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self.async_activated.set)
+        else:
+            self.activated.set()
+
+    # Same as run(), but for the asyncio engine
+    async def run_async(self):
+        while True:
+            # Wait until we've been activated
+            await self.async_activated.wait()
+            self.async_activated.clear()
+            if self.room.stopped:
+                return
+            print(f"[italic purple] {self.name} has STARTED speaking.")
+
+            await self.run_turn_async()
+
+            print(f"[italic purple] {self.name} has FINISHED speaking.")
+
+    # Start generating our next line ahead of time, unless we're already doing that
+    def prepare_turn(self):
+        with self.prepared_turn_lock:
+            if self.prepared_turn is None:
+                self.prepared_turn = PreparedTurn(self)
+
+    def take_prepared_turn(self):
+        with self.prepared_turn_lock:
+            prepared_turn = self.prepared_turn
+            self.prepared_turn = None
+            return prepared_turn
+
+    def cancel_prepared_turn(self):
+        prepared_turn = self.take_prepared_turn()
+        if prepared_turn is not None:
+            prepared_turn.cancel()
+
+    # Called as soon as our line is committed to the conversation.
+    # If we're "paused", then nobody else will talk after us. Otherwise, pick another agent randomly and have them start preparing their line right away.
+    def schedule_next_speaker(self):
+        if self.room.agents_paused or self.room.stopped:
+            return
+        other_agents = [agent for agent in self.room.agents if agent is not self]
+        self.next_speaker = random.choice(other_agents)
+        self.next_speaker.prepare_turn()
+
+    # Called once we're done talking: hand over to the speaker we picked earlier.
+    # If we got "paused" in the meantime, throw away their prepared line instead.
+    def hand_over_to_next_speaker(self):
+        next_speaker = self.next_speaker
+        self.next_speaker = None
+        if next_speaker is None:
+            return
+        if self.room.agents_paused or self.room.stopped:
+            next_speaker.cancel_prepared_turn()
+            return
+        next_speaker.activate()
+
+    # One full turn: use our prepared line (or generate one now), then say it
+    def run_turn(self):
+        try:
+            self.say_prepared_turn()
+        finally:
+            # Whatever happened to our line, somebody has to talk next (unless we're paused), otherwise the show stalls
+            if self.next_speaker is None:
+                self.schedule_next_speaker()
+            # The next speaker has (hopefully) already finished preparing their line, so they can start right away
+            self.hand_over_to_next_speaker()
+
+    # Waits for the first clip of our line, then starts saying it.
+    # If someone else said something since we prepared the line, it doesn't fit the conversation anymore, so we make a new one (only once, so we can't get stuck here).
+    # Returns (first_clip, prepared_turn). The clip is None if no audio could be made, in which case nothing was added to the conversation.
+    def wait_for_first_clip(self, prepared_turn):
+        for attempt in range(2):
+            with prepared_turn.tracer.span("wait_first_clip", trace_id=prepared_turn.trace_id, room=self.room.name):
+                clip = prepared_turn.clips.get()
+            if clip is None:
+                prepared_turn.cancel()
+                return None, prepared_turn
+            if prepared_turn.start_speaking(ignore_changes=attempt > 0):
+                return clip, prepared_turn
+            print(f"[italic purple] The conversation changed, so {self.name} is rethinking their response.")
+            prepared_turn.cancel()
+            prepared_turn = PreparedTurn(self)
+
+    def say_prepared_turn(self):
+        prepared_turn = self.take_prepared_turn()
+        if prepared_turn is None:
+            prepared_turn = PreparedTurn(self)
+        tracer = prepared_turn.tracer
+        turn_start_time = time.time()
+        turn_start = time.perf_counter()
+
+        # Wait here until the current speaker is finished
+        with tracer.lock(self.room.speaking_lock, "speaking_lock", trace_id=prepared_turn.trace_id, room=self.room.name):
+
+            clip, prepared_turn = self.wait_for_first_clip(prepared_turn)
+            trace = {"trace_id": prepared_turn.trace_id, "room": self.room.name}
+            if clip is None:
+                print(f"[magenta] Whoopsie! {self.name} didn't get any audio for their response, so they're skipping their turn.")
+                return
+
+            # Activate move filter on the image
+            with tracer.span("obs", action="filter_on", **trace):
+                self.room.resources.obswebsockets_manager.set_filter_visibility("Line In", self.filter_name, True)
+
+            self.room.emit('start_agent', {'agent_id': self.agent_id})
+            first_playback = None
+            line_duration = 0
+            while clip is not None:
+                text, audio_clip, audio_and_timestamps = clip
+                # Queue the TTS audio right away, so it starts the instant the previous clip ends
+                playback = self.room.queue_clip(audio_clip)
+                first_playback = first_playback or playback
+                line_duration += get_clip_duration(audio_clip)
+                # Send the clip's subtitles to the front-end once it actually starts playing
+                self.send_subtitles(audio_and_timestamps, playback)
+                # The next clips keep generating in the background
+                clip = prepared_turn.clips.get()
+            # Don't let the next person talk until our last clip has actually finished, otherwise it gets cut off
+            if not playback.wait_until_finished(line_duration + PLAYBACK_TIMEOUT_MARGIN):
+                print(f"[red]{self.name}'s line still hasn't finished playing, moving on without it")
+            self.room.emit('clear_agent', {'agent_id': self.agent_id})
+            self.record_playback(tracer, trace, first_playback, playback)
+
+            # Turn off the filter in OBS
+            with tracer.span("obs", action="filter_off", **trace):
+                self.room.resources.obswebsockets_manager.set_filter_visibility("Line In", self.filter_name, False)
+
+        tracer.record("turn", turn_start_time, (time.perf_counter() - turn_start) * 1000, **trace)
+
+    # Records how long our audio played for, and the dead air between the previous speaker finishing and us starting
+    def record_playback(self, tracer, trace, first_playback, last_playback):
+        if first_playback.started_at is None or last_playback.finished_at is None:
+            return
+        tracer.record("playback", first_playback.started_at, (last_playback.finished_at - first_playback.started_at) * 1000, **trace)
+        previous_finished_at = self.room.last_speaker_finished_at
+        if previous_finished_at is not None:
+            tracer.record("dead_air", previous_finished_at, max(0, first_playback.started_at - previous_finished_at) * 1000, **trace)
+        self.room.last_speaker_finished_at = last_playback.finished_at
+
+    # Sends a clip's whole subtitle track to the front-end in one message, the moment the clip starts playing.
+    # Each dictionary will look like: {'text': 'here is my speech', 'start_time': 11.58, 'end_time': 14.74}, with the times measured from the start of the clip.
+    # The browser shows each sentence at its start_time itself (see static/js/multiAgent.js), so nothing on the server has to sleep through the clip.
+    def send_subtitles(self, audio_and_timestamps, playback):
+        subtitles = [{'text': sentence['text'], 'start_time': sentence['start_time'] or 0, 'end_time': sentence['end_time']} for sentence in audio_and_timestamps]
+        playback.on_started(lambda: self.room.emit('agent_subtitles', {'agent_id': self.agent_id, 'started_at': playback.started_at, 'subtitles': subtitles}))
+
+    # Same as run_turn, but for the asyncio engine
+    async def run_turn_async(self):
+        try:
+            await self.say_prepared_turn_async()
+        finally:
+            # Whatever happened to our line, somebody has to talk next (unless we're paused), otherwise the show stalls
+            if self.next_speaker is None:
+                self.schedule_next_speaker()
+            self.hand_over_to_next_speaker()
+
+    # Same as wait_for_first_clip, but for the asyncio engine
+    async def wait_for_first_clip_async(self, prepared_turn):
+        for attempt in range(2):
+            with prepared_turn.tracer.span("wait_first_clip", trace_id=prepared_turn.trace_id, room=self.room.name):
+                clip = await prepared_turn.clips.get()
+            if clip is None:
+                prepared_turn.cancel()
+                return None, prepared_turn
+            if prepared_turn.start_speaking(ignore_changes=attempt > 0):
+                return clip, prepared_turn
+            print(f"[italic purple] The conversation changed, so {self.name} is rethinking their response.")
+            prepared_turn.cancel()
+            prepared_turn = PreparedTurn(self)
+
+    # Same as say_prepared_turn, but for the asyncio engine.
+    # OBS (which only has a blocking client) runs on the default thread pool.
+    async def say_prepared_turn_async(self):
+        prepared_turn = self.take_prepared_turn()
+        if prepared_turn is None:
+            prepared_turn = PreparedTurn(self)
+        tracer = prepared_turn.tracer
+        turn_start_time = time.time()
+        turn_start = time.perf_counter()
+
+        # Wait here until the current speaker is finished
+        async with tracer.lock_async(self.room.async_speaking_lock, "speaking_lock", trace_id=prepared_turn.trace_id, room=self.room.name):
+
+            clip, prepared_turn = await self.wait_for_first_clip_async(prepared_turn)
+            trace = {"trace_id": prepared_turn.trace_id, "room": self.room.name}
+            if clip is None:
+                print(f"[magenta] Whoopsie! {self.name} didn't get any audio for their response, so they're skipping their turn.")
+                return
+
+            # Activate move filter on the image
+            with tracer.span("obs", action="filter_on", **trace):
+                await asyncio.to_thread(self.room.resources.obswebsockets_manager.set_filter_visibility, "Line In", self.filter_name, True)
+
+            self.room.emit('start_agent', {'agent_id': self.agent_id})
+            first_playback = None
+            line_duration = 0
+            while clip is not None:
+                text, audio_clip, audio_and_timestamps = clip
+                # Queue the TTS audio right away, so it starts the instant the previous clip ends
+                playback = self.room.queue_clip(audio_clip)
+                first_playback = first_playback or playback
+                line_duration += get_clip_duration(audio_clip)
+                self.send_subtitles(audio_and_timestamps, playback)
+                # The next clips keep generating in the background
+                clip = await prepared_turn.clips.get()
+            # Wait until the audio has actually finished before the next person talks, otherwise it gets cut off
+            if not await playback.wait_until_finished_async(line_duration + PLAYBACK_TIMEOUT_MARGIN):
+                print(f"[red]{self.name}'s line still hasn't finished playing, moving on without it")
+            self.room.emit('clear_agent', {'agent_id': self.agent_id})
+            self.record_playback(tracer, trace, first_playback, playback)
+
+            # Turn off the filter in OBS
+            with tracer.span("obs", action="filter_off", **trace):
+                await asyncio.to_thread(self.room.resources.obswebsockets_manager.set_filter_visibility, "Line In", self.filter_name, False)
+
+        tracer.record("turn", turn_start_time, (time.perf_counter() - turn_start) * 1000, **trace)
 
 # Class that handles human input, this thread is how you can manually activate or pause the other agents
 class Human():
     
-    def __init__(self, name, all_agents):
+    def __init__(self, room, name):
+        self.room = room # The ConversationRoom whose agents this human controls
         self.name = name # This will be added to the beginning of the response
-        self.all_agents = all_agents
 
     def run(self):
-        global agents_paused
-        while True:
+        while not self.room.stopped:
+            key = self.get_pressed_key()
 
             # Speak into mic and add the dialogue to the chat history
-            if keyboard.is_pressed('num 7'):
-
-                # Toggles "pause" flag - stops other agents from activating additional agents
-                agents_paused = True
-                print(f"[italic red] Agents have been paused")
+            if key == 'num 7':
+                self.pause_agents()
 
                 # Record mic audio from Doug (until he presses '=')
                 print(f"[italic green] DougDoug has STARTED speaking.")
-                mic_audio = audio_manager.record_audio(end_recording_key='num 8')
-
-                with conversation_lock:
-                    # Transcribe mic audio into text with Whisper
-                    transcribed_audio = whisper_manager.audio_to_text(mic_audio)
-                    print(f"[teal]Got the following audio from Doug:\n{transcribed_audio}")
+                # Transcribe mic audio into text with Whisper
+                # This happens outside the conversation lock, so it never waits on an agent's OpenAi call (or makes them wait on Whisper)
+                transcribed_audio = self.record_and_transcribe()
+                print(f"[teal]Got the following audio from Doug:\n{transcribed_audio}")
 
-                    # Add Doug's response into all agents chat history
-                    for agent in self.all_agents:
-                        agent.openai_manager.chat_history.append({"role": "user", "content": f"[{self.name}] {transcribed_audio}"})
-                        agent.openai_manager.save_chat_to_backup() # Tell the other agents to save their chat history to their backup file
+                # Add Doug's response into all agents chat history
+                with get_latency_tracer().lock(self.room.conversation_lock, "conversation_lock", room=self.room.name, speaker=self.name):
+                    self.share_response(transcribed_audio)
                 
                 print(f"[italic magenta] DougDoug has FINISHED speaking.")
 
                 # Activate another agent randomly
-                agents_paused = False
-                random_agent = random.randint(0, len(self.all_agents)-1)
-                print(f"[cyan]Activating Agent {random_agent+1}")
-                self.all_agents[random_agent].activated = True
+                self.activate_random_agent()
 
-            
-            # "Pause" the other agents.
-            # Whoever is currently speaking will finish, but no future agents will be activated
-            if keyboard.is_pressed('f4'):
-                print("[italic red] Agents have been paused")
-                agents_paused = True
-                time.sleep(1) # Wait for a bit to ensure you don't press this twice in a row
-            
-            # Activate Agent 1
-            if keyboard.is_pressed('num 1'):
-                print("[cyan]Activating Agent 1")
-                agents_paused = False
-                self.all_agents[0].activated = True
-                time.sleep(1) # Wait for a bit to ensure you don't press this twice in a row
-            
-            # Activate Agent 2
-            if keyboard.is_pressed('num 2'):
-                print("[cyan]Activating Agent 2")
-                agents_paused = False
-                self.all_agents[1].activated = True
-                time.sleep(1) # Wait for a bit to ensure you don't press this twice in a row
-            
-            # Activate Agent 3
-            if keyboard.is_pressed('num 3'):
-                print("[cyan]Activating Agent 3")
-                agents_paused = False
-                self.all_agents[2].activated = True
+            elif key is not None:
+                self.handle_control_key(key)
                 time.sleep(1) # Wait for a bit to ensure you don't press this twice in a row
             
             time.sleep(0.05)
-                
 
+    # Same as run(), but for the asyncio engine
+    async def run_async(self):
+        while not self.room.stopped:
+            key = self.get_pressed_key()
 
-def start_bot(bot):
-    bot.run()
+            # Speak into mic and add the dialogue to the chat history
+            if key == 'num 7':
+                self.pause_agents()
 
-if __name__ == '__main__':
+                # Record mic audio from Doug (until he presses '=')
+                print(f"[italic green] DougDoug has STARTED speaking.")
+                # Transcribe mic audio into text with Whisper, outside the conversation lock
+                transcribed_audio = await asyncio.to_thread(self.record_and_transcribe)
+                print(f"[teal]Got the following audio from Doug:\n{transcribed_audio}")
 
-    all_agents = []
+                # Add Doug's response into all agents chat history
+                # Nothing awaits while holding the conversation lock, so taking it here never blocks the event loop (see ConversationRoom.run_async)
+                with get_latency_tracer().lock(self.room.conversation_lock, "conversation_lock", room=self.room.name, speaker=self.name):
+                    self.share_response(transcribed_audio)
 
-    # Agent 1
-    agent1 = Agent("OSWALD", 1, "Audio Move - Wario Pepper", all_agents, VIDEOGAME_AGENT_1, "Dougsworth")
-    agent1_thread = threading.Thread(target=start_bot, args=(agent1,))
-    agent1_thread.start()
+                print(f"[italic magenta] DougDoug has FINISHED speaking.")
 
-    # Agent 2
-    agent2 = Agent("TONY KING OF NEW YORK", 2, "Audio Move - Waluigi Pepper", all_agents, VIDEOGAME_AGENT_2, "Tony Emperor of New York")
-    agent2_thread = threading.Thread(target=start_bot, args=(agent2,))
-    agent2_thread.start()
+                # Activate another agent randomly
+                self.activate_random_agent()
+
+            elif key is not None:
+                self.handle_control_key(key)
+                await asyncio.sleep(1) # Wait for a bit to ensure you don't press this twice in a row
+
+            await asyncio.sleep(0.05)
+
+    # Records the mic until the end key is pressed, and returns what was said
+    # "asr" is how long we wait for the transcript after the end key is pressed
+    def record_and_transcribe(self):
+        resources = self.room.resources
+        tracer = get_latency_tracer()
+        trace = {"trace_id": tracer.new_trace_id(self.name), "room": self.room.name}
+        if not STREAMING_MIC:
+            with tracer.span("human_recording", **trace):
+                mic_audio = resources.audio_manager.record_audio(end_recording_key='num 8')
+            with tracer.span("asr", **trace):
+                return resources.whisper_manager.audio_to_text(mic_audio)
+        # Each window of audio starts transcribing in the background as soon as it's recorded
+        transcriber = IncrementalTranscriber(LazyWhisper(resources))
+        with tracer.span("human_recording", **trace):
+            for samples, sample_rate in resources.audio_manager.stream_mic_audio(end_recording_key='num 8'):
+                transcriber.add_window(samples, sample_rate)
+        with tracer.span("asr", **trace):
+            return transcriber.finish()
+
+    # Returns the first control key that is currently pressed, or None
+    def get_pressed_key(self):
+        for key in ['num 7', 'f4', 'num 1', 'num 2', 'num 3']:
+            if keyboard.is_pressed(key):
+                return key
+        return None
+
+    # Toggles "pause" flag - stops other agents from activating additional agents
+    # Any lines the agents were preparing ahead of time are thrown away, since they won't fit after whatever the human says next
+    def pause_agents(self):
+        self.room.agents_paused = True
+        self.room.cancel_prepared_turns()
+        # The gap until the next agent speaks is on purpose, so it doesn't count as dead air
+        self.room.last_speaker_finished_at = None
+        print(f"[italic red] Agents have been paused")
+
+    # Add Doug's response into the shared conversation log, so every agent sees it
+    def share_response(self, transcribed_audio):
+        self.room.conversation_log.add_message(self.name, transcribed_audio)
+
+    # Unpause the agents and activate one of them randomly
+    def activate_random_agent(self):
+        self.room.agents_paused = False
+        random_agent = random.randint(0, len(self.room.agents)-1)
+        print(f"[cyan]Activating Agent {random_agent+1}")
+        self.room.agents[random_agent].activate()
+
+    # Handles the pause and "activate agent" keys
+    def handle_control_key(self, key):
 
-    # Agent 3
-    agent3 = Agent("VICTORIA", 3, "Audio Move - Gamer Pepper", all_agents, VIDEOGAME_AGENT_3, "Victoria")
-    agent3_thread = threading.Thread(target=start_bot, args=(agent3,))
-    agent3_thread.start()
+        # "Pause" the other agents.
+        # Whoever is currently speaking will finish, but no future agents will be activated
+        if key == 'f4':
+            self.pause_agents()
 
-    all_agents.append(agent1)
-    all_agents.append(agent2)
-    all_agents.append(agent3)
+        # Activate Agent 1, 2 or 3
+        elif key in ['num 1', 'num 2', 'num 3']:
+            agent_number = int(key[-1])
+            if agent_number > len(self.room.agents):
+                return
+            print(f"[cyan]Activating Agent {agent_number}")
+            self.room.agents_paused = False
+            self.room.agents[agent_number-1].activate()
 
-    # Human thread
-    human = Human("DOUGDOUG", all_agents)
-    human_thread = threading.Thread(target=start_bot, args=(human,))
-    human_thread.start()
+
+
+def start_bot(bot):
+    bot.run()
+
+if __name__ == '__main__':
+
+    # The main room gets the three default agents, plus the human on the keyboard
+    room_manager.create_room(DEFAULT_ROOM_NAME, DEFAULT_AGENTS, "DOUGDOUG")
 
     print("[italic green]!!AGENTS ARE READY TO GO!!\nPress Num 1, Num 2, or Num3 to activate an agent.\nPress F7 to speak to the agents.")
 
     socketio.run(app)
-
-    agent1_thread.join()
-    agent2_thread.join()
-    agent3_thread.join()
-    human_thread.join()
\ No newline at end of file
@@ -1,5 +1,15 @@
+import json
 import time
-from obswebsocket import obsws, requests  # noqa: E402
+import queue
+import itertools
+import threading
+import websocket
+from collections import deque
+from concurrent.futures import Future
+from obswebsocket import obsws, requests, events  # noqa: E402
+from obswebsocket.core import RecvThread
+from obswebsocket.exceptions import MessageTimeout
+from websocket import WebSocketException
 from websockets_auth import WEBSOCKET_HOST, WEBSOCKET_PORT, WEBSOCKET_PASSWORD
 
 ##########################################################
@@ -7,43 +17,329 @@ from websockets_auth import WEBSOCKET_HOST, WEBSOCKET_PORT, WEBSOCKET_PASSWORD
 
 class OBSWebsocketsManager:
     ws = None
+
+    # Every request goes through one queue, and a background thread sends them to OBS in order.
+    # The set_ functions just queue their request and return a Future straight away, so a slow OBS never holds up the agents (or their audio).
+    # Requests that are queued around the same time (e.g. every frame of an animation) are sent together as one RequestBatch, so it's one round-trip instead of dozens.
+    # The get_ functions wait for their answer, but still go through the queue so they see everything that was set before them.
+    #
+    # Another background thread (the supervisor) keeps us connected. If OBS isn't running yet, or restarts mid-stream, it keeps trying to reconnect
+    # with a growing delay inbetween, and the show carries on without the OBS effects in the meantime:
+    # set_ requests are held (the most recent max_pending_requests of them) and sent once OBS is back, and get_ requests fail straight away with OBSDisconnected.
     
-    def __init__(self):
+    def __init__(self, max_batch_size=50, batch_timeout=5, request_timeout=5, min_reconnect_delay=1, max_reconnect_delay=30, max_pending_requests=100, host=WEBSOCKET_HOST, port=WEBSOCKET_PORT, password=WEBSOCKET_PASSWORD):
+        """
+        max_batch_size: the most requests sent to OBS in one RequestBatch
+        batch_timeout: seconds to wait for OBS to answer a RequestBatch before moving on to the next requests
+        request_timeout: seconds to wait for OBS to answer a single request. If it doesn't, we assume the connection is dead and reconnect.
+        min_reconnect_delay / max_reconnect_delay: seconds between reconnect attempts. The delay doubles after every failed attempt.
+        max_pending_requests: how many set_ requests to hold on to while disconnected. Older ones are dropped.
+        host / port / password: where OBS's websocket server is, see websockets_auth.py
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.request_timeout = request_timeout
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        # Scene item IDs don't change while the item exists, so each one is only looked up once: {(scene_name, source_name): scene_item_id}
+        # OBS tells us when scenes and sources are added, removed or renamed, and then we forget the IDs that might be wrong now.
+        self.scene_item_ids = {}
+        self.scene_item_ids_lock = threading.Lock()
+
+        # obs-websocket-py doesn't know about RequestBatch, so OBSBatchClient hands OBS's answers to on_batch_response() before the library sees them
+        self.batch_responses = {}
+        self.batch_counter = itertools.count(1)
+
+        # Health of the connection, see get_health()
+        self.state = "connecting"
+        self.state_changed_at = time.time()
+        self.connected = threading.Event()
+        self.disconnected = threading.Event()
+        self.closed = False
+        self.reconnect_attempts = 0
+        self.last_error = None
+        self.pending_requests = deque(maxlen=max_pending_requests)
+        self.dropped_requests = 0
+
+        self.commands = queue.Queue()
+        self.worker_thread = threading.Thread(target=self.run_commands, daemon=True)
+        self.worker_thread.start()
+        self.supervisor_thread = threading.Thread(target=self.supervise, daemon=True)
+        self.supervisor_thread.start()
+
+    def disconnect(self):
+        self.closed = True
+        self.set_state("closed")
+        self.disconnected.set()
+        if self.ws is not None:
+            self.ws.disconnect()
+
+    # Blocks until we're connected to OBS, or timeout seconds have passed. Returns True if we're connected.
+    def wait_until_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    # Returns how the connection is doing, e.g. {'state': 'disconnected', 'seconds_in_state': 12.5, 'reconnect_attempts': 3, 'pending_requests': 4, 'dropped_requests': 0, 'last_error': '...'}
+    # state is "connecting" (never connected yet), "connected", "disconnected" (lost the connection and trying to get it back) or "closed"
+    def get_health(self):
+        return {
+            'state': self.state,
+            'seconds_in_state': round(time.time() - self.state_changed_at, 1),
+            'reconnect_attempts': self.reconnect_attempts,
+            'pending_requests': len(self.pending_requests),
+            'dropped_requests': self.dropped_requests,
+            'last_error': self.last_error,
+        }
+
+    def set_state(self, state):
+        self.state = state
+        self.state_changed_at = time.time()
+
+    # The supervisor thread: (re)connects whenever we aren't connected, waiting longer after each failed attempt
+    def supervise(self):
+        delay = self.min_reconnect_delay
+        while not self.closed:
+            if self.connected.is_set():
+                self.disconnected.wait()
+                continue
+            try:
+                self.connect()
+                delay = self.min_reconnect_delay
+            except Exception as e:
+                self.reconnect_attempts += 1
+                self.last_error = str(e)
+                if self.reconnect_attempts == 1 or self.reconnect_attempts % 10 == 0:
+                    print(f"Couldn't connect to OBS ({e}), retrying every {self.max_reconnect_delay}s at most. The agents will keep talking without the OBS effects.")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def connect(self):
+        # Throw away the old connection, without waiting on it in case it's stuck
+        if self.ws is not None:
+            threading.Thread(target=close_quietly, args=(self.ws,), daemon=True).start()
+            self.ws = None
+
         # Connect to websockets
-        self.ws = obsws(WEBSOCKET_HOST, WEBSOCKET_PORT, WEBSOCKET_PASSWORD)
-        self.ws.connect()
+        ws = OBSBatchClient(self.host, self.port, self.password, timeout=self.request_timeout, on_disconnect=self.on_disconnect, on_batch_response=self.on_batch_response)
+        ws.connect()
+        for event in [events.SceneItemCreated, events.SceneItemRemoved, events.SceneRemoved, events.SceneNameChanged, events.InputNameChanged, events.InputRemoved]:
+            ws.register(self.on_scene_changed, event)
+        self.ws = ws
+        # If OBS restarted, every scene item has a new ID
+        self.forget_scene_item_ids()
+        self.reconnect_attempts = 0
+        self.set_state("connected")
+        self.disconnected.clear()
+        self.connected.set()
         print("Connected to OBS Websockets!\n")
+        # Wake up the worker, so it sends anything that was held while we were disconnected
+        self.commands.put(None)
 
-    def disconnect(self):
-        self.ws.disconnect()
+    # Called by obs-websocket-py when the websocket closes
+    def on_disconnect(self, ws):
+        if ws is self.ws:
+            self.mark_disconnected("the connection closed")
+
+    def mark_disconnected(self, reason):
+        if not self.connected.is_set() or self.closed:
+            return
+        print(f"Lost the connection to OBS ({reason}), reconnecting in the background. The agents will keep talking without the OBS effects.")
+        self.last_error = str(reason)
+        self.set_state("disconnected")
+        self.connected.clear()
+        self.disconnected.set()
+
+    # Sends a request to OBS in the background, and returns a Future for it straight away.
+    # request can be a request object, or a function that returns one. A function is called on the background thread, so it can look up scene item IDs without making you wait.
+    def queue_request(self, request):
+        future = Future()
+        self.commands.put((request, future, False))
+        return future
+
+    # Sends a request after everything that's already queued, waits for OBS to answer it, and returns it (the answer is in .datain)
+    def call(self, request):
+        future = Future()
+        self.commands.put((request, future, True))
+        return future.result()
+
+    # Returns the ID of a source in a scene, which a lot of requests need instead of the source's name.
+    # Only call this from the background thread (i.e. inside a function given to queue_request or call), since it talks to OBS directly.
+    def get_scene_item_id(self, scene_name, source_name):
+        with self.scene_item_ids_lock:
+            if (scene_name, source_name) in self.scene_item_ids:
+                return self.scene_item_ids[(scene_name, source_name)]
+        response = self.ws.call(requests.GetSceneItemId(sceneName=scene_name, sourceName=source_name))
+        scene_item_id = response.datain['sceneItemId']
+        with self.scene_item_ids_lock:
+            self.scene_item_ids[(scene_name, source_name)] = scene_item_id
+        return scene_item_id
+
+    def forget_scene_item_ids(self):
+        with self.scene_item_ids_lock:
+            self.scene_item_ids.clear()
+
+    # Called by obs-websocket-py when scenes or sources change in OBS
+    def on_scene_changed(self, event):
+        with self.scene_item_ids_lock:
+            if event.name == "SceneItemCreated":
+                self.scene_item_ids[(event.datain['sceneName'], event.datain['sourceName'])] = event.datain['sceneItemId']
+            elif event.name == "SceneItemRemoved":
+                self.scene_item_ids.pop((event.datain.get('sceneName'), event.datain.get('sourceName')), None)
+            else:
+                # A scene or source was renamed or deleted, which can affect lots of IDs, so start over
+                self.scene_item_ids.clear()
+
+    # The background thread: takes everything that's queued and sends it to OBS.
+    # Requests that don't need an answer are batched together. A request that needs an answer sends the batch before it first, so the order is kept.
+    # While we're disconnected, requests that need an answer fail straight away, and the rest are held until we reconnect.
+    def run_commands(self):
+        while True:
+            commands = [self.commands.get()]
+            while len(commands) < self.max_batch_size:
+                try:
+                    commands.append(self.commands.get_nowait())
+                except queue.Empty:
+                    break
+            # None is only there to wake us up after reconnecting
+            commands = [command for command in commands if command is not None]
+            if self.connected.is_set() and self.pending_requests:
+                commands = self.take_pending_requests() + commands
+
+            batch = []
+            for request, future, needs_answer in commands:
+                if not self.connected.is_set():
+                    self.hold_request(request, future, needs_answer)
+                    continue
+                try:
+                    request = request() if callable(request) else request
+                except (MessageTimeout, OSError, WebSocketException) as e:
+                    # Lost the connection while looking up a scene item ID, so hold on to this one until we're back
+                    self.mark_disconnected(e)
+                    self.hold_request(request, future, needs_answer)
+                    continue
+                except Exception as e:
+                    print(f"Couldn't build OBS request: {e}")
+                    future.set_exception(e)
+                    continue
+                if needs_answer:
+                    self.send_batch(batch)
+                    batch = []
+                    self.send_request(request, future)
+                else:
+                    batch.append((request, future))
+            self.send_batch(batch)
+
+    def hold_request(self, request, future, needs_answer):
+        if needs_answer:
+            future.set_exception(OBSDisconnected(f"Not connected to OBS ({self.state})"))
+            return
+        if len(self.pending_requests) == self.pending_requests.maxlen:
+            # Drop the oldest one, and let whoever is holding its Future know it's never going to be sent
+            _, dropped_future, _ = self.pending_requests.popleft()
+            dropped_future.set_exception(OBSDisconnected("Dropped while disconnected from OBS, too many requests were waiting"))
+            self.dropped_requests += 1
+        self.pending_requests.append((request, future, needs_answer))
+
+    def take_pending_requests(self):
+        pending_requests = list(self.pending_requests)
+        self.pending_requests.clear()
+        print(f"Sending {len(pending_requests)} OBS requests from while we were disconnected")
+        return pending_requests
+
+    def send_request(self, request, future):
+        try:
+            response = self.ws.call(request)
+        except Exception as e:
+            print(f"OBS request {request.name} failed: {e}")
+            self.mark_disconnected(e)
+            future.set_exception(e)
+            return
+        if response.status is False:
+            self.on_request_failed(request)
+        future.set_result(response)
+
+    # Sends a list of (request, future) to OBS as one RequestBatch, and waits for the answer
+    def send_batch(self, batch):
+        if len(batch) <= 1:
+            for request, future in batch:
+                self.send_request(request, future)
+            return
+
+        batch_id = f"batch-{next(self.batch_counter)}"
+        response = {"event": threading.Event(), "results": None}
+        self.batch_responses[batch_id] = response
+        payload = {
+            "op": 8,
+            "d": {
+                "requestId": batch_id,
+                "haltOnFailure": False,
+                "executionType": 0, # SerialRealtime: one after another, in order
+                "requests": [{"requestType": request.name, "requestData": request.data()} for request, _ in batch]
+            }
+        }
+        try:
+            self.ws.ws.send(json.dumps(payload))
+            response["event"].wait(self.batch_timeout)
+        except Exception as e:
+            print(f"OBS request batch failed: {e}")
+            self.mark_disconnected(e)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self.batch_responses.pop(batch_id, None)
+
+        if response["results"] is None:
+            print(f"OBS didn't answer a batch of {len(batch)} requests within {self.batch_timeout}s")
+            self.mark_disconnected("a request batch timed out")
+            for _, future in batch:
+                future.set_exception(MessageTimeout(f"No answer for {batch_id}"))
+            return
+        for (request, future), result in zip(batch, response["results"]):
+            request.input(result.get('responseData', {}), result['requestStatus']['result'])
+            if request.status is False:
+                self.on_request_failed(request)
+            future.set_result(request)
+
+    # Called (on the connection's receiving thread) when OBS answers a RequestBatch
+    def on_batch_response(self, data):
+        response = self.batch_responses.get(data.get('requestId'))
+        if response is not None:
+            response["results"] = data.get('results', [])
+            response["event"].set()
+
+    def on_request_failed(self, request):
+        print(f"OBS request {request.name} failed: {request.datain}")
+        # The source may have been removed and added back with a new ID, so look the IDs up again next time
+        if "sceneItemId" in request.data():
+            self.forget_scene_item_ids()
 
     # Set the current scene
     def set_scene(self, new_scene):
-        self.ws.call(requests.SetCurrentProgramScene(sceneName=new_scene))
+        return self.queue_request(requests.SetCurrentProgramScene(sceneName=new_scene))
 
     # Set the visibility of any source's filters
     def set_filter_visibility(self, source_name, filter_name, filter_enabled=True):
-        self.ws.call(requests.SetSourceFilterEnabled(sourceName=source_name, filterName=filter_name, filterEnabled=filter_enabled))
+        return self.queue_request(requests.SetSourceFilterEnabled(sourceName=source_name, filterName=filter_name, filterEnabled=filter_enabled))
 
     # Set the visibility of any source
     def set_source_visibility(self, scene_name, source_name, source_visible=True):
-        response = self.ws.call(requests.GetSceneItemId(sceneName=scene_name, sourceName=source_name))
-        myItemID = response.datain['sceneItemId']
-        self.ws.call(requests.SetSceneItemEnabled(sceneName=scene_name, sceneItemId=myItemID, sceneItemEnabled=source_visible))
+        return self.queue_request(lambda: requests.SetSceneItemEnabled(sceneName=scene_name, sceneItemId=self.get_scene_item_id(scene_name, source_name), sceneItemEnabled=source_visible))
 
     # Returns the current text of a text source
     def get_text(self, source_name):
-        response = self.ws.call(requests.GetInputSettings(inputName=source_name))
+        response = self.call(requests.GetInputSettings(inputName=source_name))
         return response.datain["inputSettings"]["text"]
 
     # Returns the text of a text source
     def set_text(self, source_name, new_text):
-        self.ws.call(requests.SetInputSettings(inputName=source_name, inputSettings = {'text': new_text}))
+        return self.queue_request(requests.SetInputSettings(inputName=source_name, inputSettings = {'text': new_text}))
 
     def get_source_transform(self, scene_name, source_name):
-        response = self.ws.call(requests.GetSceneItemId(sceneName=scene_name, sourceName=source_name))
-        myItemID = response.datain['sceneItemId']
-        response = self.ws.call(requests.GetSceneItemTransform(sceneName=scene_name, sceneItemId=myItemID))
+        response = self.call(lambda: requests.GetSceneItemTransform(sceneName=scene_name, sceneItemId=self.get_scene_item_id(scene_name, source_name)))
         transform = {}
         transform["positionX"] = response.datain["sceneItemTransform"]["positionX"]
         transform["positionY"] = response.datain["sceneItemTransform"]["positionY"]
@@ -65,25 +361,73 @@ class OBSWebsocketsManager:
     # e.g. {"scaleX": 2, "scaleY": 2.5}
     # Note: there are other transform settings, like alignment, etc, but these feel like the main useful ones.
     # Use get_source_transform to see the full list
+    # Moving a source every frame is fine, since the requests are batched and the scene item ID is only looked up once
     def set_source_transform(self, scene_name, source_name, new_transform):
-        response = self.ws.call(requests.GetSceneItemId(sceneName=scene_name, sourceName=source_name))
-        myItemID = response.datain['sceneItemId']
-        self.ws.call(requests.SetSceneItemTransform(sceneName=scene_name, sceneItemId=myItemID, sceneItemTransform=new_transform))
+        return self.queue_request(lambda: requests.SetSceneItemTransform(sceneName=scene_name, sceneItemId=self.get_scene_item_id(scene_name, source_name), sceneItemTransform=new_transform))
 
     # Note: an input, like a text box, is a type of source. This will get *input-specific settings*, not the broader source settings like transform and scale
     # For a text source, this will return settings like its font, color, etc
     def get_input_settings(self, input_name):
-        return self.ws.call(requests.GetInputSettings(inputName=input_name))
+        return self.call(requests.GetInputSettings(inputName=input_name))
 
     # Get list of all the input types
     def get_input_kind_list(self):
-        return self.ws.call(requests.GetInputKindList())
+        return self.call(requests.GetInputKindList())
 
     # Get list of all items in a certain scene
     def get_scene_items(self, scene_name):
-        return self.ws.call(requests.GetSceneItemList(sceneName=scene_name))
+        return self.call(requests.GetSceneItemList(sceneName=scene_name))
     
     # Immediately ends the stream. Use with caution.
     def stop_stream(self):
-        return self.ws.call(requests.StopStream())
+        return self.call(requests.StopStream())
+
+
+
+# obs-websocket-py's client, but the answers to our RequestBatches (op 9) go to on_batch_response(data) instead of being logged as an "Unknown message".
+# Everything else (requests, events, disconnects) is handled by the library as usual. Only obs-websocket 5.x is supported, not the legacy protocol.
+class OBSBatchClient(obsws):
+
+    def __init__(self, host, port, password, timeout=60, on_disconnect=None, on_batch_response=None):
+        super().__init__(host, port, password, legacy=False, timeout=timeout, on_disconnect=on_disconnect)
+        self.on_batch_response = on_batch_response
+
+    # Same as obsws.connect(), but the messages are received by BatchRecvThread
+    def connect(self):
+        self.ws = websocket.WebSocket()
+        self.ws.connect(f"ws://{self.host}:{self.port}")
+        self._auth()
+        self.thread_recv = BatchRecvThread(self)
+        self.thread_recv.daemon = True
+        self.thread_recv.start()
+
+class BatchRecvThread(RecvThread):
+
+    def __init__(self, core):
+        super().__init__(core)
+        # The library's loop only ever calls recv(), so we read each message first and keep the batch answers for ourselves
+        self.websocket = self.ws
+        self.ws = self
+
+    # An empty message is skipped by the library's loop
+    def recv(self):
+        message = self.websocket.recv()
+        try:
+            result = json.loads(message)
+        except (ValueError, TypeError):
+            return message
+        if isinstance(result, dict) and result.get('op') == 9:
+            if self.core.on_batch_response:
+                self.core.on_batch_response(result.get('d', {}))
+            return ""
+        return message
+
+# Raised by the get_ functions when we aren't connected to OBS
+class OBSDisconnected(Exception):
+    pass
 
+def close_quietly(ws):
+    try:
+        ws.disconnect()
+    except Exception:
+        pass
@@ -1,43 +1,86 @@
-from openai import OpenAI
+from api_clients import get_api_clients
 import tiktoken
 import os
 from rich import print
 import base64
 import time
 import json
+from chat_journal import ChatJournal
+from sentences import split_complete_sentences
 
 class OpenAiManager:
     
-    def __init__(self, system_prompt=None, chat_history_backup=None):
+    def __init__(self, system_prompt=None, chat_history_backup=None, conversation_log=None, speaker_name=None):
         """
         Optionally provide a chat_history_backup txt file and a system_prompt string.
         If the backup file is provided, we load the chat history from it.
         If the backup file already exists, then we don't add the system prompt into the convo history, because we assume that it already has a system prompt in it.
         Alternatively you manually add new system prompts into the chat history at any point. 
+
+        Alternatively provide a shared ConversationLog and the speaker_name of whoever this manager talks for (instead of a backup file).
+        Then chat_history is just this speaker's view of the shared log: the system prompt, our own lines as "assistant" messages and everyone else's lines as "user" messages.
+        The log saves itself, and our answers are added to the log rather than only to our own history.
         """
 
-        self.client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        # Every OpenAiManager shares the same pooled client, see api_clients.py
+        self.api_clients = get_api_clients()
+        self.client = self.api_clients.openai
         self.logging = True # Determines whether the module should print out its results
         self.tiktoken_encoder = None # Used to calculate the token count in messages
         self.chat_history = []
+        # Token count of each message in chat_history (same order), plus the running total.
+        # This way we only run tiktoken on a message once, instead of re-encoding the whole history every turn.
+        self.chat_history_token_counts = []
+        self.chat_history_tokens = 0
+
+        # OpenAi automatically caches the start of a prompt that it has seen recently, which makes those tokens cheaper and faster.
+        # It only works if the start of the prompt is exactly the same as last time, so the history is only ever added to at the end,
+        # and when it gets too long we drop a big block of old messages at once (trim_block_tokens), instead of one message every turn.
+        # That way the start of the prompt only changes once every few dozen turns.
+        self.max_history_tokens = 128000
+        self.trim_block_tokens = 32000
+        # How many of our prompt tokens OpenAi had cached, for the last call and in total
+        self.last_usage = None
+        self.total_prompt_tokens = 0
+        self.total_cached_tokens = 0
 
-        # If a backup file is provided, we will save our chat history to that file after every call
+        # If we are a view of a shared ConversationLog, this is how far through the log our chat_history has caught up
+        self.conversation_log = conversation_log
+        self.speaker_name = speaker_name
+        self.conversation_log_position = 0
+
+        # If a backup file is provided, every change to our chat history is journaled to disk (see chat_journal.py)
         self.chat_history_backup = chat_history_backup
+        self.journal = ChatJournal(chat_history_backup) if chat_history_backup else None
         
-        # If the backup file already exists, we load its contents into the chat_history
-        if chat_history_backup and os.path.exists(chat_history_backup):
-            with open(chat_history_backup, 'r') as file:
-                self.chat_history = json.load(file)
+        # If the backup file already exists, we load its contents (plus any journaled changes) into the chat_history
+        saved_chat_history = self.journal.load() if self.journal else None
+        if conversation_log is not None:
+            if system_prompt:
+                self.chat_history.append(system_prompt)
+            # Everything in chat_history after this comes from the log
+            self.conversation_log_history_start = len(self.chat_history)
+            self.conversation_log_position = conversation_log.first_index
+            conversation_log.add_view(self)
+        elif saved_chat_history is not None:
+            self.chat_history = saved_chat_history
         elif system_prompt:
             # If the chat history file doesn't exist, then our chat history is currently empty.
             # If we were provided a system_prompt, add it into the chat history as the first message.
             self.chat_history.append(system_prompt)
+            self.save_chat_to_backup()
+        self.rebuild_token_cache()
+
+    # The async client has to be created lazily, because it belongs to whichever event loop uses it
+    def get_async_client(self):
+        return self.api_clients.get_async_openai()
 
-    # Write our current chat history to the txt file
+    # Write our full current chat history to the txt file. The write happens on a background thread.
+    # You don't need to call this after add_message_to_history or pop_message_from_history, those changes are already journaled.
+    # Only call this if you changed chat_history directly.
     def save_chat_to_backup(self):
-        if self.chat_history_backup:
-            with open(self.chat_history_backup, 'w') as file:
-                json.dump(self.chat_history, file)
+        if self.journal:
+            self.journal.compact(self.chat_history)
 
     def num_tokens_from_messages(self, messages, model='gpt-4o'):
         """Returns the number of tokens used by a list of messages.
@@ -56,36 +99,107 @@ class OpenAiManager:
         Version 3: the content is an array with two dictionaries, one for the text portion and one for the image portion
             'content' = [{'type': 'text', 'text': 'Okay now please compare the previous image I sent you with this new image!'}, {'type': 'image_url', 'image_url': {'url': 'https://i.gyazo.com/8ec349446dbb538727e515f2b964224c.png', 'detail': 'high'}}]
         """
+        num_tokens = 0
+        for message in messages:
+            num_tokens += self.num_tokens_from_message(message, model)
+        num_tokens += 2  # every reply is primed with <im_start>assistant
+        return num_tokens
+
+    # Returns the number of tokens used by a single message (see num_tokens_from_messages for the supported formats)
+    def num_tokens_from_message(self, message, model='gpt-4o'):
         try:
             if self.tiktoken_encoder == None:
                 self.tiktoken_encoder = tiktoken.encoding_for_model(model) # We store this value so we don't have to check again every time
-            num_tokens = 0
-            for message in messages:
-                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-                for key, value in message.items():
-                    if key == 'role':
+            num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            for key, value in message.items():
+                if key == 'role':
+                    num_tokens += len(self.tiktoken_encoder.encode(value))
+                elif key == 'content':
+                    # In the case that value is just a string, simply get its token value and move on
+                    if isinstance(value, str):
                         num_tokens += len(self.tiktoken_encoder.encode(value))
-                    elif key == 'content':
-                        # In the case that value is just a string, simply get its token value and move on
-                        if isinstance(value, str):
-                            num_tokens += len(self.tiktoken_encoder.encode(value))
-                            continue
-
-                        # In this case the 'content' variables value is an array of dictionaries
-                        for message_data in value:
-                            for content_key, content_value in message_data.items():
-                                if content_key == 'type':
-                                    num_tokens += len(self.tiktoken_encoder.encode(content_value))
-                                elif content_key == 'text': 
-                                    num_tokens += len(self.tiktoken_encoder.encode(content_value))
-                                elif content_key == "image_url":
-                                    num_tokens += 1105 # Assumes the image is 1920x1080 and that detail is set to high               
-            num_tokens += 2  # every reply is primed with <im_start>assistant
+                        continue
+
+                    # In this case the 'content' variables value is an array of dictionaries
+                    for message_data in value:
+                        for content_key, content_value in message_data.items():
+                            if content_key == 'type':
+                                num_tokens += len(self.tiktoken_encoder.encode(content_value))
+                            elif content_key == 'text': 
+                                num_tokens += len(self.tiktoken_encoder.encode(content_value))
+                            elif content_key == "image_url":
+                                num_tokens += 1105 # Assumes the image is 1920x1080 and that detail is set to high               
             return num_tokens
         except Exception:
             # Either this model is not implemented in tiktoken, or there was some error processing the messages
             raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.""")
 
+    # Recount the tokens of every message in the chat history.
+    # Only needed when chat_history was replaced or edited directly (e.g. loaded from a backup file)
+    def rebuild_token_cache(self):
+        self.chat_history_token_counts = [self.num_tokens_from_message(message) for message in self.chat_history]
+        self.chat_history_tokens = sum(self.chat_history_token_counts)
+
+    # If someone modified chat_history without going through add_message_to_history, recount it and save the full history
+    def check_for_direct_changes(self):
+        if len(self.chat_history_token_counts) != len(self.chat_history):
+            self.rebuild_token_cache()
+            self.save_chat_to_backup()
+
+    # Returns the token length of the whole chat history, using the cached per-message counts
+    def get_chat_history_tokens(self):
+        self.check_for_direct_changes()
+        return self.chat_history_tokens + 2  # every reply is primed with <im_start>assistant
+
+    # Add a message to the end of the chat history, and count its tokens once (unless you already know its token count)
+    # The change is journaled to the backup file in the background
+    def add_message_to_history(self, message, message_tokens=None):
+        self.check_for_direct_changes()
+        if message_tokens is None:
+            message_tokens = self.num_tokens_from_message(message)
+        self.chat_history.append(message)
+        self.chat_history_token_counts.append(message_tokens)
+        self.chat_history_tokens += message_tokens
+        if self.journal:
+            self.journal.record_append(message, self.chat_history)
+
+    # Remove a message from the chat history and subtract its tokens from the running total
+    def pop_message_from_history(self, index=-1):
+        self.check_for_direct_changes()
+        message = self.chat_history.pop(index)
+        self.chat_history_tokens -= self.chat_history_token_counts.pop(index)
+        if self.journal:
+            self.journal.record_pop(index, self.chat_history)
+        return message
+
+    # Catch up our chat_history with any new lines in the shared conversation log.
+    # The log already knows each line's token count, so nothing gets re-encoded here.
+    def sync_with_conversation_log(self):
+        if self.conversation_log is None:
+            return
+        for entry in self.conversation_log.get_entries(self.conversation_log_position):
+            if entry['speaker'] == self.speaker_name:
+                self.add_message_to_history({"role": "assistant", "content": entry['text']}, entry['speaker_tokens'])
+            else:
+                self.add_message_to_history(entry['message'], entry['listener_tokens'])
+            self.conversation_log_position += 1
+
+    # The log index of the oldest line that's still in our chat_history. The log can drop every line before it.
+    def get_conversation_log_start(self):
+        return self.conversation_log_position - (len(self.chat_history) - self.conversation_log_history_start)
+
+    # Returns True if nobody has added to the shared conversation log since we took our snapshot at log_position
+    def is_up_to_date(self, log_position):
+        return self.conversation_log is None or len(self.conversation_log) == log_position
+
+    # Save the answer we just got. If we share a conversation log, it goes into the log (so everyone else sees it too).
+    def record_answer(self, openai_answer):
+        if self.conversation_log is not None:
+            self.conversation_log.add_message(self.speaker_name, openai_answer)
+            self.sync_with_conversation_log()
+        else:
+            self.add_message_to_history({"role": "assistant", "content": openai_answer})
+
     # Asks a question with no chat history
     def chat(self, prompt=""):
         if not prompt:
@@ -99,7 +213,7 @@ class OpenAiManager:
             return
 
         print("[yellow]\nAsking ChatGPT a question...")
-        completion = self.client.chat.completions.create(
+        completion = self.api_clients.call("openai", self.client.chat.completions.create,
           model="gpt-4o",
           messages=chat_question
         )
@@ -130,7 +244,7 @@ class OpenAiManager:
             url = image_path # The provided image path is a URL
         if self.logging:
             print("[yellow]\nAsking ChatGPT to analyze image...")
-        completion = self.client.chat.completions.create(
+        completion = self.api_clients.call("openai", self.client.chat.completions.create,
             model="gpt-4o",
             messages=[
                 {
@@ -155,10 +269,14 @@ class OpenAiManager:
         return openai_answer
     
 
-    # Asks a question that includes the full conversation history
-    # Can include a mix of text and images
-    def chat_with_history(self, prompt="", image_path="", local_image=True):
-        
+    # Trims old messages until the chat history plus the prompt (and optional image) is under the token limit, then adds the prompt to the chat history.
+    # Returns the list of messages to send to OpenAi, or None if the message couldn't be created.
+    # If we share a conversation log, the prompt is only sent along with this request and isn't saved in the history.
+    def prepare_chat_history(self, prompt="", image_path="", local_image=True):
+        self.sync_with_conversation_log()
+        prompt_messages = []
+        prompt_tokens = 0
+
         # If we received a prompt, add it into our chat history.
         # Prompts are technically optional because the Ai can just continue the conversation from where it left off.
         if prompt is not None and prompt != "":
@@ -191,33 +309,167 @@ class OpenAiManager:
                 }
                 new_chat_message["content"].append(new_image_content)
 
-            # Add the new message into our chat history
-            self.chat_history.append(new_chat_message)
+            prompt_messages.append(new_chat_message)
+            prompt_tokens += self.num_tokens_from_message(new_chat_message)
 
         # Check total token limit. Remove old messages as needed
         if self.logging:
-            print(f"[coral]Chat History has a current token length of {self.num_tokens_from_messages(self.chat_history)}")
-        while self.num_tokens_from_messages(self.chat_history) > 128000:
-            self.chat_history.pop(1) # We skip the 1st message since it's the system message
-            if self.logging:
-                print(f"Popped a message! New token length is: {self.num_tokens_from_messages(self.chat_history)}")
+            print(f"[coral]Chat History has a current token length of {self.get_chat_history_tokens() + prompt_tokens}")
+        if self.get_chat_history_tokens() + prompt_tokens > self.max_history_tokens:
+            self.trim_chat_history(self.max_history_tokens - self.trim_block_tokens - prompt_tokens)
+        # Without a conversation log nothing else remembers the prompt, so it's kept in our own chat history.
+        # It's only added after trimming, so the trim works out the same way in both modes.
+        if self.conversation_log is None and prompt_messages:
+            self.add_message_to_history(prompt_messages.pop(), prompt_tokens)
+        # The prompt goes on the very end, so everything before it is the same as last turn and can come from OpenAi's cache
+        return self.chat_history + prompt_messages
+
+    # Removes the oldest messages (but never the system message) until the chat history is at most target_tokens long
+    def trim_chat_history(self, target_tokens):
+        popped_messages = 0
+        while self.get_chat_history_tokens() > target_tokens and len(self.chat_history) > 1:
+            self.pop_message_from_history(1) # We skip the 1st message since it's the system message
+            popped_messages += 1
+        if self.logging:
+            print(f"Popped {popped_messages} old messages! New token length is: {self.get_chat_history_tokens()}")
+
+    # Asks a question that includes the full conversation history
+    # Can include a mix of text and images
+    def chat_with_history(self, prompt="", image_path="", local_image=True):
+
+        messages = self.prepare_chat_history(prompt, image_path, local_image)
+        if messages is None:
+            return None
 
+        openai_answer = self.get_completion(messages)
+
+        # Add this answer to our chat history
+        self.record_answer(openai_answer)
+        return openai_answer
+
+    # Keeps track of how much of the prompt OpenAi had cached, and prints it for this call
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        # Older versions of the openai library don't know about prompt_tokens_details, so it can be a plain dictionary
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached_tokens = details.get("cached_tokens", 0)
+        else:
+            cached_tokens = getattr(details, "cached_tokens", 0)
+        cached_tokens = cached_tokens or 0
+        self.last_usage = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cached_ratio": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0,
+        }
+        self.total_prompt_tokens += prompt_tokens
+        self.total_cached_tokens += cached_tokens
+        # The totals are always kept (the benchmark reads them), but they're only printed when logging is on
+        if not self.logging:
+            return
+        total_ratio = self.total_cached_tokens / self.total_prompt_tokens if self.total_prompt_tokens else 0
+        print(f"[grey50]Prompt cache: {cached_tokens}/{prompt_tokens} tokens cached ({self.last_usage['cached_ratio']:.0%}), {total_ratio:.0%} over the whole session")
+
+    # Sends a list of messages (e.g. from prepare_chat_history) to OpenAi and returns the answer.
+    # This does NOT add the answer to the chat history, call record_answer() if you decide to keep it.
+    def get_completion(self, messages):
         if self.logging:
             print("[yellow]\nAsking ChatGPT a question...")
-        completion = self.client.chat.completions.create(
+        completion = self.api_clients.call("openai", self.client.chat.completions.create,
           model="gpt-4o",
-          messages=self.chat_history
+          messages=messages
         )
+        self.record_usage(completion.usage)
+        openai_answer = completion.choices[0].message.content
+        if self.logging:
+            print(f"[green]\n{openai_answer}\n")
+        return openai_answer
 
-        # Add this answer to our chat history
-        self.chat_history.append({"role": completion.choices[0].message.role, "content": completion.choices[0].message.content})
+    # Same as get_completion, but streams the answer back from OpenAi.
+    # This is a generator that yields each sentence as soon as it's complete, and returns the full answer when it's done.
+    # This does NOT add the answer to the chat history, call record_answer() if you decide to keep it.
+    def stream_completion(self, messages):
+        if self.logging:
+            print("[yellow]\nAsking ChatGPT a question (streaming)...")
+        # We keep our OpenAi slot (see api_clients.py) until the whole answer has streamed in
+        with self.api_clients.open_stream("openai", self.client.chat.completions.create,
+          model="gpt-4o",
+          messages=messages,
+          stream=True,
+          stream_options={"include_usage": True}
+        ) as stream:
+            openai_answer = ""
+            unfinished_text = ""
+            for chunk in stream:
+                # The last chunk has no text, just the token usage
+                if getattr(chunk, "usage", None):
+                    self.record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                new_text = chunk.choices[0].delta.content
+                if not new_text:
+                    continue
+                openai_answer += new_text
+                unfinished_text += new_text
+                # Yield every sentence that has been completed so far
+                finished_sentences, unfinished_text = split_complete_sentences(unfinished_text)
+                for sentence in finished_sentences:
+                    yield sentence
+            # Whatever is left over is the final sentence
+            if unfinished_text.strip():
+                yield unfinished_text.strip()
 
-        # If a backup file was provided, write out convo history to the txt file
-        self.save_chat_to_backup()
+        if self.logging:
+            print(f"[green]\n{openai_answer}\n")
+        return openai_answer
 
-        # Return answer
+    # Async version of get_completion. Does NOT add the answer to the chat history.
+    async def get_completion_async(self, messages):
+        if self.logging:
+            print("[yellow]\nAsking ChatGPT a question...")
+        completion = await self.api_clients.call_async("openai", self.get_async_client().chat.completions.create,
+          model="gpt-4o",
+          messages=messages
+        )
+        self.record_usage(completion.usage)
         openai_answer = completion.choices[0].message.content
         if self.logging:
             print(f"[green]\n{openai_answer}\n")
         return openai_answer
-    
+
+    # Async version of stream_completion. This is an async generator that yields each sentence as soon as it's complete.
+    # Async generators can't return a value, so join the sentences yourself if you need the full answer.
+    # This does NOT add the answer to the chat history.
+    async def stream_completion_async(self, messages):
+        if self.logging:
+            print("[yellow]\nAsking ChatGPT a question (streaming)...")
+        async with self.api_clients.open_stream_async("openai", self.get_async_client().chat.completions.create,
+          model="gpt-4o",
+          messages=messages,
+          stream=True,
+          stream_options={"include_usage": True}
+        ) as stream:
+            openai_answer = ""
+            unfinished_text = ""
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    self.record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                new_text = chunk.choices[0].delta.content
+                if not new_text:
+                    continue
+                openai_answer += new_text
+                unfinished_text += new_text
+                # Yield every sentence that has been completed so far
+                finished_sentences, unfinished_text = split_complete_sentences(unfinished_text)
+                for sentence in finished_sentences:
+                    yield sentence
+            # Whatever is left over is the final sentence
+            if unfinished_text.strip():
+                yield unfinished_text.strip()
+
+        if self.logging:
+            print(f"[green]\n{openai_answer}\n")
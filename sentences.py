@@ -0,0 +1,21 @@
+import re
+
+# Where one sentence ends and the next begins. The streamed OpenAi answers (openai_chat.py) and the subtitles (subtitle_alignment.py)
+# both split text here, so the subtitles always line up with the streamed clips.
+
+# The punctuation that ends a sentence
+SENTENCE_END_CHARACTERS = ".!?"
+# Matches the end of a sentence: punctuation (plus any closing quotes/brackets) followed by whitespace
+SENTENCE_END_REGEX = re.compile(r'([.!?]+["\')\]]*)\s+')
+
+# Splits streamed text into the sentences that are complete so far.
+# Returns the list of complete sentences, plus the leftover text that hasn't finished its sentence yet.
+def split_complete_sentences(text):
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_REGEX.finditer(text):
+        sentence = text[start:match.end(1)].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    return sentences, text[start:]
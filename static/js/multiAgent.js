@@ -5,25 +5,43 @@ $(document).ready(function() {
 
     var socket = io();
 
-    socket.on('start_agent', function(msg, cb) {
-        console.log("Got data: " + msg)
+    // What's on screen for each agent: the timers for the sentences we haven't shown yet, and the animation of the current sentence.
+    // The old animation is always stopped and removed before a new one starts, otherwise anime.js keeps every old (looping) animation running forever,
+    // and after a few hours of streaming the OBS browser source eats a whole CPU core.
+    var agents = {};
 
-        $('#agent-container-' + msg.agent_id).animate({ opacity: 1 }, 500);
+    function getAgent(agentId) {
+        if (!agents[agentId])
+            agents[agentId] = { timers: [], animation: null, letters: null };
+        return agents[agentId];
+    }
 
-        if (cb)
-            cb();
-    });
+    function clearTimers(agent) {
+        agent.timers.forEach(timer => clearTimeout(timer));
+        agent.timers = [];
+    }
+
+    function stopAnimation(agent) {
+        if (agent.animation) {
+            agent.animation.pause();
+            anime.remove(agent.letters);
+        }
+        agent.animation = null;
+        agent.letters = null;
+    }
+
+    // Shows one sentence, with every letter bobbing up and down
+    function showSentence(agentId, text) {
+        let agent = getAgent(agentId);
+        stopAnimation(agent);
+
+        $("#agent-text-" + agentId).text(text)
 
-    // Updates each sentence
-    socket.on('agent_message', function(msg, cb) {
-        
-        $("#agent-text-" + msg.agent_id).text(msg.text)
-        
         // Note that openAiAnimation is NOT a const variable
-        let openAiAnimation = new Letterize({targets: "#agent-text-" + msg.agent_id, className: "agent-letter"});
+        let openAiAnimation = new Letterize({targets: "#agent-text-" + agentId, className: "agent-letter"});
 
         // Now we've turned every letter into its own span, we group all of the letter spans into "word" elements, so that the word elements can wrap around multiple lines appropriately
-        let $openaiText = $('#agent-text-' + msg.agent_id); // Get the openai-text container
+        let $openaiText = $('#agent-text-' + agentId); // Get the openai-text container
         let $letters = $openaiText.find('.agent-letter'); // Get all the letter spans inside the openai_text container
         let $newContent = $('<div></div>'); // Create a new jQuery object to hold the new structure
         let $wordSpan = $('<span class="agent-word"></span>'); // Create a new word span to start with
@@ -41,14 +59,57 @@ $(document).ready(function() {
         $newContent.append($wordSpan); // Append the last word span to the new content
         $openaiText.empty().append($newContent.contents()); // Clear the openai_text container and append the new content
 
-        var animation = anime.timeline({
-            targets: openAiAnimation.listAll,
+        agent.letters = openAiAnimation.listAll;
+        agent.animation = anime.timeline({
+            targets: agent.letters,
             delay: anime.stagger(30),
             loop: true
         });
-        animation
+        agent.animation
             .add({translateY: -2, duration: 1000})
             .add({translateY: 0, duration: 1000});
+    }
+
+    // Only receive the messages for the room this page belongs to
+    socket.on('connect', function() {
+        socket.emit('join_room', {room: $('body').attr('data-room')});
+    });
+
+    socket.on('start_agent', function(msg, cb) {
+        console.log("Got data: " + msg)
+
+        $('#agent-container-' + msg.agent_id).stop(true).animate({ opacity: 1 }, 500);
+
+        if (cb)
+            cb();
+    });
+
+    // The whole subtitle track of a clip, sent the moment the clip starts playing:
+    // {agent_id: 1, started_at: 1718035200.52, subtitles: [{text: 'here is my speech', start_time: 0.0, end_time: 3.16}, ...]}
+    // Each sentence is shown at its start_time, counted from when the clip started.
+    socket.on('agent_subtitles', function(msg, cb) {
+        let agent = getAgent(msg.agent_id);
+        clearTimers(agent);
+
+        // How long the message took to get here. Capped, in case the browser's clock doesn't match the server's.
+        let elapsed = msg.started_at ? Math.min(Math.max(Date.now() / 1000 - msg.started_at, 0), 1) : 0;
+        msg.subtitles.forEach(function(subtitle, i) {
+            // Skip any sentence that's already over by the time we got the message
+            let nextStart = i + 1 < msg.subtitles.length ? msg.subtitles[i + 1].start_time : Infinity;
+            if (nextStart <= elapsed)
+                return;
+            let delay = Math.max(subtitle.start_time - elapsed, 0) * 1000;
+            agent.timers.push(setTimeout(() => showSentence(msg.agent_id, subtitle.text), delay));
+        });
+
+        if (cb)
+            cb();
+    });
+
+    // Shows one sentence straight away
+    socket.on('agent_message', function(msg, cb) {
+        clearTimers(getAgent(msg.agent_id));
+        showSentence(msg.agent_id, msg.text);
 
         if (cb)
             cb();
@@ -57,9 +118,12 @@ $(document).ready(function() {
     socket.on('clear_agent', function (msg, cb) {
         console.log("Client received clear message instruction!")
 
-        $('#agent-container-' + msg.agent_id).animate({ opacity: 0 }, 500);
+        let agent = getAgent(msg.agent_id);
+        clearTimers(agent);
+        // Stop the letters moving once they've faded out, so nothing keeps animating while the agent is hidden
+        $('#agent-container-' + msg.agent_id).stop(true).animate({ opacity: 0 }, 500, () => stopAnimation(agent));
 
         if (cb)
             cb();
     });
-});
\ No newline at end of file
+});
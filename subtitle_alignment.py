@@ -0,0 +1,100 @@
+from rich import print
+from sentences import split_complete_sentences, SENTENCE_END_CHARACTERS
+
+class SubtitleAligner:
+
+    # Creates sentence subtitles for TTS audio that we generated ourselves.
+    # We already know the text, so instead of running Whisper on the audio we just need to work out when each sentence is spoken.
+    # The output matches WhisperManager.audio_to_text(file, "sentence"), a list of dictionaries like:
+    # {'text': 'here is my speech', 'start_time': 11.58, 'end_time': 14.74}
+    #
+    # There are three ways of getting the timing, from best to worst:
+    # 1) ElevenLabs character timestamps (exact, and free if you use text_to_audio_with_timestamps)
+    # 2) The audio file's duration, spread across the sentences based on how long each one is
+    # 3) Whisper (slow, especially on CPU). Only used if the other two aren't possible.
+
+    def __init__(self, audio_manager=None, whisper_manager=None):
+        self.audio_manager = audio_manager # Used to get the length of an audio file
+        self.whisper_manager = whisper_manager # Optional fallback
+        # Pause that we assume happens inbetween two sentences, as a fraction of the total audio length (capped at sentence_gap_max seconds)
+        self.sentence_gap_fraction = 0.05
+        self.sentence_gap_max = 0.3
+
+    # Split text into sentences. Uses the same splitting as the streamed OpenAi answers, so subtitles line up with the streamed clips.
+    def split_sentences(self, text):
+        sentences, leftover_text = split_complete_sentences(text)
+        if leftover_text.strip():
+            sentences.append(leftover_text.strip())
+        return sentences
+
+    # Returns the sentence subtitles for a TTS audio clip, using the best timing information we have
+    def get_subtitles(self, text, audio_file=None, alignment=None, audio_duration=None):
+        if alignment:
+            try:
+                subtitles = self.align_with_character_timestamps(alignment)
+                if subtitles:
+                    return subtitles
+            except (KeyError, IndexError, TypeError) as e:
+                print(f"[red]Couldn't use the character timestamps for subtitles: {e}")
+
+        if audio_duration is None and audio_file is not None and self.audio_manager is not None:
+            audio_duration = self.audio_manager.get_audio_length(audio_file)
+        if audio_duration:
+            return self.align_with_duration(text, audio_duration)
+
+        if audio_file is not None and self.whisper_manager is not None:
+            print("[yellow]No timing information for subtitles, falling back to Whisper")
+            return self.whisper_manager.audio_to_text(audio_file, "sentence")
+
+        # We don't know anything about the timing, so just show the whole text at once
+        return [{'text': text, 'start_time': 0, 'end_time': 0}]
+
+    # Spreads the sentences across the audio, giving each sentence time based on how many characters it has
+    def align_with_duration(self, text, audio_duration):
+        sentences = self.split_sentences(text)
+        if not sentences:
+            return []
+        gap = 0
+        if len(sentences) > 1:
+            gap = min(self.sentence_gap_max, audio_duration * self.sentence_gap_fraction)
+        speaking_time = audio_duration - gap * (len(sentences) - 1)
+        total_characters = sum(len(sentence) for sentence in sentences)
+
+        subtitles = []
+        current_time = 0
+        for sentence in sentences:
+            sentence_duration = speaking_time * len(sentence) / total_characters
+            subtitles.append({'text': sentence, 'start_time': round(current_time, 2), 'end_time': round(current_time + sentence_duration, 2)})
+            current_time += sentence_duration + gap
+        return subtitles
+
+    # Uses the character timestamps from ElevenLabs to get the exact start and end time of each sentence.
+    # The alignment looks like: {'characters': ['H', 'i', '.'], 'character_start_times_seconds': [0.0, 0.1, 0.2], 'character_end_times_seconds': [0.1, 0.2, 0.3]}
+    def align_with_character_timestamps(self, alignment):
+        characters = alignment['characters']
+        start_times = alignment['character_start_times_seconds']
+        end_times = alignment['character_end_times_seconds']
+
+        subtitles = []
+        sentence_text = ""
+        sentence_start = None
+        sentence_end = None
+        for i, character in enumerate(characters):
+            # Don't start a sentence on whitespace
+            if sentence_start is None and character.isspace():
+                continue
+            if sentence_start is None:
+                sentence_start = start_times[i]
+            sentence_text += character
+            sentence_end = end_times[i]
+
+            # A sentence ends on punctuation (plus any closing quotes/brackets) that is followed by whitespace
+            next_character = characters[i+1] if i+1 < len(characters) else " "
+            last_character = sentence_text.rstrip("\"')]")[-1:]
+            if next_character.isspace() and last_character and last_character in SENTENCE_END_CHARACTERS:
+                subtitles.append({'text': sentence_text.strip(), 'start_time': sentence_start, 'end_time': sentence_end})
+                sentence_text = ""
+                sentence_start = None
+        if sentence_text.strip():
+            subtitles.append({'text': sentence_text.strip(), 'start_time': sentence_start, 'end_time': sentence_end})
+        return subtitles
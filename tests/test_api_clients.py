@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from api_clients import APIClients
+
+# Like the errors the OpenAi and ElevenLabs clients raise for an HTTP error: the status code is on the error or on its response
+class FakeStatusError(Exception):
+
+    def __init__(self, status_code, headers=None, on_response=False):
+        super().__init__(f"HTTP {status_code}")
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+        if not on_response:
+            self.status_code = status_code
+
+# Fails with each of the given errors in turn, then returns "done"
+class FlakyFunction():
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+    async def call_async(self, **kwargs):
+        return self(**kwargs)
+
+# Stand-in for a streamed response, it only remembers being closed
+class FakeStream():
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeAsyncStream(FakeStream):
+
+    async def close(self):
+        self.closed = True
+
+def make_api_clients(max_retries=3, deadline=90, timeout=30):
+    return APIClients({
+        "openai": {"max_concurrent": 2, "timeout": timeout, "connect_timeout": 5, "max_retries": max_retries, "deadline": deadline, "timeout_argument": "timeout"},
+        "elevenlabs": {"max_concurrent": 2, "timeout": timeout, "connect_timeout": 5, "max_retries": max_retries, "deadline": deadline, "timeout_argument": "request_options"},
+    })
+
+class TestRetryDelay(unittest.TestCase):
+
+    def setUp(self):
+        self.api_clients = make_api_clients()
+
+    def test_rate_limits_server_errors_and_dropped_connections_are_retried(self):
+        for error in (FakeStatusError(429), FakeStatusError(500), FakeStatusError(503, on_response=True), httpx.ConnectError("connection refused")):
+            self.assertIsNotNone(self.api_clients.get_retry_delay(error, 0), error)
+
+    def test_mistakes_on_our_side_are_not_retried(self):
+        for error in (FakeStatusError(400), FakeStatusError(401), FakeStatusError(404, on_response=True), ValueError("bad argument")):
+            self.assertIsNone(self.api_clients.get_retry_delay(error, 0), error)
+
+    def test_backoff_doubles_with_each_attempt(self):
+        for attempt in range(4):
+            delay = self.api_clients.get_retry_delay(FakeStatusError(500), attempt)
+            self.assertGreaterEqual(delay, 0.5 * (2 ** attempt) * 0.75)
+            self.assertLessEqual(delay, 0.5 * (2 ** attempt) * 1.25)
+
+    def test_retry_after_header_wins_but_is_capped(self):
+        self.assertEqual(self.api_clients.get_retry_delay(FakeStatusError(429, {"retry-after": "2"}), 0), 2)
+        self.assertEqual(self.api_clients.get_retry_delay(FakeStatusError(429, {"retry-after": "600"}), 0), 30)
+        # A date instead of a number of seconds falls back to the usual backoff
+        self.assertLess(self.api_clients.get_retry_delay(FakeStatusError(429, {"retry-after": "Wed, 21 Oct 2026 07:28:00 GMT"}), 0), 1)
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.api_clients = make_api_clients()
+        # No waiting between attempts
+        self.api_clients.get_retry_delay = lambda error, attempt: None if isinstance(error, ValueError) else 0
+
+    def test_retries_until_it_works(self):
+        function = FlakyFunction(FakeStatusError(500), httpx.ConnectError("connection refused"))
+        self.assertEqual(self.api_clients.call("openai", function), "done")
+        self.assertEqual(len(function.calls), 3)
+
+    def test_gives_up_after_max_retries(self):
+        function = FlakyFunction(*[FakeStatusError(500) for _ in range(10)])
+        with self.assertRaises(FakeStatusError):
+            self.api_clients.call("openai", function)
+        self.assertEqual(len(function.calls), 4)
+
+    def test_errors_that_arent_worth_retrying_are_raised_straight_away(self):
+        function = FlakyFunction(ValueError("bad argument"))
+        with self.assertRaises(ValueError):
+            self.api_clients.call("openai", function)
+        self.assertEqual(len(function.calls), 1)
+
+    def test_no_retry_if_the_wait_would_go_past_the_deadline(self):
+        api_clients = make_api_clients(deadline=1)
+        api_clients.get_retry_delay = lambda error, attempt: 5
+        function = FlakyFunction(FakeStatusError(500))
+        start = time.time()
+        with self.assertRaises(FakeStatusError):
+            api_clients.call("openai", function)
+        self.assertEqual(len(function.calls), 1)
+        self.assertLess(time.time() - start, 1)
+
+    def test_async_retries_until_it_works(self):
+        function = FlakyFunction(FakeStatusError(429))
+        self.assertEqual(asyncio.run(self.api_clients.call_async("openai", function.call_async)), "done")
+        self.assertEqual(len(function.calls), 2)
+
+class TestTimeouts(unittest.TestCase):
+
+    def test_each_attempt_gets_what_is_left_of_the_deadline(self):
+        api_clients = make_api_clients(deadline=10, timeout=30)
+        function = FlakyFunction()
+        api_clients.call("openai", function)
+        self.assertLessEqual(function.calls[0]["timeout"].read, 10)
+        self.assertGreater(function.calls[0]["timeout"].read, 9)
+        self.assertEqual(function.calls[0]["timeout"].connect, 5)
+
+    def test_usual_timeout_when_the_deadline_is_further_away(self):
+        api_clients = make_api_clients(deadline=90, timeout=30)
+        function = FlakyFunction()
+        api_clients.call("openai", function)
+        self.assertEqual(function.calls[0]["timeout"].read, 30)
+
+    def test_elevenlabs_gets_whole_seconds_in_its_request_options(self):
+        api_clients = make_api_clients(deadline=2.5, timeout=30)
+        function = FlakyFunction()
+        api_clients.call("elevenlabs", function, request_options={"max_retries": 0})
+        self.assertEqual(function.calls[0]["request_options"], {"max_retries": 0, "timeout_in_seconds": 3})
+
+class TestLateStreams(unittest.TestCase):
+
+    def test_stream_is_closed_at_the_deadline(self):
+        api_clients = make_api_clients(deadline=0.1)
+        stream = FakeStream()
+        with api_clients.open_stream("openai", lambda timeout: stream) as opened_stream:
+            self.assertIs(opened_stream, stream)
+            time.sleep(0.3)
+            self.assertTrue(stream.closed)
+
+    def test_stream_that_finishes_in_time_is_left_alone(self):
+        api_clients = make_api_clients(deadline=0.2)
+        stream = FakeStream()
+        with api_clients.open_stream("openai", lambda timeout: stream):
+            pass
+        time.sleep(0.3)
+        self.assertFalse(stream.closed)
+
+    def test_async_stream_is_closed_at_the_deadline(self):
+        api_clients = make_api_clients(deadline=0.1)
+        stream = FakeAsyncStream()
+        async def open_stream(timeout):
+            return stream
+        async def read_slowly():
+            async with api_clients.open_stream_async("openai", open_stream):
+                await asyncio.sleep(0.3)
+        asyncio.run(read_slowly())
+        self.assertTrue(stream.closed)
+
+    def test_close_late_stream_survives_a_broken_stream(self):
+        def close():
+            raise OSError("already closed")
+        make_api_clients().close_late_stream("openai", SimpleNamespace(close=close))
+
+if __name__ == "__main__":
+    unittest.main()
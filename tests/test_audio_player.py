@@ -0,0 +1,63 @@
+import os
+import sys
+import asyncio
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Play everything through SDL's silent driver, so the tests don't need speakers
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from audio_clip import AudioClip
+from audio_player import AudioManager, PlaybackItem
+from benchmark import make_silent_mp3
+
+class TestPlaybackQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.audio_manager = AudioManager()
+
+    def tearDown(self):
+        self.audio_manager.remove_playback_queue("test")
+
+    def test_plays_clips_one_after_another(self):
+        items = [self.audio_manager.queue_clip(AudioClip(make_silent_mp3(0.1)), "test") for _ in range(3)]
+        self.assertTrue(items[-1].wait_until_finished(5))
+        for earlier, later in zip(items, items[1:]):
+            self.assertLessEqual(earlier.finished_at, later.started_at)
+
+    def test_skips_a_clip_that_cant_be_decoded(self):
+        bad_item = self.audio_manager.queue_clip(AudioClip(b""), "test")
+        good_item = self.audio_manager.queue_clip(AudioClip(make_silent_mp3(0.1)), "test")
+        self.assertTrue(bad_item.wait_until_finished(5))
+        self.assertTrue(bad_item.started.is_set())
+        # The playback thread is still alive, so the clip after it plays as usual
+        self.assertTrue(good_item.wait_until_finished(5))
+        self.assertIsNotNone(good_item.sound)
+
+    def test_removing_the_queue_finishes_every_clip(self):
+        items = [self.audio_manager.queue_clip(AudioClip(make_silent_mp3(1)), "test") for _ in range(3)]
+        self.assertTrue(items[0].started.wait(5))
+        self.audio_manager.remove_playback_queue("test")
+        for item in items:
+            self.assertTrue(item.finished.is_set())
+
+class TestPlaybackItem(unittest.TestCase):
+
+    def test_wait_until_finished_gives_up_after_the_timeout(self):
+        item = PlaybackItem(AudioClip(b""))
+        self.assertFalse(item.wait_until_finished(0.05))
+        item.mark_finished()
+        self.assertTrue(item.wait_until_finished(0.05))
+
+    def test_wait_until_finished_async_gives_up_after_the_timeout(self):
+        item = PlaybackItem(AudioClip(b""))
+        self.assertFalse(asyncio.run(item.wait_until_finished_async(0.05)))
+
+        async def finish_soon():
+            asyncio.get_running_loop().call_later(0.05, item.mark_finished)
+            return await item.wait_until_finished_async(5)
+        self.assertTrue(asyncio.run(finish_soon()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_journal import ChatJournal
+
+def make_message(i):
+    return {"role": "user", "content": f"[OSWALD] line {i}"}
+
+class TestChatJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.backup_file = os.path.join(self.temp_directory.name, "backup_history.txt")
+
+    def tearDown(self):
+        self.temp_directory.cleanup()
+
+    # Appends messages to chat_history through the journal, the way OpenAiManager and ConversationLog do
+    def append(self, journal, chat_history, messages):
+        for message in messages:
+            chat_history.append(message)
+            journal.record_append(message, chat_history)
+
+    def test_restores_appends_and_pops(self):
+        journal = ChatJournal(self.backup_file)
+        chat_history = []
+        self.append(journal, chat_history, [make_message(i) for i in range(5)])
+        chat_history.pop(1)
+        journal.record_pop(1, chat_history)
+        journal.flush()
+        self.assertFalse(os.path.exists(self.backup_file))
+        self.assertEqual(ChatJournal(self.backup_file).load(), chat_history)
+
+    def test_compacts_into_the_backup_file(self):
+        journal = ChatJournal(self.backup_file, compact_every=10)
+        chat_history = []
+        self.append(journal, chat_history, [make_message(i) for i in range(25)])
+        journal.flush()
+        with open(self.backup_file) as f:
+            self.assertEqual(len(json.load(f)["messages"]), 20)
+        # Only the records since the last compaction are left in the journal
+        with open(journal.journal_file) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        restored_journal = ChatJournal(self.backup_file, compact_every=10)
+        self.assertEqual(restored_journal.load(), chat_history)
+        self.assertEqual(restored_journal.generation, journal.generation)
+
+    def test_a_crash_before_the_journal_is_deleted_doesnt_duplicate_messages(self):
+        journal = ChatJournal(self.backup_file)
+        chat_history = []
+        self.append(journal, chat_history, [make_message(i) for i in range(5)])
+        journal.compact(chat_history)
+        journal.flush()
+        self.append(journal, chat_history, [make_message(i) for i in range(5, 8)])
+        journal.flush()
+        old_journal = journal.journal_file + ".old"
+        shutil.copy(journal.journal_file, old_journal)
+        journal.compact(chat_history)
+        journal.flush()
+        # Act like we crashed after the new backup file was swapped in, but before the journal was deleted
+        shutil.copy(old_journal, journal.journal_file)
+        restored_journal = ChatJournal(self.backup_file)
+        self.assertEqual(restored_journal.load(), chat_history)
+
+        # Anything journaled after restarting is kept, and the stale records are still skipped
+        restored_history = list(chat_history)
+        self.append(restored_journal, restored_history, [make_message(8)])
+        restored_journal.flush()
+        self.assertEqual(ChatJournal(self.backup_file).load(), restored_history)
+
+    def test_loads_backups_from_before_generations(self):
+        with open(self.backup_file, "w") as f:
+            json.dump([make_message(0), make_message(1)], f)
+        with open(f"{self.backup_file}.journal", "w") as f:
+            f.write(json.dumps({"op": "append", "message": make_message(2)}) + "\n")
+            f.write(json.dumps({"op": "pop", "index": 0}) + "\n")
+        journal = ChatJournal(self.backup_file)
+        self.assertEqual(journal.load(), [make_message(1), make_message(2)])
+        self.assertEqual(journal.generation, 0)
+
+    def test_skips_a_line_that_was_cut_off(self):
+        journal = ChatJournal(self.backup_file)
+        chat_history = []
+        self.append(journal, chat_history, [make_message(i) for i in range(3)])
+        journal.flush()
+        with open(journal.journal_file, "a") as f:
+            f.write('{"op": "append", "mess')
+        self.assertEqual(ChatJournal(self.backup_file).load(), chat_history)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_clients
+from conversation_log import ConversationLog
+from openai_chat import OpenAiManager
+from benchmark import FakeAPIClients, LatencyDistribution, DEFAULT_LATENCIES
+
+LINE = "I once raced a goose in Mario Kart and the goose won the whole cup."
+
+class ConversationLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.original_api_clients = api_clients.api_clients
+        api_clients.api_clients = FakeAPIClients({name: LatencyDistribution(0, 0) for name in DEFAULT_LATENCIES})
+
+    def tearDown(self):
+        api_clients.api_clients = self.original_api_clients
+        self.temp_directory.cleanup()
+
+    def get_path(self, file_name):
+        return os.path.join(self.temp_directory.name, file_name)
+
+    # An agent's view of the log, with a history limit small enough to trim after a few lines
+    def make_view(self, conversation_log, speaker_name, max_history_tokens):
+        view = OpenAiManager({"role": "system", "content": "You are a pepper."}, conversation_log=conversation_log, speaker_name=speaker_name)
+        view.logging = False
+        view.max_history_tokens = max_history_tokens
+        view.trim_block_tokens = max_history_tokens // 2
+        return view
+
+class TestDroppingOldLines(ConversationLogTestCase):
+
+    def test_lines_every_view_has_trimmed_are_dropped(self):
+        conversation_log = ConversationLog(self.get_path("log.txt"))
+        line_tokens = conversation_log.create_entry("OSWALD", LINE)['listener_tokens']
+        views = [self.make_view(conversation_log, "OSWALD", line_tokens * 10), self.make_view(conversation_log, "VICTORIA", line_tokens * 20)]
+        for i in range(60):
+            conversation_log.add_message("OSWALD" if i % 2 else "VICTORIA", LINE)
+            for view in views:
+                view.prepare_chat_history()
+
+        self.assertEqual(len(conversation_log), 60)
+        self.assertGreater(conversation_log.first_index, 0)
+        # Only the lines that the view with the longest history still has are kept
+        self.assertEqual(conversation_log.first_index, min(view.get_conversation_log_start() for view in views))
+        self.assertEqual(len(conversation_log.get_entries()), 60 - conversation_log.first_index)
+        for view in views:
+            self.assertEqual(view.conversation_log_position, 60)
+            self.assertEqual(len(view.chat_history) - 1, 60 - view.get_conversation_log_start())
+
+        # New lines still reach every view, and the indexes keep counting up
+        self.assertEqual(conversation_log.add_message("OSWALD", "One more."), 60)
+        self.assertEqual(conversation_log.get_entries(60)[0]['text'], "One more.")
+        for view in views:
+            view.prepare_chat_history()
+            self.assertEqual(view.chat_history[-1]['content'], "One more." if view.speaker_name == "OSWALD" else "[OSWALD] One more.")
+        # Finish writing before the temp folder is removed
+        conversation_log.flush()
+
+    def test_nothing_is_dropped_until_every_view_has_trimmed(self):
+        conversation_log = ConversationLog()
+        line_tokens = conversation_log.create_entry("OSWALD", LINE)['listener_tokens']
+        trimming_view = self.make_view(conversation_log, "OSWALD", line_tokens * 10)
+        self.make_view(conversation_log, "VICTORIA", line_tokens * 1000)
+        for _ in range(40):
+            conversation_log.add_message("VICTORIA", LINE)
+            trimming_view.prepare_chat_history()
+        self.assertGreater(trimming_view.get_conversation_log_start(), 0)
+        # The other view hasn't even read the log yet
+        self.assertEqual(conversation_log.first_index, 0)
+        self.assertEqual(len(conversation_log.get_entries()), 40)
+
+    def test_the_backup_file_only_keeps_the_lines_that_are_left(self):
+        conversation_log = ConversationLog(self.get_path("log.txt"))
+        line_tokens = conversation_log.create_entry("OSWALD", LINE)['listener_tokens']
+        view = self.make_view(conversation_log, "OSWALD", line_tokens * 10)
+        for i in range(40):
+            conversation_log.add_message("VICTORIA", f"{LINE} {i}")
+            view.prepare_chat_history()
+        conversation_log.flush()
+
+        restored_log = ConversationLog(self.get_path("log.txt"))
+        self.assertEqual([entry['text'] for entry in restored_log.get_entries()], [entry['text'] for entry in conversation_log.get_entries()])
+        self.assertLess(len(restored_log), 40)
+
+class TestLegacyBackups(ConversationLogTestCase):
+
+    def write_legacy_backup(self, file_name, chat_history):
+        with open(self.get_path(file_name), "w") as f:
+            json.dump(chat_history, f)
+        return self.get_path(file_name)
+
+    def test_rebuilds_the_conversation_from_the_first_backup_that_exists(self):
+        oswald_backup = self.write_legacy_backup("backup_history_OSWALD.txt", [
+            {"role": "system", "content": "You are Oswald."},
+            {"role": "user", "content": "[VICTORIA] Hello there."},
+            {"role": "user", "content": [{"type": "text", "text": "Okay what is your response?"}]},
+            {"role": "assistant", "content": "Hi Victoria."},
+            {"role": "user", "content": "[TONY KING OF NEW YORK] Fuhgeddaboudit."},
+        ])
+        victoria_backup = self.write_legacy_backup("backup_history_VICTORIA.txt", [
+            {"role": "system", "content": "You are Victoria."},
+            {"role": "assistant", "content": "Something else entirely."},
+        ])
+        legacy_backups = [("TONY KING OF NEW YORK", self.get_path("missing.txt")), ("OSWALD", oswald_backup), ("VICTORIA", victoria_backup)]
+        conversation_log = ConversationLog(self.get_path("log.txt"), legacy_backups)
+
+        # Tony never had a backup, so Oswald's is used. The system prompt and the "what is your response" prompts aren't part of the conversation.
+        self.assertEqual([(entry['speaker'], entry['text']) for entry in conversation_log.get_entries()], [
+            ("VICTORIA", "Hello there."),
+            ("OSWALD", "Hi Victoria."),
+            ("TONY KING OF NEW YORK", "Fuhgeddaboudit."),
+        ])
+
+        # The rebuilt conversation is saved in the new format, so the old backups aren't needed next time
+        conversation_log.flush()
+        os.remove(oswald_backup)
+        restored_log = ConversationLog(self.get_path("log.txt"), legacy_backups)
+        self.assertEqual([entry['message'] for entry in restored_log.get_entries()], [entry['message'] for entry in conversation_log.get_entries()])
+
+    def test_the_log_file_wins_over_legacy_backups(self):
+        legacy_backup = self.write_legacy_backup("backup_history_OSWALD.txt", [{"role": "assistant", "content": "Old line."}])
+        conversation_log = ConversationLog(self.get_path("log.txt"))
+        conversation_log.add_message("VICTORIA", "New line.")
+        conversation_log.flush()
+        restored_log = ConversationLog(self.get_path("log.txt"), [("OSWALD", legacy_backup)])
+        self.assertEqual([entry['text'] for entry in restored_log.get_entries()], ["New line."])
+
+if __name__ == "__main__":
+    unittest.main()
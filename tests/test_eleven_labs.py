@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_clients
+from eleven_labs import ElevenLabsManager
+from benchmark import FakeAPIClients, LatencyDistribution, DEFAULT_LATENCIES, DEFAULT_AGENTS
+
+# The real ElevenLabsManager on top of the benchmark's fake ElevenLabs client, in a temporary folder so the real caches aren't touched
+class ElevenLabsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.temp_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_directory.name)
+        self.original_api_clients = api_clients.api_clients
+        api_clients.api_clients = FakeAPIClients({name: LatencyDistribution(0, 0) for name in DEFAULT_LATENCIES})
+        self.fake_elevenlabs = api_clients.api_clients.fake_elevenlabs
+        self.requests = []
+        generate = self.fake_elevenlabs.generate
+        def count_generate(**kwargs):
+            self.requests.append(kwargs["text"])
+            return generate(**kwargs)
+        self.fake_elevenlabs.generate = count_generate
+        self.manager = ElevenLabsManager()
+        self.voice = DEFAULT_AGENTS[0]["voice"]
+
+    def tearDown(self):
+        api_clients.api_clients = self.original_api_clients
+        os.chdir(self.original_directory)
+        self.temp_directory.cleanup()
+
+class TestTTSCacheInElevenLabsManager(ElevenLabsTestCase):
+
+    def test_the_same_line_is_only_generated_once(self):
+        first_clip = self.manager.text_to_audio_clip("Hello there.", self.voice)
+        second_clip = self.manager.text_to_audio_clip("Hello there.", self.voice)
+        self.assertEqual(first_clip.data, second_clip.data)
+        self.assertEqual(self.requests, ["Hello there."])
+
+    def test_a_cached_file_deleted_from_disk_is_generated_again(self):
+        clip = self.manager.text_to_audio_clip("Hello there.", self.voice)
+        os.remove(clip.file_path)
+        clip = self.manager.text_to_audio_clip("Hello there.", self.voice)
+        self.assertTrue(clip.data)
+        self.assertTrue(os.path.exists(clip.file_path))
+        self.assertEqual(self.requests, ["Hello there.", "Hello there."])
+
+    def test_a_deleted_timestamps_file_is_generated_again(self):
+        clip, alignment = self.manager.text_to_audio_clip_with_timestamps("Hello there.", self.voice)
+        os.remove(clip.file_path)
+        clip, alignment = self.manager.text_to_audio_clip_with_timestamps("Hello there.", self.voice)
+        self.assertTrue(os.path.exists(clip.file_path))
+        self.assertEqual(alignment["characters"], list("Hello there."))
+        stats = self.manager.tts_cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (0, 2))
+
+class TestFileBasedTTS(ElevenLabsTestCase):
+
+    def test_text_to_audio_saves_a_copy_in_the_subdirectory(self):
+        os.makedirs("clips")
+        file_path = self.manager.text_to_audio("Hello there.", self.voice, save_as_wave=False, subdirectory="clips")
+        self.assertEqual(os.path.dirname(file_path), os.path.abspath("clips"))
+        # The caller owns the file, so deleting it (like play_audio(delete_file=True) does) leaves the cache alone
+        os.remove(file_path)
+        file_path = self.manager.text_to_audio("Hello there.", self.voice, save_as_wave=False, subdirectory="clips")
+        self.assertTrue(os.path.exists(file_path))
+        self.assertEqual(self.manager.tts_cache.get_stats()["hits"], 1)
+        self.assertEqual(self.requests, ["Hello there."])
+
+    def test_text_to_audio_with_timestamps_saves_a_copy_in_the_subdirectory(self):
+        os.makedirs("clips")
+        for _ in range(2):
+            file_path, alignment = self.manager.text_to_audio_with_timestamps("Hello there.", self.voice, subdirectory="clips")
+            self.assertEqual(os.path.dirname(file_path), os.path.abspath("clips"))
+            self.assertEqual(alignment["characters"], list("Hello there."))
+            os.remove(file_path)
+        self.assertEqual(self.manager.tts_cache.get_stats()["hits"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from latency_trace import LatencyTracer, summarize_spans, get_percentile, get_rotated_file
+
+class TestSummary(unittest.TestCase):
+
+    def test_percentiles_interpolate_between_the_closest_values(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(get_percentile(values, 50), 50.5)
+        self.assertAlmostEqual(get_percentile(values, 95), 95.05)
+        self.assertEqual(get_percentile(values, 100), 100)
+        self.assertEqual(get_percentile([7.0], 95), 7.0)
+
+    def test_summarizes_each_stage_separately(self):
+        spans = [{"name": "llm", "duration_ms": float(i)} for i in range(100, 0, -1)] + [{"name": "tts", "duration_ms": 300.0}]
+        self.assertEqual(summarize_spans(spans), {
+            "llm": {"count": 100, "p50_ms": 50.5, "p95_ms": 95.0, "max_ms": 100.0},
+            "tts": {"count": 1, "p50_ms": 300.0, "p95_ms": 300.0, "max_ms": 300.0},
+        })
+
+    def test_summary_only_covers_the_most_recent_spans(self):
+        tracer = LatencyTracer(None, max_recent_spans=10)
+        for i in range(100):
+            tracer.record("llm", time.time(), i)
+        self.assertEqual(tracer.get_summary()["llm"]["count"], 10)
+        self.assertEqual(tracer.get_summary()["llm"]["p50_ms"], 94.5)
+
+    def test_spans_are_timed_and_grouped_by_trace_id(self):
+        tracer = LatencyTracer(None)
+        trace_id = tracer.new_trace_id("OSWALD")
+        with tracer.span("tts", trace_id, characters=12):
+            time.sleep(0.05)
+        with tracer.lock(threading.Lock(), "conversation_lock", trace_id):
+            pass
+        self.assertEqual([span["name"] for span in tracer.recent_spans], ["tts", "wait_conversation_lock"])
+        self.assertTrue(all(span["trace_id"] == trace_id for span in tracer.recent_spans))
+        self.assertGreaterEqual(tracer.recent_spans[0]["duration_ms"], 40)
+        self.assertEqual(tracer.recent_spans[0]["characters"], 12)
+
+    def test_disabled_tracer_records_nothing(self):
+        tracer = LatencyTracer(None, enabled=False)
+        with tracer.span("llm"):
+            pass
+        self.assertEqual(tracer.get_summary(), {})
+
+class TestTraceFile(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.trace_file = os.path.join(self.temp_directory.name, "latency_trace.jsonl")
+
+    def tearDown(self):
+        self.temp_directory.cleanup()
+
+    def read_spans(self, file_name):
+        with open(file_name, "r") as file:
+            return [json.loads(line) for line in file]
+
+    def test_every_span_is_written_to_the_file(self):
+        tracer = LatencyTracer(self.trace_file)
+        for i in range(5):
+            tracer.record("llm", time.time(), i, f"turn-{i}")
+        tracer.writer.flush()
+        self.assertEqual([span["trace_id"] for span in self.read_spans(self.trace_file)], [f"turn-{i}" for i in range(5)])
+
+    def test_full_file_is_rotated(self):
+        tracer = LatencyTracer(self.trace_file, max_file_bytes=1000)
+        for i in range(100):
+            tracer.record("llm", time.time(), i, f"turn-{i}")
+        tracer.writer.flush()
+        # Only the newest spans are kept, in two files of about max_file_bytes each
+        rotated_spans = self.read_spans(get_rotated_file(self.trace_file))
+        spans = self.read_spans(self.trace_file)
+        self.assertLess(os.path.getsize(self.trace_file), 1000 + 200)
+        self.assertLess(os.path.getsize(get_rotated_file(self.trace_file)), 1000 + 200)
+        self.assertEqual([span["trace_id"] for span in rotated_spans + spans], [f"turn-{i}" for i in range(100 - len(rotated_spans) - len(spans), 100)])
+
+    def test_counts_what_was_already_in_the_file(self):
+        with open(self.trace_file, "w") as file:
+            file.write(json.dumps({"trace_id": "old", "name": "llm", "start": 0, "duration_ms": 1}) + "\n" * 2000)
+        tracer = LatencyTracer(self.trace_file, max_file_bytes=1000)
+        tracer.record("llm", time.time(), 1, "new")
+        tracer.writer.flush()
+        self.assertEqual([span["trace_id"] for span in self.read_spans(self.trace_file)], ["new"])
+        self.assertTrue(os.path.exists(get_rotated_file(self.trace_file)))
+
+if __name__ == "__main__":
+    unittest.main()
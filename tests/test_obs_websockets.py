@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import logging
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obs_websockets import OBSWebsocketsManager, OBSDisconnected
+from fake_obs_server import FakeOBSServer
+
+# Waits until condition() is true, for up to timeout seconds
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+# Remembers when the supervisor tried to connect, so the backoff can be checked
+class RecordingOBSWebsocketsManager(OBSWebsocketsManager):
+
+    def __init__(self, **kwargs):
+        self.connect_attempts = []
+        super().__init__(**kwargs)
+
+    def connect(self):
+        self.connect_attempts.append(time.time())
+        super().connect()
+
+class TestOBSWebsocketsManager(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOBSServer()
+        self.port = self.server.port
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.disconnect()
+        self.server.stop()
+
+    def make_manager(self, **kwargs):
+        settings = {"host": "127.0.0.1", "port": self.port, "password": "", "request_timeout": 1, "batch_timeout": 1, "min_reconnect_delay": 0.05, "max_reconnect_delay": 0.4}
+        settings.update(kwargs)
+        manager = RecordingOBSWebsocketsManager(**settings)
+        self.managers.append(manager)
+        return manager
+
+    def test_connects_once_obs_starts(self):
+        manager = self.make_manager()
+        time.sleep(0.2)
+        self.assertEqual(manager.get_health()["state"], "connecting")
+        # get_ requests fail straight away while OBS isn't there
+        with self.assertRaises(OBSDisconnected):
+            manager.get_text("Subtitles")
+
+        self.server.start()
+        self.assertTrue(manager.wait_until_connected(5))
+        manager.set_text("Subtitles", "hello").result(2)
+        self.assertEqual(manager.get_text("Subtitles"), "hello")
+
+    def test_reconnects_after_obs_restarts_mid_show(self):
+        self.server.start()
+        manager = self.make_manager()
+        self.assertTrue(manager.wait_until_connected(5))
+        manager.set_filter_visibility("Line In", "Audio Move", True).result(2)
+
+        # OBS goes away mid-show
+        self.server.stop()
+        self.assertTrue(wait_for(lambda: manager.get_health()["state"] == "disconnected"))
+        held = [manager.set_filter_visibility("Line In", "Audio Move", visible) for visible in (False, True, False)]
+        self.assertTrue(wait_for(lambda: manager.get_health()["pending_requests"] == 3))
+        self.assertFalse(any(future.done() for future in held))
+        with self.assertRaises(OBSDisconnected):
+            manager.get_text("Subtitles")
+
+        # Once it's back, everything that was held is sent, in order
+        requests_before = len(self.server.received_requests)
+        self.server.start()
+        self.assertTrue(manager.wait_until_connected(5))
+        for future in held:
+            self.assertTrue(future.result(2).status)
+        self.assertEqual(self.server.received_requests[requests_before:], ["SetSourceFilterEnabled"] * 3)
+        self.assertEqual(manager.get_health()["pending_requests"], 0)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_drops_the_oldest_requests_when_too_many_are_held(self):
+        manager = self.make_manager(max_pending_requests=2)
+        futures = [manager.set_text("Subtitles", str(i)) for i in range(3)]
+        self.assertTrue(wait_for(lambda: manager.get_health()["dropped_requests"] == 1))
+        with self.assertRaises(OBSDisconnected):
+            futures[0].result(2)
+
+        self.server.start()
+        self.assertTrue(manager.wait_until_connected(5))
+        futures[1].result(2)
+        futures[2].result(2)
+        self.assertEqual(self.server.received_requests, ["SetInputSettings", "SetInputSettings"])
+        self.assertEqual(manager.get_text("Subtitles"), "2")
+
+    def test_reconnect_delay_doubles_up_to_the_max_and_resets_after_connecting(self):
+        manager = self.make_manager(min_reconnect_delay=0.05, max_reconnect_delay=0.2)
+        self.assertTrue(wait_for(lambda: len(manager.connect_attempts) >= 6))
+        gaps = [later - earlier for earlier, later in zip(manager.connect_attempts, manager.connect_attempts[1:])]
+        self.assertGreater(gaps[1], gaps[0] * 1.5)
+        self.assertGreater(gaps[2], gaps[1] * 1.5)
+        for gap in gaps[3:5]:
+            self.assertAlmostEqual(gap, 0.2, delta=0.1)
+
+        self.server.start()
+        self.assertTrue(manager.wait_until_connected(5))
+        self.assertEqual(manager.get_health()["reconnect_attempts"], 0)
+
+        # After a good connection, the first retry is quick again
+        self.server.stop()
+        self.assertTrue(wait_for(lambda: manager.get_health()["state"] == "disconnected"))
+        lost_at = time.time()
+        attempts = len(manager.connect_attempts)
+        self.assertTrue(wait_for(lambda: len(manager.connect_attempts) > attempts + 1))
+        self.assertLess(manager.connect_attempts[attempts + 1] - lost_at, 0.2)
+
+    def test_batches_requests_that_are_queued_together(self):
+        self.server.start()
+        manager = self.make_manager()
+        self.assertTrue(manager.wait_until_connected(5))
+        futures = [manager.set_filter_visibility("Line In", "Audio Move", i % 2 == 0) for i in range(20)]
+        for future in futures:
+            self.assertTrue(future.result(2).status)
+        self.assertEqual(len(self.server.received_requests), 20)
+        self.assertGreater(max(self.server.batch_sizes, default=0), 1)
+
+    def test_batches_dont_depend_on_logging(self):
+        # The batch answers used to be picked out of obs-websocket-py's log, so turning logging off made every batch time out
+        self.server.start()
+        manager = self.make_manager()
+        self.assertTrue(manager.wait_until_connected(5))
+        logging.disable(logging.CRITICAL)
+        try:
+            futures = [manager.set_text("Subtitles", str(i)) for i in range(20)]
+            for future in futures:
+                self.assertTrue(future.result(2).status)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertGreater(max(self.server.batch_sizes, default=0), 1)
+        self.assertEqual(manager.get_health()["state"], "connected")
+
+    def test_two_managers_each_get_their_own_batch_answers(self):
+        self.server.start()
+        managers = [self.make_manager(), self.make_manager()]
+        for manager in managers:
+            self.assertTrue(manager.wait_until_connected(5))
+        futures = [manager.set_text(f"Subtitles {i}", str(j)) for j in range(10) for i, manager in enumerate(managers)]
+        for future in futures:
+            self.assertTrue(future.result(2).status)
+        for manager in managers:
+            self.assertEqual(manager.get_health()["state"], "connected")
+
+    def test_scene_item_ids_are_looked_up_once(self):
+        self.server.start()
+        manager = self.make_manager()
+        self.assertTrue(manager.wait_until_connected(5))
+        for visible in (True, False, True):
+            manager.set_source_visibility("Main", "Pepper", visible).result(2)
+        self.assertEqual(self.server.received_requests.count("GetSceneItemId"), 1)
+        self.assertEqual(self.server.received_requests.count("SetSceneItemEnabled"), 3)
+
+    def test_scene_item_ids_are_forgotten_when_the_scenes_change(self):
+        self.server.start()
+        manager = self.make_manager()
+        self.assertTrue(manager.wait_until_connected(5))
+        manager.set_source_visibility("Main", "Pepper", True).result(2)
+
+        # A renamed scene can change any ID, so they're all looked up again
+        self.server.send_event("SceneNameChanged", {"oldSceneName": "Main", "sceneName": "Main 2"})
+        self.assertTrue(wait_for(lambda: not manager.scene_item_ids))
+        manager.set_source_visibility("Main", "Pepper", False).result(2)
+        self.assertEqual(self.server.received_requests.count("GetSceneItemId"), 2)
+
+        # A new scene item comes with its ID, so that one doesn't need looking up
+        self.server.send_event("SceneItemCreated", {"sceneName": "Main", "sourceName": "Hat", "sceneItemId": 42})
+        self.assertTrue(wait_for(lambda: ("Main", "Hat") in manager.scene_item_ids))
+        manager.set_source_visibility("Main", "Hat", True).result(2)
+        self.assertEqual(self.server.received_requests.count("GetSceneItemId"), 2)
+
+        # After OBS restarts every scene item has a new ID
+        self.server.stop()
+        self.assertTrue(wait_for(lambda: manager.get_health()["state"] == "disconnected"))
+        self.server.start()
+        self.assertTrue(manager.wait_until_connected(5))
+        self.assertEqual(manager.scene_item_ids, {})
+        manager.set_source_visibility("Main", "Pepper", True).result(2)
+        self.assertEqual(self.server.received_requests.count("GetSceneItemId"), 3)
+
+if __name__ == "__main__":
+    unittest.main()
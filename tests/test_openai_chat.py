@@ -0,0 +1,141 @@
+import os
+import sys
+import io
+import tempfile
+import unittest
+from types import SimpleNamespace
+from contextlib import redirect_stdout
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_clients
+from openai_chat import OpenAiManager
+from conversation_log import ConversationLog
+from benchmark import FakeAPIClients, LatencyDistribution, DEFAULT_LATENCIES
+
+SYSTEM_PROMPT = {"role": "system", "content": "You are a very excitable video game streamer."}
+
+class OpenAiManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.temp_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_directory.name)
+        self.original_api_clients = api_clients.api_clients
+        api_clients.api_clients = FakeAPIClients({name: LatencyDistribution(0, 0) for name in DEFAULT_LATENCIES})
+
+    def tearDown(self):
+        api_clients.api_clients = self.original_api_clients
+        os.chdir(self.original_directory)
+        self.temp_directory.cleanup()
+
+    # A manager with a small token limit, so the tests only need a few dozen messages to hit it
+    def make_manager(self, **kwargs):
+        openai_manager = OpenAiManager(system_prompt=SYSTEM_PROMPT, **kwargs)
+        openai_manager.logging = False
+        openai_manager.max_history_tokens = 400
+        openai_manager.trim_block_tokens = 150
+        return openai_manager
+
+    def assert_token_cache_is_correct(self, openai_manager):
+        self.assertEqual(openai_manager.get_chat_history_tokens(), openai_manager.num_tokens_from_messages(openai_manager.chat_history))
+        self.assertEqual(openai_manager.chat_history_token_counts, [openai_manager.num_tokens_from_message(message) for message in openai_manager.chat_history])
+
+class TestPromptPrefix(OpenAiManagerTestCase):
+
+    # Runs a few dozen turns and counts how often the start of the prompt changed from one turn to the next
+    def count_prefix_changes(self, openai_manager, get_answer_for_turn):
+        previous_messages = None
+        prefix_changes = 0
+        for turn in range(40):
+            messages = openai_manager.prepare_chat_history(f"Turn {turn}: what do you think of the new speedrun record in this game?")
+            # The prompt only ever goes on the end, so everything OpenAi saw last turn should still be at the start
+            if previous_messages is not None and messages[:len(previous_messages)] != previous_messages:
+                prefix_changes += 1
+                self.assertEqual(messages[0], SYSTEM_PROMPT)
+                self.assertLessEqual(openai_manager.get_chat_history_tokens(), openai_manager.max_history_tokens - openai_manager.trim_block_tokens + 2)
+            self.assert_token_cache_is_correct(openai_manager)
+            self.assertLessEqual(openai_manager.num_tokens_from_messages(messages), openai_manager.max_history_tokens)
+            previous_messages = messages + get_answer_for_turn(openai_manager, turn)
+        return prefix_changes
+
+    def test_prefix_only_changes_when_a_block_is_trimmed(self):
+        openai_manager = self.make_manager()
+        def record_answer(openai_manager, turn):
+            answer = f"Answer {turn}: it is completely bonkers and I love it so much."
+            openai_manager.record_answer(answer)
+            return [{"role": "assistant", "content": answer}]
+        prefix_changes = self.count_prefix_changes(openai_manager, record_answer)
+        # Each trim drops a whole block, so the prefix changes a few times in 40 turns rather than every turn
+        self.assertGreater(prefix_changes, 0)
+        self.assertLess(prefix_changes, 10)
+
+    def test_prefix_only_changes_when_a_block_is_trimmed_with_a_conversation_log(self):
+        conversation_log = ConversationLog(os.path.join(self.temp_directory.name, "log.txt"))
+        openai_manager = self.make_manager(conversation_log=conversation_log, speaker_name="OSWALD")
+        previous_messages = None
+        prefix_changes = 0
+        for turn in range(40):
+            messages = openai_manager.prepare_chat_history(f"Turn {turn}: what do you think?")
+            # In log mode the prompt is only sent along with this request, it isn't kept in the history
+            self.assertEqual(messages[-1]["content"][0]["text"], f"Turn {turn}: what do you think?")
+            history = messages[:-1]
+            if previous_messages is not None and history[:len(previous_messages)] != previous_messages:
+                prefix_changes += 1
+            self.assert_token_cache_is_correct(openai_manager)
+            conversation_log.add_message("OSWALD", f"Answer {turn}: it is completely bonkers and I love it so much.")
+            conversation_log.add_message("TONY", f"Reply {turn}: no way, the old record was way cooler.")
+            openai_manager.sync_with_conversation_log()
+            previous_messages = openai_manager.chat_history[:]
+        conversation_log.flush()
+        self.assertGreater(prefix_changes, 0)
+        self.assertLess(prefix_changes, 10)
+
+class TestTokenCache(OpenAiManagerTestCase):
+
+    def test_matches_a_full_recount_after_a_trim(self):
+        openai_manager = self.make_manager()
+        for turn in range(30):
+            openai_manager.add_message_to_history({"role": "user", "content": f"Message {turn} about the boss fight"})
+        openai_manager.trim_chat_history(100)
+        self.assertEqual(openai_manager.chat_history[0], SYSTEM_PROMPT)
+        self.assertLessEqual(openai_manager.get_chat_history_tokens(), 100)
+        self.assert_token_cache_is_correct(openai_manager)
+
+    def test_direct_changes_to_the_chat_history_are_recounted(self):
+        openai_manager = self.make_manager()
+        openai_manager.chat_history.append({"role": "user", "content": "Someone edited the history by hand"})
+        self.assert_token_cache_is_correct(openai_manager)
+
+    def test_is_rebuilt_from_a_backup(self):
+        backup_file = os.path.join(self.temp_directory.name, "backup.txt")
+        openai_manager = self.make_manager(chat_history_backup=backup_file)
+        for turn in range(30):
+            openai_manager.prepare_chat_history(f"Message {turn} about the boss fight")
+            openai_manager.record_answer(f"Answer {turn}: that boss is way too hard")
+        openai_manager.journal.flush()
+        restored_manager = self.make_manager(chat_history_backup=backup_file)
+        self.assertEqual(restored_manager.chat_history, openai_manager.chat_history)
+        self.assert_token_cache_is_correct(restored_manager)
+        restored_manager.journal.flush()
+
+class TestRecordUsage(OpenAiManagerTestCase):
+
+    def test_only_prints_when_logging_is_on(self):
+        openai_manager = self.make_manager()
+        usage = SimpleNamespace(prompt_tokens=2048, prompt_tokens_details={"cached_tokens": 1024})
+        output = io.StringIO()
+        with redirect_stdout(output):
+            openai_manager.record_usage(usage)
+        self.assertEqual(output.getvalue(), "")
+        openai_manager.logging = True
+        with redirect_stdout(output):
+            openai_manager.record_usage(usage)
+        self.assertIn("1024/2048", output.getvalue())
+        # The totals are kept either way
+        self.assertEqual((openai_manager.total_prompt_tokens, openai_manager.total_cached_tokens), (4096, 2048))
+        self.assertEqual(openai_manager.last_usage["cached_ratio"], 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sentences import split_complete_sentences
+
+class TestSplitCompleteSentences(unittest.TestCase):
+
+    def test_keeps_the_unfinished_sentence_as_leftover_text(self):
+        self.assertEqual(split_complete_sentences("Hello there. How are"), (["Hello there."], "How are"))
+
+    def test_a_sentence_needs_whitespace_after_it_to_be_complete(self):
+        # "3." could be the start of "3.5", so it has to wait for the next chunk
+        self.assertEqual(split_complete_sentences("It costs 3."), ([], "It costs 3."))
+        self.assertEqual(split_complete_sentences("It costs 3.5 coins! "), (["It costs 3.5 coins!"], ""))
+
+    def test_keeps_closing_quotes_and_brackets_with_the_sentence(self):
+        text = 'He said "wahoo!" (Then he left.) What?! Okay... bye'
+        self.assertEqual(split_complete_sentences(text), (['He said "wahoo!"', "(Then he left.)", "What?!", "Okay..."], "bye"))
+
+    def test_text_split_across_chunks_gives_the_same_sentences(self):
+        text = "I love this game. Do you? It's great! "
+        sentences = []
+        unfinished_text = ""
+        for i in range(0, len(text), 3):
+            unfinished_text += text[i:i + 3]
+            finished_sentences, unfinished_text = split_complete_sentences(unfinished_text)
+            sentences += finished_sentences
+        self.assertEqual(sentences, split_complete_sentences(text)[0])
+        self.assertEqual(sentences, ["I love this game.", "Do you?", "It's great!"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import sys
+import asyncio
+import tempfile
+import threading
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Play everything through SDL's silent driver, so the tests don't need speakers
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import api_clients
+import latency_trace
+import multi_agent_gpt
+from latency_trace import LatencyTracer
+from openai_chat import OpenAiManager
+from multi_agent_gpt import SharedResources, ConversationRoom, PreparedTurn, DEFAULT_AGENTS
+from benchmark import FakeAPIClients, LatencyDistribution, DEFAULT_LATENCIES
+
+ANSWER = ["I once raced a goose in Mario Kart and the goose won.", "That is the most unhinged thing anyone has said all day!", "Wait, are we still talking about video games?"]
+
+# A room in a temporary folder, on top of the benchmark's fake OpenAi and ElevenLabs clients (with no latency).
+# The real OpenAiManager, ElevenLabsManager and PreparedTurn run on top of them.
+class RoomTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.temp_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_directory.name)
+        self.original_api_clients = api_clients.api_clients
+        self.original_latency_tracer = latency_trace.latency_tracer
+        self.original_streaming = multi_agent_gpt.STREAMING_RESPONSES
+        api_clients.api_clients = FakeAPIClients({name: LatencyDistribution(0, 0) for name in DEFAULT_LATENCIES})
+        api_clients.api_clients.fake_openai.make_answer = lambda: list(ANSWER)
+        api_clients.api_clients.fake_async_openai.make_answer = lambda: list(ANSWER)
+        latency_trace.latency_tracer = LatencyTracer(os.path.join(self.temp_directory.name, "latency_trace.jsonl"))
+        self.room = ConversationRoom("test", SharedResources(), DEFAULT_AGENTS)
+        # Nobody gets picked to talk next, so each test only has the turns it makes itself
+        self.room.agents_paused = True
+        self.agent = self.room.agents[0]
+
+    def tearDown(self):
+        self.room.conversation_log.flush()
+        api_clients.api_clients = self.original_api_clients
+        latency_trace.latency_tracer = self.original_latency_tracer
+        multi_agent_gpt.STREAMING_RESPONSES = self.original_streaming
+        os.chdir(self.original_directory)
+        self.temp_directory.cleanup()
+
+    # Takes every clip of a prepared turn, until the None at the end
+    def get_clips(self, prepared_turn):
+        clips = []
+        while True:
+            clip = prepared_turn.clips.get(timeout=10)
+            if clip is None:
+                return clips
+            clips.append(clip)
+
+    # The fake stream's chunks don't keep the exact spacing between sentences, so only the words are compared
+    def get_log_texts(self):
+        return [" ".join(entry['text'].split()) for entry in self.room.conversation_log.get_entries()]
+
+class TestStreamingCompletion(RoomTestCase):
+
+    def test_yields_each_sentence_and_returns_the_full_answer(self):
+        openai_manager = OpenAiManager(conversation_log=self.room.conversation_log, speaker_name="OSWALD")
+        openai_manager.logging = False
+        stream = openai_manager.stream_completion([{"role": "user", "content": "Hi"}])
+        sentences = []
+        try:
+            while True:
+                sentences.append(next(stream))
+        except StopIteration as finished:
+            openai_answer = finished.value
+        self.assertEqual(sentences, ANSWER)
+        self.assertEqual(openai_answer.split(), " ".join(ANSWER).split())
+        self.assertGreater(openai_manager.total_prompt_tokens, 0)
+
+    def test_async_yields_each_sentence(self):
+        openai_manager = OpenAiManager(conversation_log=self.room.conversation_log, speaker_name="OSWALD")
+        openai_manager.logging = False
+        async def get_sentences():
+            return [sentence async for sentence in openai_manager.stream_completion_async([{"role": "user", "content": "Hi"}])]
+        self.assertEqual(asyncio.run(get_sentences()), ANSWER)
+
+class TestStreamingTurn(RoomTestCase):
+
+    def test_each_sentence_becomes_its_own_clip(self):
+        multi_agent_gpt.STREAMING_RESPONSES = True
+        prepared_turn = PreparedTurn(self.agent)
+        clips = self.get_clips(prepared_turn)
+        self.assertEqual([text for text, _, _ in clips], ANSWER)
+        for text, audio_clip, subtitles in clips:
+            self.assertGreater(audio_clip.duration, 0)
+            self.assertEqual(subtitles, [{'text': text, 'start_time': 0, 'end_time': audio_clip.duration}])
+        # Nothing is added to the conversation until the agent starts saying it
+        self.assertEqual(self.get_log_texts(), [])
+        self.assertTrue(prepared_turn.start_speaking())
+        self.assertEqual(self.get_log_texts(), [" ".join(ANSWER)])
+
+    def test_each_sentence_becomes_its_own_clip_with_the_asyncio_engine(self):
+        multi_agent_gpt.STREAMING_RESPONSES = True
+        async def get_clips():
+            self.agent.event_loop = asyncio.get_running_loop()
+            prepared_turn = PreparedTurn(self.agent)
+            clips = []
+            while (clip := await asyncio.wait_for(prepared_turn.clips.get(), 10)) is not None:
+                clips.append(clip)
+            return prepared_turn, clips
+        prepared_turn, clips = asyncio.run(get_clips())
+        self.assertEqual([text for text, _, _ in clips], ANSWER)
+        self.assertTrue(prepared_turn.start_speaking())
+        self.assertEqual(self.get_log_texts(), [" ".join(ANSWER)])
+
+    def test_the_whole_answer_is_one_clip_without_streaming(self):
+        multi_agent_gpt.STREAMING_RESPONSES = False
+        clips = self.get_clips(PreparedTurn(self.agent))
+        self.assertEqual(len(clips), 1)
+        text, audio_clip, subtitles = clips[0]
+        self.assertEqual(text, " ".join(ANSWER))
+        # The subtitles come from ElevenLabs' timestamps, one per sentence
+        self.assertEqual([subtitle['text'] for subtitle in subtitles], ANSWER)
+
+    def test_the_same_sentence_is_only_sent_to_elevenlabs_once(self):
+        multi_agent_gpt.STREAMING_RESPONSES = True
+        for _ in range(2):
+            prepared_turn = PreparedTurn(self.agent)
+            self.get_clips(prepared_turn)
+            prepared_turn.cancel()
+        stats = self.room.resources.elevenlabs_manager.tts_cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (len(ANSWER), len(ANSWER)))
+
+# When the prepared line gets committed to the conversation, or thrown away.
+# OpenAi's answer waits on answer_gate, so each test decides when the answer finishes.
+class TestPreparedTurnCommit(RoomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        multi_agent_gpt.STREAMING_RESPONSES = True
+        self.answer_gate = threading.Event()
+        def make_answer():
+            self.answer_gate.wait(10)
+            return list(ANSWER)
+        api_clients.api_clients.fake_openai.make_answer = make_answer
+
+    def tearDown(self):
+        self.answer_gate.set()
+        super().tearDown()
+
+    def test_answer_is_committed_once_it_finishes_if_speaking_started_first(self):
+        prepared_turn = PreparedTurn(self.agent)
+        self.assertTrue(prepared_turn.start_speaking())
+        self.assertEqual(self.get_log_texts(), [])
+        self.answer_gate.set()
+        self.get_clips(prepared_turn)
+        self.assertTrue(prepared_turn.committed)
+        self.assertEqual(self.get_log_texts(), [" ".join(ANSWER)])
+
+    def test_stale_answer_is_thrown_away(self):
+        prepared_turn = PreparedTurn(self.agent)
+        self.assertTrue(prepared_turn.snapshot_taken.wait(10))
+        # Someone else talks after the snapshot was taken, so the answer no longer follows on from the conversation
+        self.room.conversation_log.add_message("TONY KING OF NEW YORK", "Fuhgeddaboudit.")
+        self.answer_gate.set()
+        self.get_clips(prepared_turn)
+        self.assertFalse(prepared_turn.start_speaking())
+        self.assertFalse(prepared_turn.committed)
+        self.assertEqual(self.get_log_texts(), ["Fuhgeddaboudit."])
+
+    def test_ignore_changes_commits_a_stale_answer(self):
+        prepared_turn = PreparedTurn(self.agent)
+        self.assertTrue(prepared_turn.snapshot_taken.wait(10))
+        self.room.conversation_log.add_message("TONY KING OF NEW YORK", "Fuhgeddaboudit.")
+        self.answer_gate.set()
+        self.get_clips(prepared_turn)
+        self.assertTrue(prepared_turn.start_speaking(ignore_changes=True))
+        self.assertEqual(self.get_log_texts(), ["Fuhgeddaboudit.", " ".join(ANSWER)])
+
+    def test_cancelled_turn_is_never_committed(self):
+        prepared_turn = PreparedTurn(self.agent)
+        self.assertTrue(prepared_turn.snapshot_taken.wait(10))
+        prepared_turn.cancel()
+        self.answer_gate.set()
+        # The clips stop coming as soon as it notices, and the answer stays out of the conversation even if someone starts saying it
+        self.assertLess(len(self.get_clips(prepared_turn)), len(ANSWER))
+        prepared_turn.start_speaking(ignore_changes=True)
+        self.assertFalse(prepared_turn.committed)
+        self.assertEqual(self.get_log_texts(), [])
+
+    def test_a_failed_answer_still_ends_the_clips(self):
+        def make_answer():
+            raise ConnectionError("OpenAi is down")
+        api_clients.api_clients.fake_openai.make_answer = make_answer
+        prepared_turn = PreparedTurn(self.agent)
+        self.assertEqual(self.get_clips(prepared_turn), [])
+        self.assertFalse(prepared_turn.committed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sentences import split_complete_sentences
+from subtitle_alignment import SubtitleAligner
+
+TEXT = 'Wahoo! Did you see that jump? I told you "it was possible." It was'
+
+# ElevenLabs-style character timestamps, with every character taking 0.1 seconds
+def make_alignment(text):
+    return {
+        "characters": list(text),
+        "character_start_times_seconds": [i * 0.1 for i in range(len(text))],
+        "character_end_times_seconds": [(i + 1) * 0.1 for i in range(len(text))],
+    }
+
+# Stand-in for WhisperManager, it only remembers what it was asked to transcribe
+class FakeWhisperManager():
+
+    def __init__(self):
+        self.transcribed_files = []
+
+    def audio_to_text(self, audio_file, timestamps=None):
+        self.transcribed_files.append((audio_file, timestamps))
+        return [{'text': 'from whisper', 'start_time': 0, 'end_time': 1}]
+
+class TestSubtitleAligner(unittest.TestCase):
+
+    def setUp(self):
+        self.aligner = SubtitleAligner()
+
+    def test_splits_sentences_the_same_way_as_the_streamed_answers(self):
+        finished_sentences, leftover_text = split_complete_sentences(TEXT)
+        self.assertEqual(self.aligner.split_sentences(TEXT), finished_sentences + [leftover_text])
+        self.assertEqual(self.aligner.split_sentences(TEXT), ["Wahoo!", "Did you see that jump?", 'I told you "it was possible."', "It was"])
+
+    def test_character_timestamps_give_each_sentence_its_exact_timing(self):
+        subtitles = self.aligner.get_subtitles(TEXT, alignment=make_alignment(TEXT))
+        self.assertEqual([subtitle['text'] for subtitle in subtitles], self.aligner.split_sentences(TEXT))
+        for subtitle in subtitles:
+            start = TEXT.index(subtitle['text'])
+            self.assertAlmostEqual(subtitle['start_time'], start * 0.1)
+            self.assertAlmostEqual(subtitle['end_time'], (start + len(subtitle['text'])) * 0.1)
+
+    def test_duration_is_spread_across_the_sentences_by_length(self):
+        subtitles = self.aligner.get_subtitles(TEXT, audio_duration=10)
+        self.assertEqual([subtitle['text'] for subtitle in subtitles], self.aligner.split_sentences(TEXT))
+        self.assertEqual(subtitles[0]['start_time'], 0)
+        self.assertAlmostEqual(subtitles[-1]['end_time'], 10, places=1)
+        for earlier, later in zip(subtitles, subtitles[1:]):
+            # There's a short pause between sentences, and longer sentences get more time
+            self.assertGreater(later['start_time'], earlier['end_time'])
+        durations = [subtitle['end_time'] - subtitle['start_time'] for subtitle in subtitles]
+        self.assertLess(durations[0], durations[2])
+
+    def test_broken_timestamps_fall_back_to_the_duration(self):
+        alignment = make_alignment(TEXT)
+        del alignment["character_end_times_seconds"][5:]
+        subtitles = self.aligner.get_subtitles(TEXT, alignment=alignment, audio_duration=10)
+        self.assertEqual(subtitles, self.aligner.align_with_duration(TEXT, 10))
+
+    def test_whisper_is_only_used_without_any_timing(self):
+        whisper_manager = FakeWhisperManager()
+        aligner = SubtitleAligner(whisper_manager=whisper_manager)
+        aligner.get_subtitles(TEXT, "clip.mp3", audio_duration=10)
+        self.assertEqual(whisper_manager.transcribed_files, [])
+        self.assertEqual(aligner.get_subtitles(TEXT, "clip.mp3"), [{'text': 'from whisper', 'start_time': 0, 'end_time': 1}])
+        self.assertEqual(whisper_manager.transcribed_files, [("clip.mp3", "sentence")])
+
+    def test_no_timing_at_all_shows_the_whole_text(self):
+        self.assertEqual(self.aligner.get_subtitles(TEXT), [{'text': TEXT, 'start_time': 0, 'end_time': 0}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts_cache import TTSCache
+
+class TestTTSCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.cache = TTSCache(os.path.join(self.temp_directory.name, "tts_cache"))
+
+    def tearDown(self):
+        self.temp_directory.cleanup()
+
+    def test_counts_hits_and_misses(self):
+        key = self.cache.make_key("audio", "hello", "voice-1")
+        self.assertIsNone(self.cache.get(key, ".mp3"))
+        file_path = self.cache.add_bytes(key, ".mp3", b"audio")
+        self.assertEqual(self.cache.get(key, ".mp3"), file_path)
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["files"], stats["size_bytes"]), (1, 1, 1, 5))
+
+    def test_a_line_with_several_files_is_one_lookup(self):
+        key = self.cache.make_key("timestamps", "hello", "voice-1")
+        self.cache.add_bytes(key, ".mp3", b"audio")
+        # The timestamps are missing, so it's a miss
+        self.assertIsNone(self.cache.get_all(key, [".mp3", ".json"]))
+        self.cache.add_bytes(key, ".json", b"{}")
+        self.assertEqual(self.cache.get_all(key, [".mp3", ".json"]), [self.cache.get_path(key, ".mp3"), self.cache.get_path(key, ".json")])
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_a_deleted_file_is_a_miss(self):
+        key = self.cache.make_key("audio", "hello", "voice-1")
+        file_path = self.cache.add_bytes(key, ".mp3", b"audio")
+        os.remove(file_path)
+        self.assertIsNone(self.cache.get(key, ".mp3"))
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["misses"], stats["files"], stats["size_bytes"]), (1, 0, 0))
+        # It can be cached again afterwards
+        self.cache.add_bytes(key, ".mp3", b"audio")
+        self.assertEqual(self.cache.get(key, ".mp3"), file_path)
+
+    def test_evicts_the_least_recently_used_file(self):
+        self.cache.max_size_bytes = 10
+        keys = [self.cache.make_key("audio", str(i)) for i in range(3)]
+        self.cache.add_bytes(keys[0], ".mp3", b"12345")
+        self.cache.add_bytes(keys[1], ".mp3", b"12345")
+        # Using the first file makes the second one the oldest
+        self.cache.get(keys[0], ".mp3")
+        self.cache.add_bytes(keys[2], ".mp3", b"12345")
+        self.assertIsNotNone(self.cache.get(keys[0], ".mp3"))
+        self.assertIsNone(self.cache.get(keys[1], ".mp3"))
+        self.assertFalse(os.path.exists(self.cache.get_path(keys[1], ".mp3")))
+        self.assertEqual(self.cache.get_stats()["evictions"], 1)
+
+    def test_old_files_are_a_miss(self):
+        key = self.cache.make_key("audio", "hello")
+        file_path = self.cache.add_bytes(key, ".mp3", b"audio")
+        self.cache.max_age_seconds = 60
+        self.cache.files[os.path.basename(file_path)] = (5, time.time() - 120)
+        self.assertIsNone(self.cache.get(key, ".mp3"))
+        self.assertFalse(os.path.exists(file_path))
+
+    def test_picks_up_the_files_from_the_last_run(self):
+        key = self.cache.make_key("audio", "hello")
+        file_path = self.cache.add_bytes(key, ".mp3", b"audio")
+        cache = TTSCache(self.cache.cache_directory)
+        self.assertEqual(cache.get(key, ".mp3"), file_path)
+
+if __name__ == "__main__":
+    unittest.main()
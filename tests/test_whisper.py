@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import unittest
+import numpy as np
+
+# The modules live in the repo root, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whisper_openai import WhisperManager, resample_to_whisper_rate, WHISPER_SAMPLE_RATE
+
+# Stand-in for the transformers pipeline. The "audio" is just a string, which is transcribed as itself.
+# It fails the whole call if any of the audio in it is "corrupt", like the real pipeline does.
+class FakePipeline():
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, audio_files, return_timestamps=False, batch_size=None):
+        with self.lock:
+            self.calls.append(list(audio_files))
+        if "corrupt" in audio_files:
+            raise ValueError("couldn't decode the audio")
+        return [{"text": audio_file, "chunks": [{"text": audio_file, "timestamp": (0.0, 1.0)}]} for audio_file in audio_files]
+
+class TestWhisperBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.whisper_manager = WhisperManager(trim_silence=False)
+        # A loaded pipeline means load_model() never imports torch
+        self.whisper_manager.pipe = FakePipeline()
+        # Long enough that every job below ends up in the same batch
+        self.whisper_manager.batch_window = 0.2
+
+    def test_jobs_queued_together_share_one_pipeline_call(self):
+        futures = [self.whisper_manager.queue_job(f"clip {i}") for i in range(3)]
+        self.assertEqual([future.result(5) for future in futures], ["clip 0", "clip 1", "clip 2"])
+        self.assertEqual(self.whisper_manager.pipe.calls, [["clip 0", "clip 1", "clip 2"]])
+
+    def test_one_corrupt_clip_only_fails_its_own_job(self):
+        futures = [self.whisper_manager.queue_job(audio_file) for audio_file in ("clip 0", "corrupt", "clip 2")]
+        self.assertEqual(futures[0].result(5), "clip 0")
+        with self.assertRaises(ValueError):
+            futures[1].result(5)
+        self.assertEqual(futures[2].result(5), "clip 2")
+        # The whole batch first, then each clip on its own
+        self.assertEqual(self.whisper_manager.pipe.calls, [["clip 0", "corrupt", "clip 2"], ["clip 0"], ["corrupt"], ["clip 2"]])
+
+    def test_timestamps_are_batched_separately(self):
+        plain = self.whisper_manager.queue_job("clip 0")
+        timestamped = self.whisper_manager.queue_job("clip 1", "sentence")
+        self.assertEqual(plain.result(5), "clip 0")
+        self.assertEqual(timestamped.result(5), [{"text": "clip 1", "start_time": 0.0, "end_time": 1.0}])
+        self.assertEqual(self.whisper_manager.pipe.calls, [["clip 0"], ["clip 1"]])
+
+# One second of a sine wave
+def make_tone(frequency, sample_rate):
+    return np.sin(2 * np.pi * frequency * np.arange(sample_rate) / sample_rate).astype(np.float32)
+
+# The loudest frequency in one second of audio, and how loud it is (1 is a full-volume sine wave)
+def get_loudest_frequency(samples):
+    spectrum = np.abs(np.fft.rfft(samples)) * 2 / len(samples)
+    return int(np.argmax(spectrum)), float(spectrum.max())
+
+class TestResampling(unittest.TestCase):
+
+    def test_audio_at_the_right_rate_is_left_alone(self):
+        samples = make_tone(440, WHISPER_SAMPLE_RATE)
+        resampled = resample_to_whisper_rate(samples, WHISPER_SAMPLE_RATE)
+        self.assertEqual(resampled.dtype, np.float32)
+        np.testing.assert_array_equal(resampled, samples)
+        self.assertEqual(len(resample_to_whisper_rate([], 48000)), 0)
+
+    def test_keeps_the_length_and_pitch(self):
+        for sample_rate in (8000, 22050, 44100, 48000):
+            resampled = resample_to_whisper_rate(make_tone(440, sample_rate), sample_rate)
+            self.assertEqual(resampled.dtype, np.float32)
+            self.assertEqual(len(resampled), WHISPER_SAMPLE_RATE)
+            frequency, volume = get_loudest_frequency(resampled)
+            self.assertEqual(frequency, 440)
+            self.assertGreater(volume, 0.9)
+
+    def test_sounds_too_high_for_whisper_are_filtered_out(self):
+        # Without the low-pass filter, 12kHz would fold back into the speech range as a 4kHz tone
+        resampled = resample_to_whisper_rate(make_tone(12000, 48000), 48000)
+        self.assertLess(get_loudest_frequency(resampled)[1], 0.05)
+
+    def test_raw_audio_is_resampled_when_loaded(self):
+        samples, sample_rate = WhisperManager(trim_silence=False).load_audio({"raw": make_tone(440, 48000), "sampling_rate": 48000})
+        self.assertEqual(sample_rate, WHISPER_SAMPLE_RATE)
+        self.assertEqual(get_loudest_frequency(samples)[0], 440)
+
+if __name__ == "__main__":
+    unittest.main()
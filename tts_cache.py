@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from rich import print
+
+class TTSCache():
+
+    # A folder of TTS audio files, named after a digest of everything that affects the audio (text, voice, voice settings, model, format).
+    # If we're asked for the same line again (catchphrases, intros, replays), we reuse the file instead of calling ElevenLabs.
+    # Old files are deleted least-recently-used first, once the folder gets bigger than max_size_bytes or a file is older than max_age_seconds.
+
+    def __init__(self, cache_directory="tts_cache", max_size_bytes=500 * 1024 * 1024, max_age_seconds=7 * 24 * 60 * 60):
+        self.cache_directory = os.path.join(os.path.abspath(os.curdir), cache_directory)
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # file name -> (size in bytes, last time it was used). Ordered from least to most recently used.
+        self.files = OrderedDict()
+        self.total_size = 0
+        os.makedirs(self.cache_directory, exist_ok=True)
+        self.load_existing_files()
+
+    # Pick up the files that are already in the folder from previous runs, oldest first
+    def load_existing_files(self):
+        existing_files = []
+        for file_name in os.listdir(self.cache_directory):
+            file_path = os.path.join(self.cache_directory, file_name)
+            if file_name.endswith(".tmp") or not os.path.isfile(file_path):
+                continue
+            stat = os.stat(file_path)
+            existing_files.append((stat.st_mtime, file_name, stat.st_size))
+        for last_used, file_name, size in sorted(existing_files):
+            self.files[file_name] = (size, last_used)
+            self.total_size += size
+        with self.lock:
+            self.evict()
+
+    # Returns a stable key for everything that affects the generated audio.
+    # Unlike hash(), this is the same every time you run the program.
+    def make_key(self, *parts):
+        key_data = json.dumps([self.to_json_friendly(part) for part in parts], sort_keys=True, default=str)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    # Voice settings are pydantic models, so turn them into plain dictionaries first
+    def to_json_friendly(self, value):
+        if hasattr(value, "model_dump"):
+            return value.model_dump()
+        if hasattr(value, "dict"):
+            return value.dict()
+        return value
+
+    # Where the file for this key lives (whether or not it exists yet)
+    def get_path(self, key, extension):
+        return os.path.join(self.cache_directory, f"{key}{extension}")
+
+    # Returns the path of the cached file, or None if it isn't cached (or is too old)
+    def get(self, key, extension):
+        file_paths = self.get_all(key, [extension])
+        return file_paths[0] if file_paths else None
+
+    # Same as get, for a line that's cached as several files (e.g. the mp3 and its timestamps). Returns their paths in the same order,
+    # or None unless all of them are cached. Either way it's counted as one hit or one miss.
+    def get_all(self, key, extensions):
+        file_names = [f"{key}{extension}" for extension in extensions]
+        with self.lock:
+            now = time.time()
+            for file_name in file_names:
+                if file_name not in self.files:
+                    continue
+                if now - self.files[file_name][1] > self.max_age_seconds:
+                    self.remove(file_name)
+                elif not os.path.exists(os.path.join(self.cache_directory, file_name)):
+                    # Someone deleted the file behind our back (by hand, or a caller that was handed its path), so forget about it
+                    self.forget(file_name)
+            if any(file_name not in self.files for file_name in file_names):
+                self.misses += 1
+                return None
+            # Mark them as the most recently used files
+            for file_name in file_names:
+                self.files[file_name] = (self.files[file_name][0], now)
+                self.files.move_to_end(file_name)
+            self.hits += 1
+        file_paths = [self.get_path(key, extension) for extension in extensions]
+        for file_path in file_paths:
+            try:
+                os.utime(file_path) # So the order survives a restart
+            except OSError:
+                pass
+        return file_paths
+
+    # Saves some bytes into the cache, and returns the file path
+    def add_bytes(self, key, extension, data):
+        file_path = self.get_path(key, extension)
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp" # Two threads can generate the same line at once
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+        self.add(key, extension)
+        return file_path
+
+    # Register a file that has just been written to get_path(key, extension)
+    def add(self, key, extension):
+        file_name = f"{key}{extension}"
+        size = os.path.getsize(self.get_path(key, extension))
+        with self.lock:
+            if file_name in self.files:
+                self.total_size -= self.files[file_name][0]
+            self.files[file_name] = (size, time.time())
+            self.files.move_to_end(file_name)
+            self.total_size += size
+            self.evict()
+
+    # Delete least recently used files until we're under the size limit (never deleting the file we just added)
+    def evict(self):
+        now = time.time()
+        while len(self.files) > 1:
+            oldest_file, (size, last_used) = next(iter(self.files.items()))
+            if self.total_size <= self.max_size_bytes and now - last_used <= self.max_age_seconds:
+                break
+            self.remove(oldest_file)
+            self.evictions += 1
+
+    def remove(self, file_name):
+        self.forget(file_name)
+        try:
+            os.remove(os.path.join(self.cache_directory, file_name))
+        except OSError as e:
+            # On Windows this happens if the file is still being played
+            print(f"[red]Couldn't remove {file_name} from the TTS cache: {e}")
+
+    # Stops tracking a file, without deleting it
+    def forget(self, file_name):
+        size, _ = self.files.pop(file_name)
+        self.total_size -= size
+
+    # Hits and misses are counted once per lookup: GET 127.0.0.1:5151/tts_cache
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "files": len(self.files), "size_bytes": self.total_size}
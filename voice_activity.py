@@ -0,0 +1,80 @@
+import numpy as np
+
+class VoiceActivityDetector():
+
+    # Finds the parts of an audio clip that have someone talking in them, so we only send those to Whisper.
+    # Less audio into Whisper means less work for it, which matters a lot when it runs on the CPU.
+    # This is a simple energy-based detector: the audio is cut into short frames, and a frame counts as speech if it's loud enough
+    # compared to the quietest parts of the clip (the background noise). Everything is done with numpy on all frames at once, so it's very fast.
+
+    def __init__(self, frame_seconds=0.03, min_threshold_db=-50, noise_margin_db=10, padding_seconds=0.2, max_pause_seconds=1.0, min_speech_seconds=0.15):
+        """
+        frame_seconds: length of each frame that gets classified as speech or silence
+        min_threshold_db: frames quieter than this are always silence
+        noise_margin_db: how much louder than the background noise a frame has to be to count as speech
+        padding_seconds: extra audio kept before and after speech, so we don't clip the start and end of words
+        max_pause_seconds: pauses longer than this split the audio into separate segments
+        min_speech_seconds: segments shorter than this are thrown away (clicks, pops, keyboard noise)
+        """
+        self.frame_seconds = frame_seconds
+        self.min_threshold_db = min_threshold_db
+        self.noise_margin_db = noise_margin_db
+        self.padding_seconds = padding_seconds
+        self.max_pause_seconds = max_pause_seconds
+        self.min_speech_seconds = min_speech_seconds
+
+    # Returns the speech in the audio as a list of (start_time, samples), plus some stats about how much audio was dropped:
+    # {'total_seconds': 12.0, 'kept_seconds': 8.5, 'dropped_seconds': 3.5}
+    # samples must be a mono numpy array
+    def trim(self, samples, sample_rate):
+        segments = [(start / sample_rate, samples[start:end]) for start, end in self.get_speech_segments(samples, sample_rate)]
+        total_seconds = len(samples) / sample_rate
+        kept_seconds = sum(len(segment) for _, segment in segments) / sample_rate
+        stats = {'total_seconds': round(total_seconds, 2), 'kept_seconds': round(kept_seconds, 2), 'dropped_seconds': round(total_seconds - kept_seconds, 2)}
+        return segments, stats
+
+    # Returns a list of (start_sample, end_sample) for every part of the audio that has speech in it
+    def get_speech_segments(self, samples, sample_rate):
+        frame_length = max(1, int(sample_rate * self.frame_seconds))
+        frame_count = len(samples) // frame_length
+        if frame_count == 0:
+            return []
+
+        # Loudness of every frame in decibels
+        frames = np.asarray(samples[:frame_count * frame_length], dtype=np.float32).reshape(frame_count, frame_length)
+        frame_db = 10 * np.log10((frames ** 2).mean(axis=1) + 1e-10)
+
+        # The quietest 10% of frames tell us how loud the background noise is.
+        # If the whole clip is speech that would be way too high, so the threshold is also kept well below the loudest frame.
+        noise_floor = np.percentile(frame_db, 10)
+        threshold = min(noise_floor + self.noise_margin_db, frame_db.max() - 20)
+        threshold = max(threshold, self.min_threshold_db)
+        is_speech = frame_db > threshold
+
+        # Keep some padding around the speech, so the starts and ends of words aren't cut off
+        padding_frames = int(self.padding_seconds / self.frame_seconds)
+        if padding_frames > 0:
+            is_speech = np.convolve(is_speech.astype(np.int32), np.ones(2 * padding_frames + 1, dtype=np.int32), mode='same') > 0
+
+        # Find where each run of speech frames starts and ends
+        edges = np.diff(np.concatenate(([0], is_speech.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        # Join segments that are only separated by a short pause, then drop the ones that are too short to be speech
+        max_pause_frames = int(self.max_pause_seconds / self.frame_seconds)
+        min_speech_frames = int(self.min_speech_seconds / self.frame_seconds)
+        segments = []
+        for start, end in zip(starts, ends):
+            if segments and start - segments[-1][1] <= max_pause_frames:
+                segments[-1][1] = end
+            else:
+                segments.append([start, end])
+        segments = [(start, end) for start, end in segments if end - start >= min_speech_frames]
+
+        # Convert frames back into samples. The leftover samples after the last full frame go with the last segment if it reaches the end.
+        sample_segments = []
+        for start, end in segments:
+            end_sample = len(samples) if end == frame_count else end * frame_length
+            sample_segments.append((int(start * frame_length), int(end_sample)))
+        return sample_segments
@@ -1,55 +1,242 @@
-import torch
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+import numpy as np
+import soundfile as sf
 from rich import print
+from voice_activity import VoiceActivityDetector
 import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Whisper models on HuggingFace, from fastest to most accurate.
+# On a GPU large is fine. On a CPU, tiny or base (with int8 quantization) are the only ones fast enough for a live show.
+WHISPER_MODELS = {
+    "tiny": "openai/whisper-tiny",
+    "base": "openai/whisper-base",
+    "small": "openai/whisper-small",
+    "medium": "openai/whisper-medium",
+    "large": "openai/whisper-large-v3",
+}
+
+# Whisper only understands 16kHz audio
+WHISPER_SAMPLE_RATE = 16000
+
+# Resamples mono float32 audio to WHISPER_SAMPLE_RATE with plain numpy.
+# The transformers pipeline can resample raw audio itself, but only with torchaudio installed, so we do it here instead.
+# When downsampling, a windowed-sinc low-pass filter removes everything Whisper can't hear first, so it doesn't fold back into the speech as noise.
+def resample_to_whisper_rate(samples, sample_rate):
+    samples = np.asarray(samples, dtype=np.float32)
+    if sample_rate == WHISPER_SAMPLE_RATE or len(samples) == 0:
+        return samples
+    if sample_rate > WHISPER_SAMPLE_RATE:
+        cutoff = 0.5 * WHISPER_SAMPLE_RATE / sample_rate # As a fraction of the original sample rate
+        taps = np.arange(-32, 33)
+        low_pass = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+        samples = np.convolve(samples, low_pass / low_pass.sum(), mode="same")
+    duration = len(samples) / sample_rate
+    new_times = np.arange(int(duration * WHISPER_SAMPLE_RATE)) / WHISPER_SAMPLE_RATE
+    old_times = np.arange(len(samples)) / sample_rate
+    return np.interp(new_times, old_times, samples).astype(np.float32)
 
 class WhisperManager():
 
     # Uses Whisper on HuggingFace: https://huggingface.co/openai/whisper-large-v3
     # Need to make sure you've installed torch with CUDA support, rather than just default torch: pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/cu118
     # I tried a lot but could not get Flash Attention 2 to install. It would speed up performance but isn't necessary.
+    #
+    # The model is only loaded the first time something is transcribed (or when you call load_model()), so creating this is instant.
+    # Torch and transformers are imported at that point too, since just importing them takes a few seconds.
+    # Anything with an audio_to_text(audio_file, timestamps=None) function can be used instead of this class (see ASR_SETTINGS in multi_agent_gpt.py).
+
+    def __init__(self, model_size="large", device=None, quantize_on_cpu=True, trim_silence=True):
+        """
+        model_size: one of WHISPER_MODELS (tiny, base, small, medium, large)
+        device: "cuda:0", "cpu", or None to use the GPU if there is one
+        quantize_on_cpu: if running on the CPU, convert the model's linear layers to int8 (dynamic quantization). Roughly 2-3x faster, with barely any loss in accuracy.
+        """
+        if model_size not in WHISPER_MODELS:
+            raise ValueError(f"Unknown Whisper model size '{model_size}', pick one of {list(WHISPER_MODELS)}")
+        self.model_id = WHISPER_MODELS[model_size]
+        self.device = device
+        self.quantize_on_cpu = quantize_on_cpu
+        self.pipe = None
+        self.load_lock = threading.Lock()
+
+        # Transcription jobs from every thread go into one queue, and a single worker runs them through Whisper in batches.
+        # The worker waits up to batch_window seconds after the first job for more to arrive, and takes at most max_batch_size jobs at a time.
+        self.jobs = queue.Queue()
+        self.batch_window = 0.05
+        self.max_batch_size = 16
+        self.worker_thread = None
+        self.worker_lock = threading.Lock()
+        # Runs the audio loading and silence trimming for submit(), so callers get a future straight away
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="whisper")
+
+        # Silence is cut out before anything is sent to Whisper (see voice_activity.py)
+        self.voice_activity_detector = VoiceActivityDetector() if trim_silence else None
+
+    # Loads the model, if it isn't loaded already
+    def load_model(self):
+        with self.load_lock:
+            if self.pipe is not None:
+                return
+            import torch
+            from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+
+            device = self.device
+            if device is None:
+                device = "cuda:0" if torch.cuda.is_available() else "cpu"
+            on_gpu = device.startswith("cuda")
+            if on_gpu:
+                print(f"[green]Loading {self.model_id} on {torch.cuda.get_device_name(device)}")  # Should be the name of your GPU, e.g., "NVIDIA GeForce RTX 4070 Ti"
+            else:
+                print(f"[yellow]No GPU being used, loading {self.model_id} on the CPU")
+            torch_dtype = torch.float16 if on_gpu else torch.float32
+
+            model = AutoModelForSpeechSeq2Seq.from_pretrained(
+                self.model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+            )
+            model.to(device)
+            model.generation_config.is_multilingual = False
+            model.generation_config.language = "en"
+
+            if not on_gpu and self.quantize_on_cpu:
+                # Store the weights of the linear layers (most of the model) as int8, and run them with int8 math
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            processor = AutoProcessor.from_pretrained(self.model_id)
+
+            self.pipe = pipeline(
+                "automatic-speech-recognition",
+                model=model,
+                tokenizer=processor.tokenizer,
+                feature_extractor=processor.feature_extractor,
+                max_new_tokens=256,
+                chunk_length_s=30,
+                batch_size=16,
+                return_timestamps=True,
+                torch_dtype=torch_dtype,
+                device=device,
+            )
 
-    def __init__(self):
-        print(torch.cuda.is_available())  # Should return True if CUDA is available
-        print(torch.cuda.get_device_name(0))  # Should return the name of your GPU, e.g., "NVIDIA GeForce RTX 4070 Ti"
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-        model_id = "openai/whisper-large-v3"
-
-        model = AutoModelForSpeechSeq2Seq.from_pretrained(
-            model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
-        )
-        model.to(device)
-        model.generation_config.is_multilingual = False
-        model.generation_config.language = "en"
-
-        processor = AutoProcessor.from_pretrained(model_id)
-
-        self.pipe = pipeline(
-            "automatic-speech-recognition",
-            model=model,
-            tokenizer=processor.tokenizer,
-            feature_extractor=processor.feature_extractor,
-            max_new_tokens=256,
-            chunk_length_s=30,
-            batch_size=16,
-            return_timestamps=True,
-            torch_dtype=torch_dtype,
-            device=device,
-        )
-    
     # Converts an audio file into transcribed text. Can provide also provide timestamps
+    # audio_file can be the path to an audio file, or raw mono audio as {"raw": numpy_array, "sampling_rate": 16000}
+    # Silence is trimmed first, and the audio is split on long pauses, so Whisper only has to listen to the parts with speech in them.
+    # The timestamps still line up with the original audio.
+    # This blocks until the transcription is done. Use submit() to get a future instead.
+    def audio_to_text(self, audio_file, timestamps=None):
+        audio = self.load_audio(audio_file)
+        if audio is None:
+            return self.transcribe(audio_file, timestamps)
+
+        samples, sample_rate = audio
+        if self.voice_activity_detector is None:
+            segments = [(0, samples)]
+        else:
+            segments, stats = self.voice_activity_detector.trim(samples, sample_rate)
+            print(f"[grey50]Trimmed {stats['dropped_seconds']}s of silence out of {stats['total_seconds']}s before transcribing")
+        # Queue every segment at once, so they all end up in the same batch
+        futures = [(start_time, self.queue_job({"raw": segment, "sampling_rate": sample_rate}, timestamps)) for start_time, segment in segments]
+        results = [(start_time, future.result()) for start_time, future in futures]
+        if timestamps == None:
+            return " ".join(text.strip() for _, text in results)
+        # Shift each segment's timestamps by where that segment starts in the original audio
+        timestamped_chunks = []
+        for start_time, chunks in results:
+            for chunk in chunks:
+                timestamped_chunks.append({
+                    'text': chunk['text'],
+                    'start_time': None if chunk['start_time'] is None else round(chunk['start_time'] + start_time, 2),
+                    'end_time': None if chunk['end_time'] is None else round(chunk['end_time'] + start_time, 2)
+                })
+        return timestamped_chunks
+
+    # Returns (samples, WHISPER_SAMPLE_RATE) with the samples as a mono float32 numpy array, so the batching worker never has to resample anything.
+    # Returns None if we can't read the audio ourselves, then Whisper just gets the file (the pipeline decodes and resamples files with ffmpeg).
+    def load_audio(self, audio_file):
+        if isinstance(audio_file, dict):
+            return resample_to_whisper_rate(audio_file["raw"], audio_file["sampling_rate"]), WHISPER_SAMPLE_RATE
+        try:
+            samples, sample_rate = sf.read(audio_file, dtype='float32', always_2d=True)
+        except Exception as e:
+            print(f"[yellow]Couldn't read {audio_file} ourselves, handing the whole file to Whisper: {e}")
+            return None
+        return resample_to_whisper_rate(samples.mean(axis=1), sample_rate), WHISPER_SAMPLE_RATE
+
+    # Same as audio_to_text, but returns a concurrent.futures.Future straight away. Call .result() on it to get the text (or timestamped chunks).
+    # Jobs submitted around the same time (e.g. from several agents or rooms) are transcribed together in one batch.
+    def submit(self, audio_file, timestamps=None):
+        return self.executor.submit(self.audio_to_text, audio_file, timestamps)
+
+    # Runs Whisper on the audio, without trimming anything first
     # wav and mp3 files appear to take the same amount of time to process
     # With test files, word timestamps took 3.5-4 seconds, sentence timestamps took 2.2 seconds, no timestamps took 1.9-2 seconds
-    def audio_to_text(self, audio_file, timestamps=None):
+    def transcribe(self, audio_file, timestamps=None):
+        return self.queue_job(audio_file, timestamps).result()
+
+    # Adds a job to the batch queue, and returns a Future for its result
+    def queue_job(self, audio_file, timestamps=None):
+        future = Future()
+        if timestamps not in (None, "sentence", "word"):
+            future.set_result(self.format_result({"text": " ", "chunks": []}, timestamps))
+            return future
+        with self.worker_lock:
+            if self.worker_thread is None:
+                self.worker_thread = threading.Thread(target=self.run_jobs, daemon=True)
+                self.worker_thread.start()
+        self.jobs.put((audio_file, timestamps, future))
+        return future
+
+    # The worker thread: collects jobs for a short window, then runs them through the pipeline as one batch
+    def run_jobs(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                time_left = deadline - time.time()
+                if time_left <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=time_left))
+                except queue.Empty:
+                    break
+
+            # Each pipeline call can only use one kind of timestamps, so jobs are grouped by it
+            for timestamps in (None, "sentence", "word"):
+                jobs = [job for job in batch if job[1] == timestamps]
+                if jobs:
+                    self.run_batch(jobs, timestamps)
+
+    def run_batch(self, jobs, timestamps):
+        try:
+            self.load_model()
+        except Exception as e:
+            print(f"[red]Couldn't load the Whisper model: {e}")
+            for _, _, future in jobs:
+                future.set_exception(e)
+            return
         if timestamps == None:
-            result = self.pipe(audio_file, return_timestamps=False)
+            return_timestamps = False
         elif timestamps == "sentence":
-            result = self.pipe(audio_file, return_timestamps=True)
-        elif timestamps == "word":
-            result = self.pipe(audio_file, return_timestamps="word")
+            return_timestamps = True
         else:
-            result = {"text": " "}
+            return_timestamps = "word"
+        try:
+            results = self.pipe([audio_file for audio_file, _, _ in jobs], return_timestamps=return_timestamps, batch_size=self.max_batch_size)
+        except Exception as e:
+            if len(jobs) == 1:
+                jobs[0][2].set_exception(e)
+                return
+            # We don't know whose audio broke the batch, so run them one at a time. That way only the broken one gets the error.
+            print(f"[yellow]A batch of {len(jobs)} audio clips failed ({e}), transcribing them one by one instead")
+            for job in jobs:
+                self.run_batch([job], timestamps)
+            return
+        if len(jobs) > 1:
+            print(f"[grey50]Transcribed {len(jobs)} audio clips in one batch")
+        for (_, _, future), result in zip(jobs, results):
+            future.set_result(self.format_result(result, timestamps))
+
+    def format_result(self, result, timestamps):
         if timestamps == None:
             # If they didn't want the timestamps, then just return the text
             return result["text"]
@@ -67,3 +254,41 @@ class WhisperManager():
                 timestamped_chunks.append(new_chunk)
             return timestamped_chunks
 
+
+class IncrementalTranscriber():
+
+    # Transcribes mic audio one window at a time while the person is still talking (see AudioManager.stream_mic_audio).
+    # Each window is transcribed on a background thread as soon as it arrives, so when they stop talking only the last window is left to do.
+    # whisper_manager can be anything with WhisperManager's audio_to_text()
+
+    def __init__(self, whisper_manager):
+        self.whisper_manager = whisper_manager
+        self.windows = queue.Queue()
+        self.texts = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # samples is a mono float32 numpy array
+    def add_window(self, samples, sample_rate):
+        self.windows.put((samples, sample_rate))
+
+    def run(self):
+        while True:
+            window = self.windows.get()
+            if window is None:
+                return
+            samples, sample_rate = window
+            try:
+                # The mic records at 44.1kHz, so resample it here (on this thread, not the recording one) to what Whisper wants
+                samples = resample_to_whisper_rate(samples, sample_rate)
+                text = self.whisper_manager.audio_to_text({"raw": samples, "sampling_rate": WHISPER_SAMPLE_RATE})
+                if text.strip():
+                    self.texts.append(text.strip())
+            except Exception as e:
+                print(f"[red]Couldn't transcribe part of the mic audio: {e}")
+
+    # Waits for the remaining windows to be transcribed, then returns the full transcript
+    def finish(self):
+        self.windows.put(None)
+        self.thread.join()
+        return " ".join(self.texts)